@@ -0,0 +1,262 @@
+"""
+Benchmarks of the ingestion and analysis pipeline on synthetic exports.
+
+For every user, exports are generated with synthetic_exports.py (seed + user
+number) in a scratch folder, then each stage runs in a fresh process working in
+that folder, so its peak RSS is its own:
+    - parse_tidepool_data, parse_fitbit_data, parse_bitesnap_data on the exports
+    - parse_batch: one month of synthetic cbg entries per call, written to new
+      partitions, then parse_batch_duplicates: the same batches again (all dropped)
+    - generate_statistics on everything the parsers wrote
+
+Results (records/sec, seconds, peak RSS of the stage and of its worker
+processes) go to a JSON file tagged with the git commit, so runs of two commits
+can be compared:
+
+    python benchmark.py --scale 1y --users 2
+    python benchmark.py --scale 1m --compare benchmark-1m-<commit>.json
+
+With --pipelined the parse stages run through the asyncio pipeline (pipeline.py).
+A stage that fails is recorded with its error (the traceback is in the user's
+benchmark.log) and makes the run exit with status 1, after the results are written.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import get_context
+
+from synthetic_exports import DEFAULT_START, TIMEZONE_OFFSET, generate_exports
+
+# Scale name -> days of data per user
+SCALES = {'1m': 30, '1y': 365, '5y': 1826}
+
+STAGES = ['parse_tidepool_data', 'parse_fitbit_data', 'parse_bitesnap_data',
+          'parse_batch', 'parse_batch_duplicates', 'generate_statistics']
+
+
+def _peak_rss_mb(who) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _cbg_batches(days: int, seed: int) -> list:
+    """
+    Returns (month datetime, batch) pairs of cleaned cbg entries, one per month.
+    """
+    batches = {}
+    for i in range(days * 288):
+        moment = DEFAULT_START + timedelta(minutes=5 * i)
+        local = moment + timedelta(minutes=TIMEZONE_OFFSET)
+        entry = {
+            'id': f"{seed:08x}{i:024x}",
+            'type': 'cbg',
+            'units': 'mmol/L',
+            'value': 5.5 + (i % 97) / 10,
+            'utc_Time': moment.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'local_Time': local.strftime("%Y-%m-%dT%H:%M:%S"),
+            'timezoneOffset': TIMEZONE_OFFSET,
+        }
+        batches.setdefault((moment.year, moment.month), []).append(entry)
+    return [(datetime(year, month, 1), {'cbg': batch}) for (year, month), batch in sorted(batches.items())]
+
+
+def run_stage(stage: str, workdir: str, days: int, seed: int, pipelined: bool = False) -> dict:
+    """
+    Runs one stage in `workdir` and returns its measurements. Meant to run in a
+    fresh process; its output goes to `workdir`/benchmark.log.
+    """
+    os.chdir(workdir)
+
+    # Redirect the file descriptor, so the stage's worker processes are quiet too
+    log_file = open("benchmark.log", 'a')
+    sys.stdout.flush()
+    os.dup2(log_file.fileno(), 1)
+    print(f"=== {stage}")
+
+    try:
+        import data_parser
+
+        if stage.startswith('parse_batch'):
+            batches = _cbg_batches(days, seed)
+            source = "benchmark"
+            tic = time.perf_counter()
+            for dateobj, batch in batches:
+                data_parser.parse_batch(batch, dateobj, source)
+            seconds = time.perf_counter() - tic
+            records = sum(len(batch['cbg']) for dateobj, batch in batches)
+        elif stage == 'generate_statistics':
+            import data_analysis
+
+            tic = time.perf_counter()
+            data_analysis.generate_statistics()
+            seconds = time.perf_counter() - tic
+            records = sum(sum(counts.values()) for counts in data_analysis.metric_entry_count.values())
+        else:
+            source = stage[len('parse_'):-len('_data')]
+            filepaths = data_parser.get_filepaths(os.path.join(data_parser.export_folder, source))
+            if pipelined:
+                from pipeline import run_pipeline
+                parser_function = partial(run_pipeline, source)
+            else:
+                parser_function = getattr(data_parser, stage)
+            tic = time.perf_counter()
+            file_stats = parser_function(filepaths)
+            seconds = time.perf_counter() - tic
+            records = sum(stats['records'] for stats in file_stats.values())
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        return {'error': f"{type(e).__name__}: {e}"}
+    finally:
+        sys.stdout.flush()
+
+    return {
+        'records': records,
+        'seconds': round(seconds, 4),
+        'records_per_sec': round(records / seconds, 1) if seconds else None,
+        'peak_rss_mb': round(_peak_rss_mb(resource.RUSAGE_SELF), 1),
+        'peak_rss_workers_mb': round(_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+    }
+
+
+def benchmark_user(workdir: str, days: int, seed: int, stages: list, pipelined: bool = False) -> dict:
+    """
+    Generates one user's exports in `workdir` and runs `stages` on them in order.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    tic = time.perf_counter()
+    generated = generate_exports(os.path.join(workdir, "export_data"), days, seed)
+    print(f"Generated {generated} in {time.perf_counter() - tic:.1f}s")
+
+    results = {}
+    for stage in stages:
+        # A fresh interpreter per stage, so peak RSS is not inherited from earlier stages
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            results[stage] = executor.submit(run_stage, stage, workdir, days, seed, pipelined).result()
+        print(f"  {stage}: {_describe(results[stage])}")
+    return {'seed': seed, 'generated': generated, 'stages': results}
+
+
+def _describe(result: dict) -> str:
+    if 'error' in result:
+        return f"failed ({result['error']})"
+    return (f"{result['records']} records in {result['seconds']:.2f}s "
+            f"({result['records_per_sec']}/s), peak RSS {result['peak_rss_mb']} MB")
+
+
+def _combine(users: list, stages: list) -> dict:
+    """
+    Totals of every stage over all users: records and seconds add up, RSS is the worst.
+    """
+    totals = {}
+    for stage in stages:
+        runs = [user['stages'][stage] for user in users]
+        if any('error' in run for run in runs):
+            totals[stage] = next(run for run in runs if 'error' in run)
+            continue
+        records = sum(run['records'] for run in runs)
+        seconds = sum(run['seconds'] for run in runs)
+        totals[stage] = {
+            'records': records,
+            'seconds': round(seconds, 4),
+            'records_per_sec': round(records / seconds, 1) if seconds else None,
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'peak_rss_workers_mb': max(run['peak_rss_workers_mb'] for run in runs),
+        }
+    return totals
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, previous: dict):
+    """
+    Prints the records/sec and peak RSS of every stage against an earlier run.
+    """
+    print(f"Compared with {previous.get('commit')} ({previous.get('scale')}, {previous.get('users')} users):")
+    for stage, result in current['stages'].items():
+        before = previous.get('stages', {}).get(stage)
+        if not before or 'error' in before or 'error' in result:
+            continue
+        speedup = result['records_per_sec'] / before['records_per_sec'] if before['records_per_sec'] else float('nan')
+        print(f"  {stage}: {speedup:.2f}x records/sec, "
+              f"peak RSS {before['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic exports.")
+    parser.add_argument("--scale", choices=SCALES, default="1m", help="days of data per user")
+    parser.add_argument("--days", type=int, help="overrides --scale")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--output", help="results file (default: benchmark-<scale>-<commit>.json)")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    parser.add_argument("--pipelined", action="store_true", help="parse through the asyncio pipeline")
+    parser.add_argument("--workdir", help="scratch folder (default: a temporary folder, removed afterwards)")
+    args = parser.parse_args()
+
+    days = args.days or SCALES[args.scale]
+    scale = args.scale if not args.days else f"{args.days}d"
+    commit = _git_commit()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="t1d-benchmark-")
+
+    users = []
+    try:
+        for user in range(args.users):
+            print(f"User {user}: {days} days")
+            users.append(benchmark_user(os.path.join(workdir, f"user-{user}"), days, args.seed + user, args.stages,
+                                        args.pipelined))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'days': days,
+        'users': args.users,
+        'seed': args.seed,
+        'pipelined': args.pipelined,
+        'stages': _combine(users, args.stages),
+        'runs': users,
+    }
+
+    output = args.output or f"benchmark-{scale}-{commit or 'nogit'}{'-pipelined' if args.pipelined else ''}.json"
+    with open(output, 'w') as out_file:
+        json.dump(results, out_file, indent=2)
+    print("Results written to", output)
+
+    if args.compare:
+        with open(args.compare, 'r') as previous_file:
+            compare(results, json.load(previous_file))
+
+    failed = [stage for stage, result in results['stages'].items() if 'error' in result]
+    if failed:
+        print(f"Failed stages: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
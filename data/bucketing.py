@@ -0,0 +1,149 @@
+"""
+Single-pass month bucketing for the parsers.
+
+Instead of sorting every record of an export by time and cutting the result into
+calendar months, each record is routed straight to its (metric, year, month)
+partition buffer. Only those small buffers are sorted. When more than
+BUCKET_MAX_BUFFERED_ENTRIES entries are buffered, the largest buffers are sorted
+and spilled to temporary files; at flush time each partition's spilled runs and
+remaining buffer are merged and written in time order.
+"""
+
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+
+from config import BUCKET_MAX_BUFFERED_ENTRIES, BUCKET_SPILL_DIR, STREAM_BATCH_SIZE
+
+
+def _epoch(date_obj: datetime) -> float:
+    return date_obj.timestamp()
+
+
+def _read_spill(spill_path: str):
+    with open(spill_path, 'r') as spill_file:
+        for line in spill_file:
+            epoch, entry = line.split("\t", 1)
+            yield float(epoch), json.loads(entry)
+
+
+class MonthBucketer:
+    """
+    Collects cleaned entries of one source and writes them per partition with
+    `write_batch(data_batch, dateobj, source)` (parse_batch), which returns the
+    number of entries it actually wrote.
+    """
+
+    def __init__(self, source: str, write_batch, max_buffered: int = BUCKET_MAX_BUFFERED_ENTRIES,
+                 spill_dir: str = BUCKET_SPILL_DIR):
+        self.source = source
+        self.write_batch = write_batch
+        self.max_buffered = max_buffered
+        self.spill_dir = spill_dir
+
+        # (metric, year, month) -> [(epoch, entry)]
+        self.buffers = defaultdict(list)
+        # (metric, year, month) -> [spill file path]
+        self.spills = defaultdict(list)
+        self.buffered = 0
+        self.entries_added = 0
+        self.entries_written = 0
+        self._tmp_dir = None
+
+    def add(self, date_obj: datetime, metric: str, entry: dict):
+        """
+        Routes a cleaned entry to its partition; date_obj is its UTC datetime.
+        """
+        self.buffers[(metric, date_obj.year, date_obj.month)].append((_epoch(date_obj), entry))
+        self.buffered += 1
+        self.entries_added += 1
+
+        if self.buffered > self.max_buffered:
+            self._spill()
+
+    def _spill(self):
+        """
+        Sorts and writes the largest buffers to disk until half the budget is free.
+        """
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix=f"{self.source}-buckets-", dir=self.spill_dir)
+
+        for key in sorted(self.buffers, key=lambda key: len(self.buffers[key]), reverse=True):
+            if self.buffered <= self.max_buffered // 2:
+                break
+            buffer = self.buffers.pop(key)
+            buffer.sort(key=lambda item: item[0])
+
+            spill_path = os.path.join(self._tmp_dir, f"{len(os.listdir(self._tmp_dir))}.spill")
+            with open(spill_path, 'w') as spill_file:
+                spill_file.writelines(f"{epoch!r}\t{json.dumps(entry)}\n" for epoch, entry in buffer)
+
+            self.spills[key].append(spill_path)
+            self.buffered -= len(buffer)
+
+    def take_full(self, size: int = STREAM_BATCH_SIZE, max_buffered: int = None) -> list:
+        """
+        Removes the in-memory buffers holding at least `size` entries, then the
+        largest others until at most `max_buffered` entries are left, and returns
+        them as sorted (metric, month datetime, entries) chunks, so they can be
+        written before the flush (see pipeline.py). Spilled runs stay until flush.
+        """
+        keys = [key for key, buffer in self.buffers.items() if len(buffer) >= size]
+        if max_buffered is not None:
+            left = self.buffered - sum(len(self.buffers[key]) for key in keys)
+            for key in sorted(set(self.buffers) - set(keys), key=lambda key: len(self.buffers[key]), reverse=True):
+                if left <= max_buffered:
+                    break
+                keys.append(key)
+                left -= len(self.buffers[key])
+
+        chunks = []
+        for key in keys:
+            metric, year, month = key
+            buffer = self.buffers.pop(key)
+            buffer.sort(key=lambda item: item[0])
+            self.buffered -= len(buffer)
+            chunks.append((metric, datetime(year, month, 1), [entry for _, entry in buffer]))
+        return chunks
+
+    def drain(self):
+        """
+        Yields every partition, in calendar order, as sorted (metric, month
+        datetime, entries) chunks, then removes the spill files.
+        """
+        keys = sorted(set(self.buffers) | set(self.spills), key=lambda key: (key[1], key[2], key[0]))
+        try:
+            for key in keys:
+                metric, year, month = key
+                buffer = self.buffers.pop(key, [])
+                buffer.sort(key=lambda item: item[0])
+                runs = [_read_spill(path) for path in self.spills.pop(key, [])]
+                merged = heapq.merge(buffer, *runs, key=lambda item: item[0]) if runs else iter(buffer)
+
+                # Large partitions are handed over in chunks so a spilled month is
+                # never fully loaded back into memory
+                dateobj = datetime(year, month, 1)
+                chunk = []
+                for _, entry in merged:
+                    chunk.append(entry)
+                    if len(chunk) >= STREAM_BATCH_SIZE:
+                        yield metric, dateobj, chunk
+                        chunk = []
+                if chunk:
+                    yield metric, dateobj, chunk
+        finally:
+            self.buffered = 0
+            if self._tmp_dir is not None:
+                shutil.rmtree(self._tmp_dir, ignore_errors=True)
+                self._tmp_dir = None
+
+    def flush(self):
+        """
+        Writes every partition, in calendar order, and removes the spill files.
+        """
+        for metric, dateobj, chunk in self.drain():
+            self.entries_written += self.write_batch({metric: chunk}, dateobj, source=self.source) or 0
@@ -0,0 +1,174 @@
+"""
+Ingestion and statistics for a cohort of users on one bounded worker pool.
+
+Each user has their own data root, `users/<id>/`, laid out like the
+single-user one (export_data, used_data, cleaned_data). A user's work is a
+sequence of tasks: ingest fitbit, tidepool and bitesnap, then (optionally)
+generate_statistics. The tasks of a user run one at a time, in order, because
+they share the user's ingestion manifest. The tasks of different users run in
+parallel on COHORT_WORKERS processes.
+
+Scheduling is fair: whenever a worker frees up, the next task comes from the
+idle user that has received the least worker time so far. A user with a
+five-year export therefore holds at most one worker, and users with little data
+finish early instead of queuing behind them.
+
+    python cohort.py [--users <id> ...] [--workers N] [--statistics]
+
+writes `users/cohort_report.json` (per-user throughput and latency, per-task
+timings) and each user's run report to their cleaned data folder.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+from config import COHORT_WORKERS, LOG_FORMAT, LOG_LEVEL, RUN_REPORT_FILENAME
+from constants import BITESNAP_FOLDER, CLEANED_FOLDER, FITBIT_FOLDER, TIDEPOOL_FOLDER, USERS_FOLDER
+from instrumentation import RunReport, collecting
+
+logger = logging.getLogger(__name__)
+
+INGEST_TASKS = [FITBIT_FOLDER, TIDEPOOL_FOLDER, BITESNAP_FOLDER]
+STATISTICS_TASK = "statistics"
+
+
+def user_root(user_id: str, users_folder: str = USERS_FOLDER) -> str:
+    return os.path.join(users_folder, user_id)
+
+
+def list_users(users_folder: str = USERS_FOLDER) -> list:
+    if not os.path.isdir(users_folder):
+        return []
+    return sorted(name for name in os.listdir(users_folder) if os.path.isdir(os.path.join(users_folder, name)))
+
+
+def _init_worker(log_level: int):
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+
+
+def run_user_task(user_id: str, task: str, users_folder: str = USERS_FOLDER) -> dict:
+    """
+    Runs one task of a user in a worker process. Returns its timings, record
+    count (records read for ingestion, per-day rows for statistics) and run
+    report; a failure is returned as 'error' rather than raised, so it only
+    stops that user's remaining tasks.
+    """
+    import data_parser
+
+    root = user_root(user_id, users_folder)
+    data_parser.use_data_root(root)
+    tic = time.perf_counter()
+
+    with collecting() as report:
+        try:
+            if task == STATISTICS_TASK:
+                import data_analysis
+
+                results = data_analysis.generate_statistics(data_parser.cleaned_folder)
+                records = sum(len(days) for days in results.values())
+            else:
+                data_parser.create_folders()
+                parsers = {
+                    # The cohort pool is the parallelism; a user's Fitbit metrics are ingested one after another
+                    FITBIT_FOLDER: partial(data_parser.parse_fitbit_data, workers=1),
+                    TIDEPOOL_FOLDER: data_parser.parse_tidepool_data,
+                    BITESNAP_FOLDER: data_parser.parse_bitesnap_data,
+                }
+                data_parser.process_data(task, parsers[task])
+                records = sum(entry['counters'].get('records_read', 0) for entry in report.entries.values())
+        except Exception as e:
+            logger.exception("User %s: %s failed", user_id, task)
+            return {'error': f"{type(e).__name__}: {e}", 'seconds': time.perf_counter() - tic,
+                    'report': report.to_dict()}
+
+    return {'records': records, 'seconds': time.perf_counter() - tic, 'report': report.to_dict()}
+
+
+def run_cohort(user_ids: list, tasks: list, workers: int = COHORT_WORKERS, users_folder: str = USERS_FOLDER) -> dict:
+    """
+    Runs `tasks` for every user on a pool of `workers` processes, scheduling
+    fairly between users. Returns the cohort report.
+    """
+    start = time.perf_counter()
+    pending = {user_id: deque(tasks) for user_id in user_ids}
+    service = {user_id: 0.0 for user_id in user_ids}
+    # When each user's previous task finished, to tell how long the next one queued
+    ready_at = {user_id: start for user_id in user_ids}
+    users = {user_id: {'tasks': {}, 'records': 0, 'busy_seconds': 0.0, 'finished_after': None}
+             for user_id in user_ids}
+    reports = {user_id: RunReport() for user_id in user_ids}
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(logging.getLogger().level,)) as executor:
+        while pending or running:
+            busy_users = {user_id for user_id, task, submitted in running.values()}
+            idle_users = [user_id for user_id in pending if user_id not in busy_users]
+
+            # Least attained service first; ties go to the order users were given in
+            while len(running) < workers and idle_users:
+                user_id = min(idle_users, key=lambda user_id: service[user_id])
+                idle_users.remove(user_id)
+                task = pending[user_id].popleft()
+                if not pending[user_id]:
+                    del pending[user_id]
+                future = executor.submit(run_user_task, user_id, task, users_folder)
+                running[future] = (user_id, task, time.perf_counter())
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id, task, submitted = running.pop(future)
+                result = future.result()
+                reports[user_id].merge(result.pop('report'))
+                result['waited_seconds'] = submitted - ready_at[user_id]
+                ready_at[user_id] = time.perf_counter()
+
+                user = users[user_id]
+                user['tasks'][task] = {name: round(value, 4) if isinstance(value, float) else value
+                                       for name, value in result.items()}
+                user['records'] += result.get('records', 0)
+                user['busy_seconds'] += result['seconds']
+                service[user_id] += result['seconds']
+                if 'error' in result:
+                    # Later tasks of the user depend on this one
+                    pending.pop(user_id, None)
+                if user_id not in pending:
+                    user['finished_after'] = round(time.perf_counter() - start, 4)
+                logger.info("User %s: %s done in %.2fs", user_id, task, result['seconds'])
+
+    for user_id, user in users.items():
+        user['busy_seconds'] = round(user['busy_seconds'], 4)
+        user['records_per_sec'] = round(user['records'] / user['busy_seconds'], 1) if user['busy_seconds'] else None
+        cleaned_folder_path = os.path.join(user_root(user_id, users_folder), CLEANED_FOLDER)
+        if os.path.isdir(cleaned_folder_path):
+            reports[user_id].save(os.path.join(cleaned_folder_path, RUN_REPORT_FILENAME), user['busy_seconds'])
+
+    return {'workers': workers, 'tasks': tasks, 'seconds': round(time.perf_counter() - start, 4), 'users': users}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the exports of every user under " + USERS_FOLDER)
+    parser.add_argument("--users", nargs="+", help="user ids (default: every folder in " + USERS_FOLDER + ")")
+    parser.add_argument("--workers", type=int, default=COHORT_WORKERS)
+    parser.add_argument("--statistics", action="store_true", help="also run generate_statistics for each user")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    user_ids = args.users or list_users()
+    tasks = INGEST_TASKS + ([STATISTICS_TASK] if args.statistics else [])
+    cohort_report = run_cohort(user_ids, tasks, args.workers)
+
+    report_path = os.path.join(USERS_FOLDER, "cohort_report.json")
+    with open(report_path, 'w') as report_file:
+        json.dump(cohort_report, report_file, indent=1)
+
+    for user_id, user in cohort_report['users'].items():
+        logger.info("User %s: %d records, %s records/s, finished after %ss",
+                    user_id, user['records'], user['records_per_sec'], user['finished_after'])
+    logger.info("Cohort of %d users done in %.2fs, report: %s", len(user_ids), cohort_report['seconds'], report_path)
@@ -0,0 +1,369 @@
+"""
+Columnar storage for cleaned partitions of metrics that have a schema in
+METRIC_SCHEMAS.
+
+A partition is stored as typed column arrays instead of JSON dicts: Parquet when
+pyarrow is installed, otherwise NumPy .npz. Like the JSON partitions (see
+partitions.py) it is append-only: each write adds a segment
+`<metric>-YYYY-M.seg-<id>.<ext>` and compaction folds the segments into
+`<metric>-YYYY-M.<ext>`.
+
+Times are stored as int64 UTC epoch seconds (utc_Time) plus the int16 offset in
+minutes (timezoneOffset); local_Time is rebuilt from the two when records are
+read back. Fields outside the schema (Tidepool's deviceId, uploadId, payload...)
+are kept as JSON in the `_extra` column, and so are schema values the typed
+columns would not give back as they were (Fitbit's "1.04" strings, ints in a
+float column, values that do not fit the type): records read back equal the
+records written, so their dedup keys (see dedup_index.py) still match.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+from config import COLUMNAR_FORMAT, METRIC_SCHEMAS
+from partitions import segment_paths
+from timestamps import get_utc_epoch
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Columns every columnar partition has, on top of its metric's schema
+TIME_COLUMNS = {
+    'utc_Time': 'int64',
+    'timezoneOffset': 'int16',
+}
+# JSON of the fields of each record that the other columns do not hold ("" if none)
+EXTRA_COLUMN = '_extra'
+# Key of the extra JSON listing the (dotted) fields a record does not have, for
+# integer columns, which have no empty value
+ABSENT_KEY = '_absent'
+# Record fields rebuilt from the time columns
+_TIME_FIELDS = ['utc_Time', 'local_Time', 'timezoneOffset']
+
+
+def columnar_suffix() -> str:
+    if COLUMNAR_FORMAT:
+        return "." + COLUMNAR_FORMAT
+    return ".parquet" if pq is not None else ".npz"
+
+
+def has_schema(metric: str) -> bool:
+    return metric in METRIC_SCHEMAS
+
+
+def schema_for(metric: str) -> dict:
+    """
+    Returns column -> dtype for a metric, including the time columns.
+    """
+    return {**TIME_COLUMNS, **METRIC_SCHEMAS[metric]}
+
+
+def _get_field(entry: dict, column: str):
+    value = entry
+    for key in column.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def typed_number(value, dtype: str):
+    """
+    Returns what a numeric column of `dtype` stores for a value: NaN for float
+    columns and 0 for integer columns if it is missing, not a number or out of range.
+    """
+    dtype = np.dtype(dtype)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = np.nan
+    if dtype.kind == 'f':
+        return number
+    if number != number or not np.iinfo(dtype).min <= number <= np.iinfo(dtype).max:
+        return 0
+    return int(number)
+
+
+def _stored_exactly(value, dtype: str) -> bool:
+    # Whether a column of `dtype` gives the value back as it was, type included
+    if dtype == 'str':
+        return isinstance(value, str) and value != ""
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
+    stored = np.dtype(dtype).type(typed_number(value, dtype)).item()
+    return type(stored) is type(value) and stored == value
+
+
+def records_to_columns(entries: list, schema: dict) -> dict:
+    """
+    Converts cleaned records to typed column arrays. Missing numbers become NaN
+    for float columns and 0 for integer columns; missing strings become "".
+    'object' columns keep the raw values (only used for in-memory conversions).
+    """
+    columns = {
+        'utc_Time': np.array([get_utc_epoch(entry) for entry in entries], dtype=np.int64),
+        'timezoneOffset': np.array([int(float(entry.get('timezoneOffset') or 0)) for entry in entries], dtype=np.int16),
+    }
+
+    for column, dtype in schema.items():
+        if column in TIME_COLUMNS:
+            continue
+        values = [_get_field(entry, column) for entry in entries]
+        if dtype == 'object':
+            # Filled element by element: np.array would make lists of equal length a 2-D array
+            columns[column] = np.empty(len(values), dtype=object)
+            columns[column][:] = values
+        elif dtype == 'str':
+            columns[column] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+        else:
+            columns[column] = np.array([typed_number(value, dtype) for value in values], dtype=dtype)
+
+    return columns
+
+
+def _field_tree(schema: dict) -> dict:
+    # Dotted column paths as nested dicts, with the column's dtype at the leaves
+    # (None for the time fields, which are rebuilt from the time columns)
+    tree = {}
+    for column, dtype in schema.items():
+        *parents, leaf = column.split('.')
+        node = tree
+        for key in parents:
+            node = node.setdefault(key, {})
+        if isinstance(node, dict):
+            node[leaf] = None if column in _TIME_FIELDS else dtype
+    return tree
+
+
+def _extra_fields(record: dict, tree: dict) -> dict:
+    extra = {}
+    for key, value in record.items():
+        if key not in tree:
+            extra[key] = value
+            continue
+        node = tree[key]
+        if isinstance(node, dict):
+            if isinstance(value, dict):
+                nested = _extra_fields(value, node)
+                if nested:
+                    extra[key] = nested
+            else:
+                extra[key] = value
+        # Values the typed columns do not give back as they were are kept here
+        elif value is None or value == "" or (node is not None and not _stored_exactly(value, node)):
+            extra[key] = value
+    return extra
+
+
+def _absent_fields(record: dict, tree: dict, prefix: str = "") -> list:
+    # Outermost missing field of each integer column, which would read back as 0
+    absent = []
+    for key, node in tree.items():
+        if isinstance(node, dict):
+            if key not in record:
+                if _has_integer_column(node):
+                    absent.append(prefix + key)
+            elif isinstance(record[key], dict):
+                absent.extend(_absent_fields(record[key], node, f"{prefix}{key}."))
+        elif _is_integer(node) and key not in record:
+            absent.append(prefix + key)
+    return absent
+
+
+def _is_integer(dtype) -> bool:
+    return dtype not in (None, 'str', 'object') and np.dtype(dtype).kind in 'iu'
+
+
+def _has_integer_column(tree: dict) -> bool:
+    return any(_has_integer_column(node) if isinstance(node, dict) else _is_integer(node) for node in tree.values())
+
+
+def extra_column(entries: list, schema: dict) -> np.ndarray:
+    """
+    Returns the EXTRA_COLUMN of entries stored in the columns of `schema`
+    (dotted path -> dtype): per entry, the JSON of its other fields and of the
+    values the columns would change, or "".
+    """
+    tree = _field_tree({**dict.fromkeys(_TIME_FIELDS), **schema})
+    extras = []
+    for entry in entries:
+        extra = _extra_fields(entry, tree)
+        absent = _absent_fields(entry, tree)
+        if absent:
+            extra[ABSENT_KEY] = absent
+        extras.append(json.dumps(extra) if extra else "")
+    return np.array(extras, dtype=str)
+
+
+def _merge_fields(target: dict, extra: dict):
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_fields(target[key], value)
+        else:
+            target[key] = value
+
+
+def _remove_field(entry: dict, column: str):
+    *parents, leaf = column.split('.')
+    for key in parents:
+        entry = entry.get(key)
+        if not isinstance(entry, dict):
+            return
+    entry.pop(leaf, None)
+
+
+def columns_to_records(columns: dict) -> list:
+    """
+    Rebuilds cleaned records (with utc_Time/local_Time strings) from column arrays.
+    """
+    utc_epochs = columns['utc_Time']
+    offsets = columns['timezoneOffset']
+    utc_times = np.datetime_as_string(utc_epochs.astype('datetime64[s]')).tolist()
+    local_times = np.datetime_as_string((utc_epochs + offsets.astype(np.int64) * 60).astype('datetime64[s]')).tolist()
+
+    value_columns = [(column, column.split('.'), array.tolist()) for column, array in columns.items()
+                     if column not in TIME_COLUMNS and column != EXTRA_COLUMN]
+    extras = columns[EXTRA_COLUMN].tolist() if EXTRA_COLUMN in columns else None
+
+    records = []
+    for i in range(len(utc_epochs)):
+        entry = {}
+        for column, path, values in value_columns:
+            value = values[i]
+            if value == "" or (isinstance(value, float) and value != value):
+                continue
+            target = entry
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+        entry['utc_Time'] = utc_times[i] + "Z"
+        entry['local_Time'] = local_times[i]
+        entry['timezoneOffset'] = float(offsets[i])
+        if extras is not None and extras[i]:
+            extra = json.loads(extras[i])
+            for column in extra.pop(ABSENT_KEY, ()):
+                _remove_field(entry, column)
+            _merge_fields(entry, extra)
+        records.append(entry)
+
+    return records
+
+
+def _write_columns(path: str, columns: dict):
+    # Write to a temporary file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if path.endswith(".parquet"):
+        pq.write_table(pa.table(columns), tmp_path)
+    else:
+        with open(tmp_path, 'wb') as out_file:
+            np.savez(out_file, **columns)
+    os.replace(tmp_path, path)
+
+
+def _read_columns(path: str, columns: list = None) -> dict:
+    if path.endswith(".parquet"):
+        table = pq.read_table(path, columns=columns)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+
+    with np.load(path) as npz_file:
+        # NpzFile reads members lazily, so only the projected columns are decoded
+        names = columns if columns is not None else npz_file.files
+        return {name: npz_file[name] for name in names if name in npz_file.files}
+
+
+def columnar_files(partition_path: str) -> list:
+    """
+    Returns the base file (if any) and segment files of a columnar partition.
+    """
+    base_name = os.path.splitext(partition_path)[0]
+    files = []
+    for suffix in (".parquet", ".npz"):
+        if os.path.exists(base_name + suffix):
+            files.append(base_name + suffix)
+        files.extend(segment_paths(partition_path, suffix))
+    return files
+
+
+def append_columnar_segment(partition_path: str, metric: str, entries: list) -> str:
+    """
+    Writes entries as a new sorted columnar segment of the partition.
+    """
+    schema = schema_for(metric)
+    columns = records_to_columns(entries, schema)
+    columns[EXTRA_COLUMN] = extra_column(entries, schema)
+    order = np.argsort(columns['utc_Time'], kind='stable')
+    columns = {name: array[order] for name, array in columns.items()}
+
+    segment_id = f"{time.time_ns()}-{os.getpid()}"
+    segment_path = os.path.splitext(partition_path)[0] + f".seg-{segment_id}{columnar_suffix()}"
+    _write_columns(segment_path, columns)
+    return segment_path
+
+
+def read_columnar_partition(partition_path: str, columns: list = None, files: list = None) -> dict:
+    """
+    Returns the partition's columns (all, or only `columns`) sorted by utc_Time,
+    merging the base file and every segment.
+    """
+    if files is None:
+        files = columnar_files(partition_path)
+
+    wanted = None
+    if columns is not None:
+        wanted = list(dict.fromkeys(['utc_Time', *columns]))
+
+    parts = [_read_columns(path, wanted) for path in files]
+    if not parts:
+        return {}
+    if len(parts) == 1:
+        merged = parts[0]
+    else:
+        # Files written before a column existed (EXTRA_COLUMN) get empty values for it
+        names = list(dict.fromkeys(name for part in parts for name in part))
+        merged = {name: np.concatenate([part[name] if name in part else _empty_column(parts, name, part)
+                                        for part in parts]) for name in names}
+        order = np.argsort(merged['utc_Time'], kind='stable')
+        merged = {name: array[order] for name, array in merged.items()}
+
+    if columns is not None and 'utc_Time' not in columns:
+        del merged['utc_Time']
+    return merged
+
+
+def _empty_column(parts: list, name: str, part: dict) -> np.ndarray:
+    dtype = next(other[name].dtype for other in parts if name in other)
+    rows = len(part['utc_Time'])
+    if dtype.kind == 'f':
+        return np.full(rows, np.nan, dtype=dtype)
+    return np.zeros(rows, dtype=dtype)
+
+
+def compact_columnar_partition(partition_path: str) -> bool:
+    """
+    Merges a columnar partition's segments into its base file and removes them.
+    """
+    files = columnar_files(partition_path)
+    segments = [path for path in files if ".seg-" in os.path.basename(path)]
+    if not segments:
+        return False
+
+    merged = read_columnar_partition(partition_path, files=files)
+    base_path = os.path.splitext(partition_path)[0] + columnar_suffix()
+    _write_columns(base_path, merged)
+
+    for path in files:
+        if path != base_path:
+            os.remove(path)
+    return True
+
+
+def columnar_partition_exists(partition_path: str) -> bool:
+    return bool(columnar_files(partition_path))
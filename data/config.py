@@ -1,3 +1,5 @@
+import os
+
 FITBIT_METRICS = [
     'Daily Readiness User Properties',
     'sleep_score',
@@ -78,4 +80,209 @@ FITBIT_SKIPPED_METRICS = [
     'User_Retired_Password',
     'Profile',
     'Stress Score'
-]
\ No newline at end of file
+]
+
+# Timezone used for local times when a source has no entry in SOURCE_TIMEZONES.
+# Naive timestamps in an export are read as wall-clock time in the source's zone.
+DEFAULT_TIMEZONE = "America/New_York"
+
+SOURCE_TIMEZONES = {
+    'tidepool': DEFAULT_TIMEZONE,
+    'fitbit': DEFAULT_TIMEZONE,
+    'bitesnap': DEFAULT_TIMEZONE,
+}
+
+# Record fields that uniquely identify an entry (Tidepool, Bitesnap). Records
+# without one are deduplicated on a hash of their content.
+DEDUP_ID_KEYS = ['id', 'entryID']
+
+# Partition compaction (see partitions.py): segments a partition needs before it is
+# compacted, and how often the background compaction thread runs.
+COMPACTION_MIN_SEGMENTS = 1
+COMPACTION_INTERVAL_SECONDS = 60
+# Seconds between attempts to take a partition lock where flock is unavailable
+LOCK_POLL_INTERVAL = 0.05
+
+# Format new cleaned partitions are written in: "json", "columnar", "packed" or
+# "sqlite" (see storage.py). `python storage.py --convert <format>` rewrites
+# existing ones.
+CLEANED_STORAGE = "json"
+# Database of the "sqlite" format (see sqlite_store.py), in the cleaned data
+# folder, and the filesystem types (as in /proc/mounts) it is not put in WAL
+# mode on: WAL needs shared memory, so it cannot work across machines
+CLEANED_DATABASE_FILENAME = "cleaned.sqlite"
+SQLITE_NETWORK_FILESYSTEMS = {
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs', 'lustre', 'fuse.sshfs', 'fuse.s3fs',
+}
+
+# File format of columnar partitions: "parquet", "npz", or None to use Parquet
+# when pyarrow is installed and .npz otherwise
+COLUMNAR_FORMAT = None
+
+# Typed columns for columnar partitions, per metric. Nested fields use dotted
+# paths. utc_Time (int64 epoch seconds) and timezoneOffset (int16 minutes) are
+# always added; metrics without a schema are stored as JSON. Values a column
+# would not give back as they were (Fitbit's numbers as strings...) are also
+# kept as JSON next to it, so floats are float64: JSON numbers fit them exactly.
+METRIC_SCHEMAS = {
+    'cbg': {'id': 'str', 'value': 'float64', 'units': 'str'},
+    'smbg': {'id': 'str', 'value': 'float64', 'units': 'str'},
+    'basal': {'id': 'str', 'deliveryType': 'str', 'rate': 'float64', 'duration': 'float64'},
+    'bolus': {'id': 'str', 'subType': 'str', 'normal': 'float64'},
+    'heart_rate': {'value.bpm': 'uint8', 'value.confidence': 'uint8'},
+    'steps': {'value': 'uint16'},
+    'calories': {'value': 'float64'},
+    'distance': {'value': 'float64'},
+    'lightly_active_minutes': {'value': 'uint16'},
+    'moderately_active_minutes': {'value': 'uint16'},
+    'very_active_minutes': {'value': 'uint16'},
+    'sedentary_minutes': {'value': 'uint16'},
+    'estimated_oxygen_variation': {'Infrared to Red Signal Ratio': 'int16'},
+    'Minute SpO2': {'value': 'float64'},
+}
+
+# High-frequency metrics kept in the packed format (see packed.py), whatever
+# CLEANED_STORAGE is. Their columns are the METRIC_SCHEMAS ones, and any other
+# fields are kept as JSON in an extra column, which costs its width in every row
+# of a file: cbg records carry several (type, deviceId, uploadId, payload...),
+# so cbg follows CLEANED_STORAGE.
+PACKED_METRICS = [
+    'heart_rate',
+    'Minute SpO2',
+    'estimated_oxygen_variation',
+]
+
+# Width in bytes of string columns in packed rows (ids, units...). A file with
+# longer values gets a wider column rather than truncating them; files written
+# with different widths are merged to the widest.
+PACKED_STRING_WIDTH = 32
+PACKED_STRING_WIDTHS = {
+    'id': 40,
+    'units': 8,
+}
+
+# Rollup tiers (see rollups.py): metric -> value field aggregated at each
+# resolution, in seconds
+ROLLUP_METRICS = {
+    'cbg': 'value',
+    'heart_rate': 'value.bpm',
+    'Minute SpO2': 'value',
+    'estimated_oxygen_variation': 'Infrared to Red Signal Ratio',
+    'steps': 'value',
+    'calories': 'value',
+    'distance': 'value',
+    'lightly_active_minutes': 'value',
+    'moderately_active_minutes': 'value',
+    'very_active_minutes': 'value',
+    'sedentary_minutes': 'value',
+}
+ROLLUP_RESOLUTIONS = [60, 300, 3600, 86400]
+
+# As-of alignment (see alignment.py): value field of metrics that have none in
+# ROLLUP_METRICS (None: the events are only counted), how the samples of a metric
+# falling in one grid step are combined when not averaged, and the default
+# tolerance in seconds of as-of lookups
+ALIGNMENT_FIELDS = {
+    'smbg': 'value',
+    'bolus': 'normal',
+    'basal': 'rate',
+    'food': None,
+}
+ALIGNMENT_AGGREGATES = {
+    'steps': 'sum',
+    'calories': 'sum',
+    'distance': 'sum',
+    'lightly_active_minutes': 'sum',
+    'moderately_active_minutes': 'sum',
+    'very_active_minutes': 'sum',
+    'sedentary_minutes': 'sum',
+    'bolus': 'sum',
+    'food': 'count',
+}
+ALIGNMENT_TOLERANCE_SECONDS = 600
+
+# Materialized per-day analysis results (see daily_summary.py), kept in the
+# cleaned data folder
+DAILY_SUMMARY_FILENAME = "daily_summary.json"
+
+# Records between two entries of the sparse time index of JSON partition files
+# (see partitions.py)
+SPARSE_INDEX_INTERVAL = 256
+
+# Instrumentation (see instrumentation.py): log level of the parsers, file the
+# run report is written to in the cleaned data folder, whether to trace
+# Python allocations (slows ingestion down noticeably) for per-metric peaks, and
+# how many records the parsers decode, normalize and bucket per timed stage
+# (timing every record costs more than normalizing it).
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+RUN_REPORT_FILENAME = "run_report.json"
+INSTRUMENT_TRACEMALLOC = False
+INSTRUMENT_BATCH_SIZE = 2000
+
+# Worker processes shared by all the users of a cohort (see cohort.py)
+COHORT_WORKERS = os.cpu_count() or 1
+
+# Streaming ingestion (see json_stream.py): characters read from an export per
+# chunk, and the most entries handed to parse_batch in one call
+JSON_STREAM_CHUNK_SIZE = 1 << 20
+STREAM_BATCH_SIZE = 50000
+
+# Month bucketing (see bucketing.py): entries buffered in memory before the
+# largest partition buffers are spilled to temporary files, and where to put
+# them (None for the system temp folder)
+BUCKET_MAX_BUFFERED_ENTRIES = 500000
+BUCKET_SPILL_DIR = None
+
+# Parallel Fitbit ingestion: worker processes (1 = serial), and metrics that are
+# scheduled first because they are by far the largest
+FITBIT_INGEST_WORKERS = os.cpu_count() or 1
+FITBIT_LARGE_METRICS = [
+    'heart_rate',
+    'estimated_oxygen_variation',
+    'Minute SpO2',
+]
+# Metrics exported as at least this many files (one per day or month) have their
+# files decoded in parallel instead of being ingested by a single worker
+FITBIT_FILE_PARALLEL_MIN_FILES = 8
+
+# Pipelined ingestion (see pipeline.py): whether process_data uses the asyncio
+# pipeline instead of the sequential parsers, raw records per batch, batches
+# each queue between two stages holds before the stage feeding it waits,
+# normalization worker processes (0 = a single thread) and partition writer threads
+PIPELINE_MODE = False
+PIPELINE_BATCH_SIZE = 5000
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_NORMALIZE_WORKERS = os.cpu_count() or 1
+PIPELINE_WRITERS = 2
+
+# Timestamp columns of Fitbit metrics (see timestamp_schemas.py): metric ->
+# {column: format}, with None to detect the format from the first value. Metrics
+# not listed are inferred from their first FITBIT_SCHEMA_SAMPLE_RECORDS records.
+TIMESTAMP_COLUMNS = {
+    **{metric: {'dateTime': "%m/%d/%y %H:%M:%S"} for metric in [
+        'heart_rate', 'time_in_heart_rate_zones', 'steps', 'calories', 'distance',
+        'lightly_active_minutes', 'moderately_active_minutes', 'very_active_minutes',
+        'sedentary_minutes', 'resting_heart_rate', 'demographic_vo2_max', 'height',
+        'swim_lengths_data',
+    ]},
+    'estimated_oxygen_variation': {'timestamp': "%m/%d/%y %H:%M:%S"},
+    'Minute SpO2': {'timestamp': "%Y-%m-%dT%H:%M:%SZ"},
+    'sleep_score': {'timestamp': "%Y-%m-%dT%H:%M:%SZ"},
+    'sleep': {'startTime': "%Y-%m-%dT%H:%M:%S.%f", 'endTime': "%Y-%m-%dT%H:%M:%S.%f"},
+}
+FITBIT_SCHEMA_SAMPLE_RECORDS = 20
+
+# Ingestion manifest (see manifest.py), kept in the cleaned data folder. Bump
+# CLEANING_VERSION when the cleaning logic changes so every file is ingested again.
+INGEST_MANIFEST_FILENAME = "ingest_manifest.json"
+CLEANING_VERSION = 1
+
+# Resumable ingestion (see task_queue.py): SQLite task queue kept in the cleaned
+# data folder, seconds a claimed task is leased for before another worker may
+# take it over (renewed while it runs), seconds between polls of an idle worker,
+# and attempts before a task is marked failed
+TASK_QUEUE_FILENAME = "ingest_tasks.sqlite"
+TASK_LEASE_SECONDS = 300
+TASK_POLL_SECONDS = 2
+TASK_MAX_ATTEMPTS = 3
@@ -5,6 +5,8 @@ CLEANED_FOLDER = "cleaned_data"
 TIDEPOOL_FOLDER = "tidepool"
 FITBIT_FOLDER = "fitbit"
 BITESNAP_FOLDER = "bitesnap"
+# One data root per user (export, used and cleaned folders) for cohorts, see cohort.py
+USERS_FOLDER = "users"
 
 # 
 local_time_col = "local_Time"
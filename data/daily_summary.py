@@ -0,0 +1,128 @@
+"""
+Materialized per-day analysis results.
+
+`cleaned_data/daily_summary.json` keeps, for every cleaned partition, the
+per-day results of its analyzer (cbg_avg, steps_sum, insulin_sum_basal, ...) and
+its number of entries per day, together with a fingerprint of the partition's
+files (names, sizes, mtimes) or SQLite write counter. A refresh only recomputes the partitions whose
+fingerprint changed, and drops the ones that no longer exist, so statistics and
+plots start from the stored rows instead of re-reading every partition.
+
+Results are stored per local day as [sum, samples], and days are local while
+partitions are UTC months, so the first local day of a month can have samples
+in two partitions. Combining adds their sums and samples up; averages (the keys
+in a row's 'means') are only divided out at the end.
+"""
+
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+from sqlite_store import partition_version
+from storage import partition_files
+
+
+def partition_fingerprint(partition_path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(partition_files(partition_path)):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    # SQLite partitions have no files of their own; their write counter changes instead
+    digest.update(f"sqlite:{partition_version(partition_path)}\n".encode())
+    return digest.hexdigest()
+
+
+class DailySummary:
+    """
+    Per-partition daily rows, persisted as one JSON file.
+    """
+
+    def __init__(self, path: str, partitions: dict = None):
+        self.path = path
+        # partition path -> {metric, fingerprint, results: {key: {MM-DD: [sum, samples]}}, means: [key],
+        #                    entry_counts: {MM-DD-YYYY: n}}
+        self.partitions = partitions if partitions is not None else {}
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, 'r') as summary_file:
+            return cls(path, json.load(summary_file))
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written summary
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as summary_file:
+            json.dump(self.partitions, summary_file)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, partitions: list, summarize) -> int:
+        """
+        Brings the summary up to date with `partitions`, a list of (partition path,
+        metric). `summarize(partition_path, metric)` returns a partition's rows and
+        is only called for new or changed partitions. Returns how many were recomputed.
+        """
+        current = {}
+        recomputed = 0
+        for partition_path, metric in partitions:
+            fingerprint = partition_fingerprint(partition_path)
+            row = self.partitions.get(partition_path)
+            # Rows without 'means' predate per-day sums and samples
+            if row is None or row['fingerprint'] != fingerprint or row['metric'] != metric or 'means' not in row:
+                rows = summarize(partition_path, metric)
+                if rows is None:
+                    # Unreadable partition: left out, and tried again next refresh
+                    continue
+                row = {'metric': metric, 'fingerprint': fingerprint, **rows}
+                recomputed += 1
+            current[partition_path] = row
+
+        self.partitions = current
+        return recomputed
+
+    def results(self) -> dict:
+        """
+        Returns result key -> {MM-DD: value} over all partitions, in partition order.
+        """
+        return combine_results(self.partitions[partition_path]
+                               for partition_path in sorted(self.partitions, key=_calendar_order))
+
+    def entry_counts(self) -> dict:
+        """
+        Returns metric -> {MM-DD-YYYY: number of entries}.
+        """
+        counts = {}
+        for row in self.partitions.values():
+            metric_counts = counts.setdefault(row['metric'], defaultdict(int))
+            for day, count in row['entry_counts'].items():
+                metric_counts[day] += count
+        return counts
+
+
+def combine_results(rows) -> dict:
+    """
+    Combines the per-day [sum, samples] results of partition rows into result
+    key -> {MM-DD: value}: the sum, or sum / samples for the keys in 'means'.
+    """
+    totals = {}
+    means = set()
+    for row in rows:
+        means.update(row['means'])
+        for key, days in row['results'].items():
+            key_totals = totals.setdefault(key, {})
+            for day, (total, samples) in days.items():
+                previous_total, previous_samples = key_totals.get(day, (0.0, 0))
+                key_totals[day] = (previous_total + total, previous_samples + samples)
+
+    return {key: defaultdict(float, {day: total / samples if key in means else total
+                                     for day, (total, samples) in days.items()})
+            for key, days in totals.items()}
+
+
+def _calendar_order(partition_path: str):
+    # "<folder>/<metric>-YYYY-M.json" sorts by folder, then by year and month
+    folder, filename = os.path.split(partition_path)
+    year, month = os.path.splitext(filename)[0].rsplit("-", 2)[1:]
+    return folder, int(year), int(month)
@@ -1,8 +1,8 @@
 import json
 import os
 import re
-import time
 from collections import defaultdict
+from datetime import datetime
 
 import matplotlib.colors as mcolors
 import matplotlib.dates as mdates
@@ -11,7 +11,14 @@ import numpy as np
 import pandas as pd
 from tabulate import tabulate
 
-from data.helpers_old import *
+from alignment import align_metrics
+from config import DAILY_SUMMARY_FILENAME
+from constants import BITESNAP_FOLDER, CLEANED_FOLDER, FITBIT_FOLDER, TIDEPOOL_FOLDER
+from daily_summary import DailySummary, combine_results
+from query import load_metric
+from columnar import records_to_columns
+from rollups import read_tiers, rollup_path
+from storage import JSON_STORAGE, SQLITE_STORAGE, list_partitions, partition_format, read_columns, read_records
 
 """
 notes: 
@@ -19,6 +26,12 @@ notes:
 - what is the difference between distance and steps?
 - 
 """
+# Folders of the single-user layout
+cleaned_folder = CLEANED_FOLDER
+tidepool_folder = TIDEPOOL_FOLDER
+fitbit_folder = FITBIT_FOLDER
+bytesnap_folder = BITESNAP_FOLDER
+
 # GLOBALS:
 total_metrics = set()
 total_days = set()
@@ -32,12 +45,13 @@ plot_entries = True
 plot_metrics = True
 
 
-def get_month_day(entry):
-    # TODO: maybe do it by local time?
-    time_obj = convert_timestamp(next((v for k, v in entry.items() if 'local' in k)))
-    local_datetime = time_obj['local_datetime']
-    month_day_str = local_datetime.strftime("%m-%d")
-    return month_day_str
+def get_foldernames(folder_path):
+    """
+    Returns the names of the subfolders of a folder (the metrics of a source), or [] if it does not exist.
+    """
+    if not os.path.isdir(folder_path):
+        return []
+    return sorted(name for name in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, name)))
 
 def combine_dict(dict1, dict2):
     results = dict1.copy()
@@ -50,159 +64,145 @@ def combine_dict(dict1, dict2):
 
     return results
 
-def analyze_cbg(data):
-    results = {
-        'cbg_total': defaultdict(list),
-        'cbg_avg': defaultdict(float)
-    }
+# Fields each analyzer needs, loaded as float64 columns (object for nested lists)
+ANALYSIS_COLUMNS = {
+    'cbg': {'value': 'float64'},
+    'heart_rate': {'value.bpm': 'float64'},
+    'sleep': {key: 'float64' for key in ["minutesAsleep", "minutesAwake", "minutesAfterWakeup", "timeInBed", "efficiency"]},
+    'steps': {'value': 'float64'},
+    'very_active_minutes': {'value': 'float64'},
+    'sedentary_minutes': {'value': 'float64'},
+    'moderately_active_minutes': {'value': 'float64'},
+    'bolus': {'normal': 'float64'},
+    'basal': {'rate': 'float64', 'duration': 'float64'},
+    'food': {'nutrients': 'object'},
+}
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        cbg_value = entry['value']
-        results['cbg_total'][month_day_str].append(cbg_value)
+def local_days(columns):
+    """
+    Returns the local calendar day (datetime64[D]) of every sample of a columns dict.
+    """
+    local_epochs = columns['utc_Time'] + columns['timezoneOffset'].astype(np.int64) * 60
+    return local_epochs.astype('datetime64[s]').astype('datetime64[D]')
 
-    for key, value in results['cbg_total'].items():
-        results['cbg_avg'][key] = sum(value) / len(value)
+def as_columns(data, fields):
+    """
+    Analyzers take a partition either as cleaned records or as columns (see analyze_metric).
+    """
+    if isinstance(data, dict):
+        return data
+    return records_to_columns(data, fields)
 
-    return results
+def group_by_day(columns, mask=None):
+    """
+    Returns the 'MM-DD' key of every local day in the columns, and each sample's
+    index into those keys. With a mask, only the selected samples are grouped.
+    """
+    days = local_days(columns)
+    if mask is not None:
+        days = days[mask]
+    unique_days, day_index = np.unique(days, return_inverse=True)
+    return [day[5:] for day in np.datetime_as_string(unique_days)], day_index
 
-def analyze_heartrate(data):
-    results = {
-        'heart_rate_total': defaultdict(list),
-        'heart_rate_avg': defaultdict(float)
-    }
+def column_values(columns, name, mask=None):
+    values = np.asarray(columns[name], dtype=np.float64)
+    return values if mask is None else values[mask]
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        heart_rate_value = entry['value']['bpm']
-        results['heart_rate_total'][month_day_str].append(heart_rate_value)
+def daily_sums(keys, day_index, values):
+    sums = np.bincount(day_index, weights=values, minlength=len(keys))
+    return defaultdict(float, zip(keys, sums.tolist()))
 
-    for key, value in results['heart_rate_total'].items():
-        results['heart_rate_avg'][key] = sum(value) / len(value)
+def daily_lists(keys, day_index, values):
+    counts = np.bincount(day_index, minlength=len(keys))
+    per_day = np.split(values[np.argsort(day_index, kind='stable')], np.cumsum(counts)[:-1])
+    return defaultdict(list, zip(keys, (day_values.tolist() for day_values in per_day)))
 
-    return results
+def analyze_cbg(data):
+    columns = as_columns(data, ANALYSIS_COLUMNS['cbg'])
+    keys, day_index = group_by_day(columns)
+    values = column_values(columns, 'value')
 
-def analyze_food(data):
     results = {
-        'calories_total': defaultdict(list),
-        'protein_total': defaultdict(list),
-        'fat_total': defaultdict(list),
-        'carbs_total': defaultdict(list),
-        'sugars_total': defaultdict(list),
-        'calories_sum': defaultdict(float),
-        'protein_sum': defaultdict(float),
-        'fat_sum': defaultdict(float),
-        'carbs_sum': defaultdict(float),
-        'sugars_sum': defaultdict(float),
+        'cbg_total': daily_lists(keys, day_index, values),
+        'cbg_avg': daily_sums(keys, day_index, values),
     }
-
-    for entry in data:
-        nutrients = entry.get('nutrients', [])
-        calories = 0
-        fat = 0
-        protein = 0
-        carbs = 0
-        sugars = 0
-        for nutrient in nutrients:
-            name = nutrient['name']
-            amount = nutrient['amount']
-            if name == 'calories':
-                calories += amount 
-            elif name == 'totalFat':
-                fat += amount
-            elif name == 'totalCarb':
-                carbs += amount
-            elif name == 'sugars':
-                sugars += amount
-            elif name == 'protein':
-                protein += amount
-
-        month_day_str = get_month_day(entry)
-        results['calories_total'][month_day_str].append(calories)
-        results['protein_total'][month_day_str].append(protein)
-        results['fat_total'][month_day_str].append(fat)
-        results['carbs_total'][month_day_str].append(carbs)
-        results['sugars_total'][month_day_str].append(sugars)
-
-        for key, value in results['calories_total'].items():
-            results['calories_sum'][key] = sum(value)
-
-        for key, value in results['protein_total'].items():
-            results['protein_sum'][key] = sum(value)
-
-        for key, value in results['fat_total'].items():
-            results['fat_sum'][key] = sum(value)
-
-        for key, value in results['carbs_total'].items():
-            results['carbs_sum'][key] = sum(value)
-
-        for key, value in results['sugars_total'].items():
-            results['sugars_sum'][key] = sum(value)
+    for key, count in zip(keys, np.bincount(day_index, minlength=len(keys)).tolist()):
+        results['cbg_avg'][key] /= count
 
     return results
 
-def analyze_sleep(data):
-    keys = ["minutesAsleep", "minutesAwake", "minutesAfterWakeup", "timeInBed", "efficiency"]
-    results = {key: defaultdict(float) for key in keys}
+def analyze_heartrate(data):
+    # heart_rate partitions are packed and handed over as memory-mapped columns
+    columns = as_columns(data, ANALYSIS_COLUMNS['heart_rate'])
+    keys, day_index = group_by_day(columns)
+    values = column_values(columns, 'value.bpm')
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        for key in keys:
-            results[key][month_day_str] += entry[key]
+    results = {
+        'heart_rate_total': daily_lists(keys, day_index, values),
+        'heart_rate_avg': daily_sums(keys, day_index, values),
+    }
+    for key, count in zip(keys, np.bincount(day_index, minlength=len(keys)).tolist()):
+        results['heart_rate_avg'][key] /= count
 
     return results
 
-def analyze_steps(data):
-    results = {
-        'steps_total': defaultdict(list),
-        'steps_sum': defaultdict(float)
+def analyze_food(data):
+    nutrient_keys = {
+        'calories': 'calories',
+        'totalFat': 'fat',
+        'totalCarb': 'carbs',
+        'sugars': 'sugars',
+        'protein': 'protein',
     }
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        steps_value = int(entry['value'])
-        results['steps_total'][month_day_str].append(steps_value)
+    columns = as_columns(data, ANALYSIS_COLUMNS['food'])
+    keys, day_index = group_by_day(columns)
 
-    for key, value in results['steps_total'].items():
-        results['steps_sum'][key] = sum(value)
+    # One pass over the nested nutrient lists, then every per-day sum at once
+    totals = {name: np.zeros(len(day_index)) for name in nutrient_keys.values()}
+    for i, nutrients in enumerate(columns['nutrients']):
+        for nutrient in nutrients or []:
+            name = nutrient_keys.get(nutrient['name'])
+            if name is not None:
+                totals[name][i] += nutrient['amount']
+
+    results = {}
+    for name in ['calories', 'protein', 'fat', 'carbs', 'sugars']:
+        results[f'{name}_total'] = daily_lists(keys, day_index, totals[name])
+        results[f'{name}_sum'] = daily_sums(keys, day_index, totals[name])
 
     return results
 
-def analyze_very_active(data):
-    results = {
-        'very_active_minutes': defaultdict(float)
-    }
+def analyze_sleep(data):
+    keys = ["minutesAsleep", "minutesAwake", "minutesAfterWakeup", "timeInBed", "efficiency"]
+    columns = as_columns(data, ANALYSIS_COLUMNS['sleep'])
+    day_keys, day_index = group_by_day(columns)
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        active_mins_value = int(entry['value'])
-        results['very_active_minutes'][month_day_str] += active_mins_value
+    return {key: daily_sums(day_keys, day_index, np.nan_to_num(column_values(columns, key))) for key in keys}
 
-    return results
+def analyze_steps(data):
+    columns = as_columns(data, ANALYSIS_COLUMNS['steps'])
+    keys, day_index = group_by_day(columns)
+    values = np.trunc(column_values(columns, 'value'))
 
-def analyze_moderately_active(data):
-    results = {
-        'moderately_active_minutes': defaultdict(float)
+    return {
+        'steps_total': daily_lists(keys, day_index, values),
+        'steps_sum': daily_sums(keys, day_index, values),
     }
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        moderate_mins_value = int(entry['value'])
-        results['moderately_active_minutes'][month_day_str] += moderate_mins_value
-
-    return results
+def _analyze_minutes(data, metric, result_key):
+    columns = as_columns(data, ANALYSIS_COLUMNS[metric])
+    keys, day_index = group_by_day(columns)
+    return {result_key: daily_sums(keys, day_index, np.trunc(column_values(columns, 'value')))}
 
-def analyze_sedentary(data):
-    results = {
-        'sedentary_minutes': defaultdict(float)
-    }
+def analyze_very_active(data):
+    return _analyze_minutes(data, 'very_active_minutes', 'very_active_minutes')
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        sedentary_mins_value = int(entry['value'])
-        results['sedentary_minutes'][month_day_str] += sedentary_mins_value
+def analyze_moderately_active(data):
+    return _analyze_minutes(data, 'moderately_active_minutes', 'moderately_active_minutes')
 
-    return results
+def analyze_sedentary(data):
+    return _analyze_minutes(data, 'sedentary_minutes', 'sedentary_minutes')
 
 def analyze_basal(data):
     """
@@ -222,44 +222,30 @@ def analyze_basal(data):
     }
     """
 
-    def units_delivered(x):
-        rate_u_per_hr, duration_minutes = x
-        duration_hours = duration_minutes / 60
-        units_delivered = rate_u_per_hr * duration_hours
-        return units_delivered
-
-    results = {
-        'basal_total': defaultdict(list),
-        'insulin_sum_basal': defaultdict(float),
-    }
+    columns = as_columns(data, ANALYSIS_COLUMNS['basal'])
 
-    for entry in data:
-        if 'rate' in entry.keys():
-            month_day_str = get_month_day(entry)
-            rate = entry['rate']
-            duration = entry['duration']
-            results['basal_total'][month_day_str].append((rate, duration))
+    # Only rate-based deliveries count (suspends have no rate)
+    has_rate = ~np.isnan(column_values(columns, 'rate'))
+    keys, day_index = group_by_day(columns, has_rate)
+    rates = column_values(columns, 'rate', has_rate)
+    durations = column_values(columns, 'duration', has_rate)
 
-    for key, value in results['basal_total'].items():
-        results['insulin_sum_basal'][key] = sum(map(units_delivered, value))
-
-    return results
-
-def analyze_bolus(data):
-    results = {
-        'bolus_total': defaultdict(list),
-        'insulin_sum_bolus': defaultdict(float),
+    # units delivered = rate (U/hr) * duration (hours)
+    return {
+        'basal_total': defaultdict(list, {key: [tuple(pair) for pair in pairs] for key, pairs in
+                                          daily_lists(keys, day_index, np.stack([rates, durations], axis=1)).items()}),
+        'insulin_sum_basal': daily_sums(keys, day_index, rates * durations / 60),
     }
 
-    for entry in data:
-        month_day_str = get_month_day(entry)
-        dose = entry['normal']
-        results['bolus_total'][month_day_str].append(dose)
-
-    for key, value in results['bolus_total'].items():
-        results['insulin_sum_bolus'][key] = sum(value)
+def analyze_bolus(data):
+    columns = as_columns(data, ANALYSIS_COLUMNS['bolus'])
+    keys, day_index = group_by_day(columns)
+    doses = column_values(columns, 'normal')
 
-    return results
+    return {
+        'bolus_total': daily_lists(keys, day_index, doses),
+        'insulin_sum_bolus': daily_sums(keys, day_index, doses),
+    }
 
 METRICS_TO_ANALYZE = {
     'cbg': analyze_cbg,
@@ -275,65 +261,116 @@ METRICS_TO_ANALYZE = {
     # 'Daily Heart Rate Variability Summary'
 }
 
+# Results that are per-day averages of the samples, rather than per-day sums
+MEAN_RESULTS = {'cbg_avg', 'heart_rate_avg'}
+
+# Metrics whose per-day result is read from the daily rollup tier (see rollups.py)
+# instead of from the raw samples: metric -> (result key, rollup column)
+ROLLUP_ANALYSES = {
+    'cbg': ('cbg_avg', 'mean'),
+    'heart_rate': ('heart_rate_avg', 'mean'),
+    'steps': ('steps_sum', 'sum'),
+    'very_active_minutes': ('very_active_minutes', 'sum'),
+    'moderately_active_minutes': ('moderately_active_minutes', 'sum'),
+    'sedentary_minutes': ('sedentary_minutes', 'sum'),
+}
+
 def analyze_file(filepath):
     pass
 
+def load_partition_columns(filepath, metric):
+    """
+    Loads a partition as the columns its analyzer needs, plus utc_Time and timezoneOffset.
+    Packed and columnar partitions only read those columns.
+    """
+    fields = ANALYSIS_COLUMNS.get(metric, {})
+    if partition_format(filepath) in (JSON_STORAGE, SQLITE_STORAGE):
+        return records_to_columns(read_records(filepath), fields)
+    return read_columns(filepath, metric, ['utc_Time', 'timezoneOffset', *fields])
+
+def utc_day_counts(utc_epochs, weights=None):
+    """
+    Returns 'MM-DD-YYYY' -> number of entries, by UTC day.
+    """
+    utc_days, day_index = np.unique((np.asarray(utc_epochs) // 86400).astype('datetime64[D]'), return_inverse=True)
+    counts = np.bincount(day_index, weights=weights, minlength=len(utc_days)).astype(np.int64)
+    return {f"{day[5:]}-{day[:4]}": count for day, count in zip(np.datetime_as_string(utc_days), counts.tolist())}
+
+def summarize_partition(filepath, metric):
+    """
+    Returns the per-day rows of one partition: the scalar results of its analyzer
+    as {key: {MM-DD: [sum, samples]}}, the keys that are averages ('means'), and
+    its entries per UTC day. Metrics with rollups are answered from their daily
+    and hourly tiers without reading the samples. See daily_summary.combine_results.
+    """
+    if metric in ROLLUP_ANALYSES and os.path.exists(rollup_path(filepath)):
+        result_key, column = ROLLUP_ANALYSES[metric]
+        tiers = read_tiers(filepath)
+        daily, hourly = tiers[86400], tiers[3600]
+        days = np.datetime_as_string(daily['start'].astype('datetime64[s]').astype('datetime64[D]'))
+        results = {result_key: {day[5:]: [total, samples] for day, total, samples
+                                in zip(days, daily['sum'].tolist(), daily['count'].tolist())}}
+        return {'results': results, 'means': [result_key] if column == 'mean' else [],
+                'entry_counts': utc_day_counts(hourly['start'], hourly['count'])}
+
+    loaded_data = load_partition_columns(filepath, metric)
+    results = {}
+    if metric in METRICS_TO_ANALYZE:
+        day_keys, day_index = group_by_day(loaded_data)
+        samples = dict(zip(day_keys, np.bincount(day_index, minlength=len(day_keys)).tolist()))
+        # Only the per-day values are kept, not the per-entry *_total lists
+        for key, days in METRICS_TO_ANALYZE[metric](loaded_data).items():
+            if not any(isinstance(value, list) for value in days.values()):
+                results[key] = {day: [value * samples[day] if key in MEAN_RESULTS else value, samples[day]]
+                                for day, value in days.items()}
+    return {'results': results, 'means': sorted(MEAN_RESULTS & set(results)),
+            'entry_counts': utc_day_counts(loaded_data['utc_Time'])}
+
+def record_entry_counts(metric, entry_counts):
+    # track the days w/ data available and the number of entries for all of these days
+    if metric not in metric_entry_count:
+        metric_entry_count[metric] = defaultdict(int)
+    for month_day_yr_str, count in entry_counts.items():
+        metric_days[metric].add(month_day_yr_str)
+        metric_entry_count[metric][month_day_yr_str] += count
+
 def analyze_metric(metric, folderpath):
     print("Current metric: ", metric)
-    metric_files = get_filepaths(folderpath)
+    # Each partition is read as the merged view of its base file and segments, or
+    # as its month of the SQLite table, in any storage format
+    metric_files = list_partitions(folderpath)
     total_entries = 0
     total_days = 0
     year_month = ""
-    results = {}
+    summaries = []
 
     for filepath in metric_files:
         pattern = r'-(\d{4}-\d{2})\.json'
         match = re.search(pattern, filepath)
-        daily_stats = defaultdict(int) # 'MM-DD' -> num entries for that day
 
         if match:
             year_month = match.group(1)
             print("Current date: ", year_month)
 
         try:
-            with open(filepath, 'r') as json_file:
-                loaded_data = json.load(json_file)
-                curr_entries = len(loaded_data)
-                total_entries += curr_entries
-                if year_month:
-                    print(f"Number of entries in {year_month}: {curr_entries}")
-                else:
-                    print(f"Number of entries: {curr_entries}")
-
-                if metric in METRICS_TO_ANALYZE:
-                    tmp = METRICS_TO_ANALYZE[metric](loaded_data)
-                    results = combine_dict(results, tmp)
-
-                for entry in loaded_data:
-                    time_obj = convert_timestamp(next((v for k, v in entry.items() if 'utc' in k)))
-                    utc_datetime = time_obj['utc_datetime']
-                    month_day_str = utc_datetime.strftime("%m-%d")
-                    month_day_yr_str = utc_datetime.strftime("%m-%d-%Y")
-
-                    # track the days w/ data avaiable
-                    metric_days[metric].add(month_day_yr_str)
-
-                    # track the number of entries for all of these days
-                    if metric not in metric_entry_count:
-                        metric_entry_count[metric] = defaultdict(int)
-                    metric_entry_count[metric][month_day_yr_str] += 1
-
-                    daily_stats[month_day_str] += 1
-                    # TODO: put any additional stuff that you want to track about the day here
-                    total_entries += 1
-
-                # print monthly statistics
-                daily_stats_table = [["Date", "Entries"]]
-                for date, entries in daily_stats.items():
-                    daily_stats_table.append([date, entries])
-                    total_days += 1
-
-                print(tabulate(daily_stats_table, headers="firstrow"))
+            summary = summarize_partition(filepath, metric)
+            summaries.append(summary)
+            record_entry_counts(metric, summary['entry_counts'])
+
+            curr_entries = sum(summary['entry_counts'].values())
+            total_entries += curr_entries
+            if year_month:
+                print(f"Number of entries in {year_month}: {curr_entries}")
+            else:
+                print(f"Number of entries: {curr_entries}")
+
+            # print monthly statistics
+            daily_stats_table = [["Date", "Entries"]]
+            for date, entries in summary['entry_counts'].items():
+                daily_stats_table.append([date[:5], entries])
+                total_days += 1
+
+            print(tabulate(daily_stats_table, headers="firstrow"))
 
         except json.JSONDecodeError as e:
             print(f"Error loading JSON from {filepath}: {e}")
@@ -341,26 +378,56 @@ def analyze_metric(metric, folderpath):
     print("Total number of entries: ", total_entries)
     print("Total number of days: ", total_days)
 
-    return results
+    return combine_results(summaries)
 
-def generate_statistics():
-    results = {}
+def reset_statistics():
+    """
+    Empties the globals filled by generate_statistics and analyze_metric.
+    """
+    total_metrics.clear()
+    total_days.clear()
+    metric_days.clear()
+    metric_entry_count.clear()
 
+def generate_statistics(cleaned_folder_path: str = None):
+    """
+    Returns the per-day results of every metric from the materialized daily
+    summary, recomputing only the partitions that changed since the last run.
+    `cleaned_folder_path` defaults to the single-user cleaned folder. The
+    globals (total_metrics, metric_days, metric_entry_count) are reset first, so
+    they describe this folder only, even in a process that ran another user's.
+    """
+    cleaned_folder_path = cleaned_folder_path or cleaned_folder
+    reset_statistics()
+    partitions = []
     for source in [tidepool_folder, fitbit_folder, bytesnap_folder]:
         print("Currently on: ", source)
-        cleaned_folder_path = os.path.join(cleaned_folder, source)
-        metric_names = get_foldernames(cleaned_folder_path)
+        source_folder_path = os.path.join(cleaned_folder_path, source)
+        metric_names = get_foldernames(source_folder_path)
 
         print("Metrics: ", metric_names)
         print("Number of metrics: ", len(metric_names))
         total_metrics.update(metric_names)
 
         for metric in metric_names:
-            metric_folder_path = os.path.join(cleaned_folder_path, metric)
-            metric_results = analyze_metric(metric, metric_folder_path)
-            results = combine_dict(results, metric_results) # TODO: retrive extracted results
+            metric_folder_path = os.path.join(source_folder_path, metric)
+            partitions.extend((filepath, metric) for filepath in list_partitions(metric_folder_path))
 
-    return results
+    def summarize(filepath, metric):
+        try:
+            return summarize_partition(filepath, metric)
+        except json.JSONDecodeError as e:
+            print(f"Error loading JSON from {filepath}: {e}")
+            return None
+
+    summary = DailySummary.load(os.path.join(cleaned_folder_path, DAILY_SUMMARY_FILENAME))
+    recomputed = summary.refresh(partitions, summarize)
+    summary.save()
+    print(f"Daily summary: {recomputed} of {len(partitions)} partitions recomputed")
+
+    for metric, entry_counts in summary.entry_counts().items():
+        record_entry_counts(metric, entry_counts)
+    return summary.results()
 
 def compare_metrics(metric1, metric2, data):
     
@@ -378,6 +445,22 @@ def compare_metrics(metric1, metric2, data):
     plt.legend()
     plt.show()
 
+def compare_metrics_aligned(metric1, metric2, start=None, end=None, step=None, cleaned_folder_path=None):
+    """
+    Scatterplot of two "source/metric" series matched sample by sample instead
+    of by day: metric2 as of each sample of metric1, or both on a grid of `step`
+    seconds (see alignment.py). Returns their correlation.
+    """
+    aligned = align_metrics([metric1, metric2], start, end, step=step, on=None if step else metric1,
+                            cleaned_folder_path=cleaned_folder_path or cleaned_folder).dropna()
+
+    plt.scatter(aligned[metric1], aligned[metric2], marker='.', s=4, color='blue')
+    plt.xlabel(metric1)
+    plt.ylabel(metric2)
+    plt.grid(True)
+    plt.show()
+    return aligned[metric1].corr(aligned[metric2])
+
 def plot_timeline(data):
     disregarded_metrics = [
         "swim_lengths_data",
@@ -453,24 +536,13 @@ def plot_entries(data, metrics_to_plot=[]):
     plt.grid(True)
     plt.show()
 
-def analyze_blood_sugars():
+def analyze_blood_sugars(cleaned_folder_path: str = None):
 
-    file_paths = [
-        '/Users/victorgoncalves/Desktop/t1d_data/data/cleaned_data/tidepool/cbg/cbg-2023-9.json',
-        '/Users/victorgoncalves/Desktop/t1d_data/data/cleaned_data/tidepool/cbg/cbg-2023-10.json',
-        '/Users/victorgoncalves/Desktop/t1d_data/data/cleaned_data/tidepool/cbg/cbg-2023-11.json',
-        '/Users/victorgoncalves/Desktop/t1d_data/data/cleaned_data/tidepool/cbg/cbg-2023-12.json',
-    ]
-
-    combined_df = pd.DataFrame()
-    for file_path in file_paths:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-            temp_df = pd.DataFrame(data)
-            combined_df = pd.concat([combined_df, temp_df], ignore_index=True)
-
-    combined_df['utc_Time'] = pd.to_datetime(combined_df['utc_Time'])
-    combined_df['local_Time'] = pd.to_datetime(combined_df['local_Time'])
+    # September to December 2023
+    combined_df = load_metric("tidepool", "cbg", datetime(2023, 9, 1), datetime(2024, 1, 1), columns=['value'],
+                              cleaned_folder_path=cleaned_folder_path or cleaned_folder)
+    combined_df['local_Time'] = pd.to_datetime(combined_df['utc_Time'] + combined_df['timezoneOffset'].astype('int64') * 60, unit='s')
+    combined_df['utc_Time'] = pd.to_datetime(combined_df['utc_Time'], unit='s')
     combined_df['date'] = combined_df['local_Time'].dt.date
     combined_df['hour'] = combined_df['local_Time'].dt.hour
     combined_df['day_of_week'] = combined_df['local_Time'].dt.dayofweek
@@ -501,24 +573,7 @@ def analyze_blood_sugars():
     plt.tight_layout()
     plt.show()
 
-    # Initialize an empty DataFrame to store all data
-    all_data = pd.DataFrame()
-
-    # Process each file
-    for file_path in file_paths:
-        # Load JSON data into a DataFrame
-        with open(file_path, 'r') as file:
-            blood_sugar_data = pd.read_json(file)
-        
-        # Convert time fields to datetime objects
-        blood_sugar_data['utc_Time'] = pd.to_datetime(blood_sugar_data['utc_Time'])
-        blood_sugar_data['local_Time'] = pd.to_datetime(blood_sugar_data['local_Time'])
-
-        # Add a date column for daily analysis
-        blood_sugar_data['date'] = blood_sugar_data['local_Time'].dt.date
-
-        # Append this DataFrame to the main DataFrame
-        all_data = all_data._append(blood_sugar_data, ignore_index=True)
+    all_data = combined_df
 
     # Calculate daily averages
     daily_avg = all_data.groupby('date')['value'].mean()
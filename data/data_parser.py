@@ -6,20 +6,37 @@ create individual timelines for various metrics like  steps, calories, distance.
 
 import os
 import json
+import logging
 import pandas as pd
 from datetime import datetime, timezone
 import shutil
-from collections import defaultdict
+from collections import Counter, defaultdict
 import time
 import re
 import csv
+import heapq
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from itertools import islice
 from config import *
-import pytz
-import sys
+from constants import CLEANED_FOLDER, EXPORT_FOLDER, TIMESTAMP_FORMATS, USED_FOLDER
+from timestamps import TimestampParser
+from tz_offsets import timezone_for_source
+from storage import append_entries, load_dedup_index, remove_partition
+from json_stream import iter_json_array
+from bucketing import MonthBucketer
+from locks import partition_lock
+from timestamp_schemas import sample_records, timestamp_parsers
+from manifest import IngestionManifest
+from rollups import has_rollups, rebuild_rollups, remove_rollups, update_rollups
+from instrumentation import collecting, count, current, memory_peak, stage
+
+logger = logging.getLogger(__name__)
 
 all_events = [] # List of all events from all data sources (CSV & JSON)
 
 # Define all the folder names
+data_root = ""
 export_folder = "export_data" 
 used_folder = "used_data"
 cleaned_folder = "cleaned_data"
@@ -32,17 +49,23 @@ utc_time_col = "utc_Time"
 # metric -> json file path
 metrics = dict()
 
-local_timezone_str = "America/New_York"
+local_timezone_str = DEFAULT_TIMEZONE
 
-formats_to_try =  [
-    "%Y-%m-%dT%H:%M:%S.%fZ", 
-    "%Y-%m-%dT%H:%M:%S.%f", 
-    "%Y-%m-%dT%H:%M:%SZ", 
-    "%Y-%m-%dT%H:%M:%S", 
-    "%Y-%m-%dT%H:%M", 
-    "%m/%d/%y %H:%M:%S", 
-    "%m/%d/%y"
-]
+formats_to_try = TIMESTAMP_FORMATS
+
+# Shared parser: remembers the last matched format, so a file is only sniffed once
+timestamp_parser = TimestampParser()
+
+def use_data_root(root: str = ""):
+    """
+    Points the export, used and cleaned folders at `root`: "" for the single-user
+    layout, users/<id> for a cohort (see cohort.py).
+    """
+    global data_root, export_folder, used_folder, cleaned_folder
+    data_root = root
+    export_folder = os.path.join(root, EXPORT_FOLDER)
+    used_folder = os.path.join(root, USED_FOLDER)
+    cleaned_folder = os.path.join(root, CLEANED_FOLDER)
 
 def create_folders():
     """
@@ -59,7 +82,22 @@ def create_folders():
             subfolder_path = os.path.join(folder, subfolder)
             os.makedirs(subfolder_path, exist_ok=True)
 
-def move_folder_contents(export_folder_path, destination_folder_path: str):
+def _move_file(source_file: str, export_folder_path: str, destination_folder_path: str) -> str:
+    destination_file = os.path.join(destination_folder_path, os.path.relpath(source_file, export_folder_path))
+    if os.path.exists(destination_file):
+        timestamp = datetime.now().strftime("%Y%m%d")
+        base_name, file_extension = os.path.splitext(destination_file)
+        destination_file = f"{base_name}_{timestamp}{file_extension}"
+
+    shutil.move(source_file, destination_file)
+    return destination_file
+
+def move_folder_contents(export_folder_path, destination_folder_path: str) -> list:
+    """
+    Moves everything under export_folder_path to destination_folder_path, renaming
+    what already exists there. Returns the (source, destination) pairs moved.
+    """
+    moves = []
     for root, dirs, files in os.walk(export_folder_path):
         for directory in dirs:
             source_dir = os.path.join(root, directory)
@@ -68,16 +106,28 @@ def move_folder_contents(export_folder_path, destination_folder_path: str):
                 timestamp = datetime.now().strftime("%Y%m%d")
                 destination_dir += f"_{timestamp}"
             shutil.move(source_dir, destination_dir)
+            moves.append((source_dir, destination_dir))
 
         for file in files:
             source_file = os.path.join(root, file)
-            destination_file = os.path.join(destination_folder_path, os.path.relpath(source_file, export_folder_path))
-            if os.path.exists(destination_file):
-                timestamp = datetime.now().strftime("%Y%m%d")
-                base_name, file_extension = os.path.splitext(destination_file)
-                destination_file = f"{base_name}_{timestamp}{file_extension}"
+            moves.append((source_file, _move_file(source_file, export_folder_path, destination_folder_path)))
 
-            shutil.move(source_file, destination_file)
+    return moves
+
+def move_files(filepaths: list, export_folder_path: str, destination_folder_path: str) -> list:
+    """
+    Moves the files `filepaths` (under export_folder_path) to the same place under
+    destination_folder_path, like move_folder_contents, leaving any other file.
+    Files that no longer exist are skipped. Returns the (source, destination) pairs moved.
+    """
+    moves = []
+    for source_file in filepaths:
+        if not os.path.isfile(source_file):
+            continue
+        os.makedirs(os.path.join(destination_folder_path,
+                                 os.path.relpath(os.path.dirname(source_file), export_folder_path)), exist_ok=True)
+        moves.append((source_file, _move_file(source_file, export_folder_path, destination_folder_path)))
+    return moves
 
 def convert_timestamp_old(timestamp_str: str) -> (str, datetime):
     """
@@ -100,98 +150,18 @@ def convert_timestamp_old(timestamp_str: str) -> (str, datetime):
     # If none of the formats match, raise an error
     raise ValueError("Unsupported timestamp format")
 
-def convert_timestamp(timestamp_str: str) -> dict:
+def convert_timestamp(timestamp_str: str, timezone_str: str = None) -> dict:
     """
     Function that takes multiple timestamp formats, converts them to UTC, and then to a specified timezone.
     """
-    local_timezone = pytz.timezone(local_timezone_str)
-    results = {}
-
-    for format_str in formats_to_try:
-        try:
-            # Try to create a datetime object using the current format string
-            datetime_obj = datetime.strptime(timestamp_str, format_str)
-            
-            # If the datetime object doesn't have tzinfo, we assume it's in UTC time
-            if 'Z' in timestamp_str or '.000Z' in timestamp_str:
-                datetime_obj = datetime_obj.replace(tzinfo=timezone.utc)
-
-            # Convert the datetime object to UTC and the specified local timezone
-            datetime_obj_utc = datetime_obj.astimezone(timezone.utc)
-            datetime_obj_local = datetime_obj_utc.astimezone(local_timezone)
-
-            # Offset in minutes from local to UTC
-            offset_minutes = datetime_obj_local.utcoffset().total_seconds() // 60
-
-            # Format the datetime objects to the specified ISO 8601 format
-            utc_iso8601_str = datetime_obj_utc.strftime("%Y-%m-%dT%H:%M:%SZ")
-            local_iso8601_str = datetime_obj_local.strftime("%Y-%m-%dT%H:%M:%S")
-
-            results['utc_time'] = utc_iso8601_str
-            results['utc_datetime'] = datetime_obj_utc
-            results['local_time'] = local_iso8601_str
-            results['local_datetime'] = datetime_obj_local
-            results['offset'] = offset_minutes
-            return results
-        except ValueError:
-            continue
-    
-    raise ValueError("Unsupported timestamp format")
+    return timestamp_parser.convert(timestamp_str, timezone_str or local_timezone_str)
 
 def matches_timestamp_format(timestamp_str: str):
     """
     Checks if a timestamp is within accepted formats.
     """
-    for format_str in formats_to_try:
-        try:
-            datetime.strptime(timestamp_str, format_str)
-            return True
-        except ValueError:
-            continue
-    return False
-
-def binary_search_by_time(data, target_entry):
-    """
-    Perform a binary search to determine if an entry exists in the data based on its timestamp.
+    return timestamp_parser.matches(timestamp_str)
 
-    This function not only looks for the exact timestamp match but also checks nearby entries 
-    for possible duplicates with the same timestamp. 
-    """
-
-    date_key = next((k for k, v in target_entry.items() if 'utc' in k))
-    target_dateStr = target_entry[date_key]
-    target_dateTime = convert_timestamp(target_dateStr)['utc_datetime']
-    duplicates = []
-    start, end = 0, len(data) - 1
-
-    while start <= end:
-        mid = (start + end) // 2
-        current_time = convert_timestamp(data[mid][date_key])['utc_datetime']
-
-        if current_time == target_dateTime:
-            duplicates.append(data[mid])
-            
-            # Check for duplicates in the right half
-            right_index = mid + 1
-            while right_index < len(data) and data[right_index][date_key] == target_dateStr:
-                duplicates.append(data[right_index])
-                right_index += 1
-
-            # Check for duplicates in the left half
-            left_index = mid - 1
-            while left_index >= 0 and data[left_index][date_key] == target_dateStr:
-                duplicates.append(data[left_index])
-                left_index -= 1
-
-            return target_entry in duplicates
-            
-        elif current_time < target_dateTime:
-            start = mid + 1
-        else:
-            end = mid - 1
-
-    return False
-    
 def get_filepaths(folder_path: str) -> list:
     """
     Returns a list of file paths in the folder path, going through all subfolders recursively.
@@ -205,142 +175,181 @@ def get_filepaths(folder_path: str) -> list:
             filepaths.append(file_path)
     return filepaths
 
-def parse_batch(data_batch: defaultdict(list), dateobj: datetime, source: str):
+def partition_key(source: str, metric: str, year: int, month: int) -> str:
+    """
+    Returns the path of a month partition relative to the cleaned data folder.
+    """
+    return os.path.join(source, metric, f"{metric}-{year}-{month}.json")
+
+def _track_file(file_stats: dict, filepath: str, source: str, metric: str, date_obj: datetime):
+    stats = file_stats.setdefault(filepath, {'partitions': set(), 'records': 0})
+    stats['partitions'].add(partition_key(source, metric, date_obj.year, date_obj.month))
+    stats['records'] += 1
+
+def parse_batch(data_batch: defaultdict(list), dateobj: datetime, source: str, storage: str = None):
     """
     Function that takes a list of events and generates a separate JSON file for each metric.
-    If the file already exists, it will be appended to without duplicates.
+    If the file already exists, the new entries are appended to it as a segment, without duplicates.
+
+    `storage` overrides CLEANED_STORAGE ("json", "columnar", "packed" or "sqlite") for new partitions.
+    Returns the number of entries written (i.e. not dropped as duplicates).
     """
+    entries_written = 0
+
     # Iterate through each metric in the input data batch
     for metric in data_batch:
+        key = f"{source}/{metric}"
+
         # Construct the directory path for the metric and create it if it doesn't exist
         metric_folder = os.path.join(cleaned_folder, source, metric)
         os.makedirs(metric_folder, exist_ok=True)
 
         # Construct the file path for the JSON file
-        filename = f"{metric}-{dateobj.year}-{dateobj.month}.json"
-        json_file_path = os.path.join(metric_folder, filename)
+        json_file_path = os.path.join(cleaned_folder, partition_key(source, metric, dateobj.year, dateobj.month))
 
-        if os.path.exists(json_file_path):
+        # Hold the partition's lock so parallel workers never interleave writes to one month
+        with stage(key, 'write'), partition_lock(json_file_path):
             try:
-                with open(json_file_path, 'r') as json_file:
-                    loaded_data = json.load(json_file)
-                    # Merge the entries from the data batch into the existing JSON file, avoiding duplicates
-                    for entry in data_batch[metric]:
-                        # if entry not in loaded_data:
-                        #     loaded_data.append(entry)
-                        # print('here')
-                        # TODO: this is not actually faster for some reason which is strange
-
-                        
-                        # TODO: Fix duplicates
-                        if entry not in loaded_data:
-                            print('not missing')
-
-                            print(loaded_data)
-
-                            print()
-
-                            print(entry)
-                            time.sleep(1000)
-
-                        if not binary_search_by_time(loaded_data, entry):
-                            print('not missing binary')
-
-
-                        if not binary_search_by_time(loaded_data, entry):
-                            loaded_data.append(entry)
-
-                    loaded_data.sort(key=lambda entry: convert_timestamp(next((v for k, v in entry.items() if 'utc' in k)))['utc_datetime'])
-                    with open(json_file_path, 'w') as json_file:
-                        json.dump(loaded_data, json_file)
-
+                with stage(key, 'dedup'):
+                    index = load_dedup_index(json_file_path, metric, storage)
             except json.JSONDecodeError as e:
-                print(f"Error loading JSON from {json_file_path}: {e}")
-        else:
-            with open(json_file_path, "w") as json_file:
-                json.dump(data_batch[metric], json_file)
-
-            """
-            csv code:
-
-            csv_filename = f"{metric}-{dateobj.year}-{dateobj.month}.csv"
-            csv_file_path = os.path.join(metric_folder, csv_filename)
-            fieldnames = data_batch[metric][0].keys()
-            with open(csv_file_path, mode='w', newline='') as file:
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in data_batch[metric]:
-                    writer.writerow(row)
-            """
+                logger.error("Error loading JSON from %s: %s", json_file_path, e)
+                continue
+
+            if index.recovered and has_rollups(metric):
+                # The last write stopped before its index was saved: its entries may be
+                # stored and counted in the rollups or not, so recount them from the records
+                logger.warning("Recovering interrupted write to %s", json_file_path)
+                with stage(key, 'rollup'):
+                    rebuild_rollups(json_file_path, metric)
+
+            # Only the entries that are not in the partition yet are written, as a new segment
+            with stage(key, 'dedup'):
+                new_entries = index.filter_new(data_batch[metric])
+            if new_entries:
+                index.begin_write()
+                append_entries(json_file_path, metric, new_entries, storage)
+                with stage(key, 'rollup'):
+                    update_rollups(json_file_path, metric, new_entries)
+            with stage(key, 'dedup'):
+                index.save()
+
+        count(key, 'records_in', len(data_batch[metric]))
+        count(key, 'records_written', len(new_entries))
+        count(key, 'duplicates', len(data_batch[metric]) - len(new_entries))
+        entries_written += len(new_entries)
+
+        """
+        csv code:
+
+        csv_filename = f"{metric}-{dateobj.year}-{dateobj.month}.csv"
+        csv_file_path = os.path.join(metric_folder, csv_filename)
+        fieldnames = data_batch[metric][0].keys()
+        with open(csv_file_path, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in data_batch[metric]:
+                writer.writerow(row)
+        """
+
+    return entries_written
+
+def clean_tidepool_entry(entry: dict, timezone_str: str):
+    """
+    Replaces the time fields of a Tidepool entry with its utc/local times and offset.
+    Returns (utc datetime, metric, entry), or None if the entry has no valid time.
+    """
+    try:
+        converted_time = convert_timestamp(entry["time"], timezone_str)
+    except (KeyError, ValueError):
+        return None
+
+    del entry["time"]
+    if "deviceTime" in entry:
+        del entry["deviceTime"]
+    if "localTime" in entry:
+        del entry["localTime"]
+    if "timezoneOffset" in entry:
+        del entry["timezoneOffset"]
+
+    entry[utc_time_col] = converted_time['utc_time']
+    entry[local_time_col] = converted_time['local_time']
+    entry['timezoneOffset'] = converted_time['offset']
+    return converted_time['utc_datetime'], entry["type"], entry
+
+def _timed_batches(records, key: str):
+    """
+    Yields lists of up to INSTRUMENT_BATCH_SIZE records, timing their decoding as
+    one stage per batch rather than per record.
+    """
+    records = iter(records)
+    while True:
+        with stage(key, 'decode'):
+            batch = list(islice(records, INSTRUMENT_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+def _count_cleaned(source: str, batch: list, cleaned: list):
+    """
+    Counts the records read per metric and the ones rejected in a batch of a
+    source, given its cleaned (utc datetime, metric, entry) triples.
+    """
+    for metric_type, n in Counter(metric_type for _, metric_type, _ in cleaned).items():
+        count(f"{source}/{metric_type}", 'records_read', n)
+    count(source, 'records_rejected', len(batch) - len(cleaned))
 
 def parse_tidepool_data(filepaths: list):
     """
     Function that takes a list of filepaths to Tidepool data files and generates a separate json file for each metric.
+    Exports are streamed entry by entry into a MonthBucketer, so memory use does not grow with the size of the export.
+    Returns the partitions and record count of each file.
     """
     set_of_metrics = set()
-
-    for filepath in filepaths:
-        if filepath.endswith(".json"):
-            print("current file:", filepath)
-            with open(filepath, 'r') as json_file:
-                # TODO: Address this bottleneck.. will load all of the data at once. 
-                data = json.load(json_file) 
-                sorted_data = sorted(data, key=lambda entry: convert_timestamp(entry['time'])['utc_datetime'])
-                # TODO: again bottleneck if you run into issues
-
-                data_batch = defaultdict(list)
-                current_month = None
-                current_dateobj = None
-                for entry in sorted_data:
-                    # Clean the entry's time data
-                    try:
-                        if "time" in entry:
-                            converted_time = convert_timestamp(entry["time"])
-                            del entry["time"]
-
-                            if "deviceTime" in entry:
-                                del entry["deviceTime"]
-                            if "localTime" in entry:
-                                del entry["localTime"]
-                            if "timezoneOffset" in entry:
-                                del entry["timezoneOffset"]
-                            
-                            entry[utc_time_col] = converted_time['utc_time']
-                            entry[local_time_col] = converted_time['local_time']
-                            entry['timezoneOffset'] = converted_time['offset']
-                            entry['datetime'] = converted_time['utc_datetime']
-                    except:
-                        print("error:", entry)
-
-                    metric_type = entry["type"]
-                    set_of_metrics.add(metric_type)
-                    date_obj = entry['datetime']
-                    del entry['datetime']
-
-                    if current_month is None:
-                        current_month = date_obj.month
-                        current_dateobj = date_obj
-
-                    if date_obj.month == current_month:
-                        data_batch[metric_type].append(entry)
-                    else:
-                        # Process the data batch for the previous month
-                        parse_batch(data_batch, current_dateobj, source="tidepool")
-
-                        # Start a new data batch for the current month
-                        data_batch = defaultdict(list)
-                        data_batch[metric_type].append(entry)
-                        current_month = date_obj.month
-                        current_dateobj = date_obj
-
-                # Process the last data batch after exiting the loop
-                if data_batch:
-                    parse_batch(data_batch, date_obj, source="tidepool")
-
-    print("Total metric lst:", set_of_metrics)
-
-def parse_fitbit_data(filepaths: list):
-
+    timezone_str = timezone_for_source("tidepool")
+
+    def clean_batches(json_file):
+        for batch in _timed_batches(iter_json_array(json_file), "tidepool"):
+            cleaned = []
+            with stage("tidepool", 'normalize'):
+                for entry in batch:
+                    triple = clean_tidepool_entry(entry, timezone_str)
+                    if triple is None:
+                        logger.debug("Tidepool entry without a valid time: %s", entry)
+                        continue
+                    cleaned.append(triple)
+
+            _count_cleaned("tidepool", batch, cleaned)
+            set_of_metrics.update(metric_type for _, metric_type, _ in cleaned)
+            yield cleaned
+
+    # filepath -> {partitions, records}, for the ingestion manifest
+    file_stats = {}
+
+    bucketer = MonthBucketer("tidepool", parse_batch)
+    with memory_peak("tidepool"):
+        for filepath in filepaths:
+            if filepath.endswith(".json"):
+                logger.info("Tidepool file: %s", filepath)
+                count("tidepool", 'files')
+                count("tidepool", 'bytes_read', os.path.getsize(filepath))
+                with open(filepath, 'r') as json_file:
+                    for cleaned in clean_batches(json_file):
+                        with stage("tidepool", 'bucket'):
+                            for date_obj, metric_type, entry in cleaned:
+                                _track_file(file_stats, filepath, "tidepool", metric_type, date_obj)
+                                bucketer.add(date_obj, metric_type, entry)
+        with stage("tidepool", 'bucket'):
+            bucketer.flush()
+
+    logger.info("Tidepool metrics: %s", sorted(set_of_metrics))
+    return file_stats
+
+def discover_fitbit_files(filepaths: list) -> dict:
+    """
+    Groups Fitbit export files by metric, based on their filenames.
+    Returns metric -> list of struct {filename, dates, extension}.
+    """
     filepaths = [path for path in filepaths if path.endswith((".csv", ".json"))]
 
     # Regex pattern to match filenames and capture the metric name, dates (including those in parentheses), and extension.
@@ -374,10 +383,7 @@ def parse_fitbit_data(filepaths: list):
                 dates = partial_date_check.group(1)
                 metric = metric[:metric.rfind(dates)].rstrip(' -')
 
-            print(f'Matched Filename: {filename}')
-            print(f'Metric: {metric}')
-            print(f'Dates: {dates}')
-            print(f'Extension: {extension}\n')
+            logger.debug("Matched %s: metric %r, dates %r, extension %s", filename, metric, dates, extension)
 
             metrics[metric].append({
                 'filename': filename,
@@ -388,125 +394,271 @@ def parse_fitbit_data(filepaths: list):
             missing_matches.append(filename)
 
     if missing_matches:
-        print("REGEX MATCHES MISSING")
-        print(missing_matches)
+        logger.warning("Fitbit files not matching any metric: %s", missing_matches)
 
-    print("Metric keys:", metrics.keys())
+    logger.info("Fitbit metrics: %s", list(metrics))
+    return metrics
 
-    for metric, file_struct_list in metrics.items():
-
-        print("Current metric:", metric)
+def _normalize_fitbit_record(record: dict, parsers: dict, timezone_str: str) -> dict:
+    """
+    Replaces the timestamp fields of a Fitbit CSV row or JSON item with their
+    utc/local versions, and sets 'datetime' to the record's UTC datetime.
+    Only the metric's known timestamp columns (`parsers`, see timestamp_schemas.py) are looked at.
+    """
+    # some entries might have more than one timestamp: say start/end time
+    found_timestamps = []
+    for key, parser in parsers.items():
+        value = record.get(key)
+        if not isinstance(value, str):
+            continue
+        try:
+            found_timestamps.append((key, parser.convert(value, timezone_str)))
+        except ValueError:
+            continue
 
-        if metric in FITBIT_SKIPPED_METRICS:
+    if len(found_timestamps) > 1:
+        for key, converted_time in found_timestamps:
+            del record[key]
+            record['utc_' + key] = converted_time['utc_time']
+            record['local_' + key] = converted_time['local_time']
+            record['timezoneOffset'] = converted_time['offset']
+            record['datetime'] = converted_time['utc_datetime']
+
+    elif len(found_timestamps) == 1:
+        key, converted_time = found_timestamps.pop()
+        del record[key]
+        record[utc_time_col] = converted_time['utc_time']
+        record[local_time_col] = converted_time['local_time']
+        record['timezoneOffset'] = converted_time['offset']
+        record['datetime'] = converted_time['utc_datetime']
+
+    return record
+
+def iter_fitbit_file(metric: str, file_struct: dict, timezone_str: str):
+    """
+    Yields the normalized records of one Fitbit export file as (utc datetime, entry)
+    pairs, in file order. JSON files are streamed, so a file is never loaded whole.
+    """
+    filename = file_struct['filename']
+    extension = file_struct['extension']
+    key = f"fitbit/{metric}"
+
+    logger.debug("Fitbit file: %s", filename)
+    count(key, 'files')
+    count(key, 'bytes_read', os.path.getsize(filename))
+
+    with open(filename, 'r') as export_file:
+        if extension == '.csv':
+            records = csv.DictReader(export_file)
+        elif extension == '.json':
+            records = iter_json_array(export_file)
+        else:
+            logger.warning("Trying to read an incorrect filepath: %s", file_struct)
+            return
+
+        # The first records tell which columns are timestamps if the metric has no declared schema
+        with stage(key, 'decode'):
+            sample, records = sample_records(records)
+        parsers = timestamp_parsers(metric, sample)
+
+        for batch in _timed_batches(records, key):
+            pairs = []
+            with stage(key, 'normalize'):
+                for record in batch:
+                    entry = _normalize_fitbit_record(record, parsers, timezone_str)
+                    if 'datetime' not in entry:
+                        logger.debug("%s record without a valid timestamp: %s", metric, entry)
+                        continue
+                    pairs.append((entry.pop('datetime'), entry))
+            count(key, 'records_read', len(batch))
+            count(key, 'records_rejected', len(batch) - len(pairs))
+            yield from pairs
+
+def _in_order(pairs, divert):
+    """
+    Passes (datetime, entry) pairs through while they are in time order; the ones
+    that are not are handed to `divert` so the run stays sorted for the merge.
+    Files written newest-first (sleep-*.json) divert almost every record, so
+    `divert` must not hold them in memory: the month bucketer spills them.
+    """
+    last = None
+    for pair in pairs:
+        if last is not None and pair[0] < last:
+            divert(pair)
             continue
+        last = pair[0]
+        yield pair
 
-        total_metric_data = []
-    
-        # Get all the data for a specific metric
-        for file_struct in file_struct_list:
-
-            filename = file_struct['filename']
-            date = file_struct['date']
-            extension = file_struct['extension']
-
-            print("Current file:", filename)
-
-            if extension == '.csv':
-                with open(filename, 'r') as csvfile:
-                    csvreader = csv.DictReader(csvfile)
-                    for row in csvreader:
-                        # some entries might have more than one timestamp: say start/end time
-                        found_timestamps = []
-                        for key, value in list(row.items()):
-                            if not isinstance(value, dict) and isinstance(value, str) and matches_timestamp_format(value):
-                                found_timestamps.append((key, value))
-
-                        if len(found_timestamps) > 1:
-                            for key, value in found_timestamps:
-                                converted_time = convert_timestamp(value)
-                                del row[key]
-                                row['utc_' + key] = converted_time['utc_time']
-                                row['local_' + key] = converted_time['local_time']
-                                row['timezoneOffset'] = converted_time['offset']
-                                row['datetime'] = converted_time['utc_datetime']
-
-                        elif len(found_timestamps) == 1:
-                            key, value = found_timestamps.pop()
-                            converted_time = convert_timestamp(value)
-                            del row[key]
-                            row[utc_time_col] = converted_time['utc_time']
-                            row[local_time_col] = converted_time['local_time']
-                            row['timezoneOffset'] = converted_time['offset']
-                            row['datetime'] = converted_time['utc_datetime']
-                        
-                        total_metric_data.append(row)
-            elif extension == '.json':
-                with open(filename, 'r') as jsonfile:
-                    data = json.load(jsonfile)  
-                    for item in data:
-                        # some entries might have more than one timestamp: say start/end time
-                        found_timestamps = []
-                        for key, value in list(item.items()):
-                            if not isinstance(value, dict) and isinstance(value, str) and matches_timestamp_format(value):
-                                found_timestamps.append((key, value))
-
-                        if len(found_timestamps) > 1:
-                            for key, value in found_timestamps:
-                                converted_time = convert_timestamp(value)
-                                del item[key]
-                                item['utc_' + key] = converted_time['utc_time']
-                                item['local_' + key] = converted_time['local_time']
-                                item['timezoneOffset'] = converted_time['offset']
-                                item['datetime'] = converted_time['utc_datetime']
-
-                        elif len(found_timestamps) == 1:
-                            key, value = found_timestamps.pop()
-                            converted_time = convert_timestamp(value)
-                            del item[key]
-                            item[utc_time_col] = converted_time['utc_time']
-                            item[local_time_col] = converted_time['local_time']
-                            item['timezoneOffset'] = converted_time['offset']
-                            item['datetime'] = converted_time['utc_datetime']
-                        
-                        total_metric_data.append(item)
-            else:
-                print("Trying to read an incorrect filepath: ", file_struct)
-
-        print("In memory: ", sys.getsizeof(total_metric_data))
-        for item in total_metric_data:
-            print(item)
-            print()
-
-        total_metric_data = sorted(total_metric_data, key=lambda x: x['datetime'])
-
-        data_batch = defaultdict(list)
-        current_month = None
-        current_dateobj = None
-        for entry in total_metric_data:
-
-            date_obj = entry['datetime']
-            del entry['datetime']
-
-            if current_month is None:
-                current_month = date_obj.month
-                current_dateobj = date_obj
-
-            if date_obj.month == current_month:
-                data_batch[metric].append(entry)
-            else:
-                # Process the data batch for the previous month
-                parse_batch(data_batch, current_dateobj, source="fitbit")
-
-                # Start a new data batch for the current month
-                data_batch = defaultdict(list)
-                data_batch[metric].append(entry)
-                current_month = date_obj.month
-                current_dateobj = date_obj
-
-        # Process the last data batch after exiting the loop
-        if data_batch:
-            parse_batch(data_batch, date_obj, source="fitbit")
+def _tracked(pairs, file_stats: dict, filepath: str, metric: str):
+    for pair in pairs:
+        _track_file(file_stats, filepath, "fitbit", metric, pair[0])
+        yield pair
+
+def decode_fitbit_file(metric: str, file_struct: dict, timezone_str: str) -> tuple:
+    """
+    Reads and normalizes one Fitbit export file. Returns its records as
+    (utc datetime, entry) pairs in file order, and the run report of the work;
+    runs in a worker process when the metric's files are decoded in parallel.
+    """
+    with collecting() as report:
+        decoded = list(iter_fitbit_file(metric, file_struct, timezone_str))
+    return decoded, report.to_dict()
 
+def _decoded_files(executor, metric: str, file_struct_list: list, timezone_str: str, in_flight: int):
+    """
+    Decodes files on the executor and yields (file_struct, decoded, report) as
+    they complete, with at most `in_flight` files submitted or waiting to be taken.
+    """
+    pending = iter(file_struct_list)
+    running = {}
+    while True:
+        for file_struct in islice(pending, in_flight - len(running)):
+            running[executor.submit(decode_fitbit_file, metric, file_struct, timezone_str)] = file_struct
+        if not running:
+            return
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            decoded, report = future.result()
+            yield running.pop(future), decoded, report
+
+def ingest_fitbit_metric(metric: str, file_struct_list: list, executor: ProcessPoolExecutor = None,
+                         in_flight: int = None) -> dict:
+    """
+    Parses every file of one Fitbit metric and writes its month partitions.
+    The files are lazily merged in time order (O(N log k) for k files) and fed to
+    the month bucketer, so the metric is never held in memory at once. With an
+    executor the files are instead decoded in parallel by its workers, and each
+    one is bucketed as soon as it arrives; at most `in_flight` (2 per
+    FITBIT_INGEST_WORKERS by default) decoded files are held at a time.
+    Returns the metric's stats, with its run report.
+    """
+    logger.info("Fitbit metric: %s (%d files)", metric, len(file_struct_list))
+    tic = time.time()
+    timezone_str = timezone_for_source("fitbit")
+    key = f"fitbit/{metric}"
+
+    # Records go straight to their month partition; nothing is sorted globally
+    bucketer = MonthBucketer("fitbit", parse_batch)
+    file_stats = {}
+
+    with collecting() as report, memory_peak(key), stage(key, 'merge'):
+        if executor is not None and len(file_struct_list) > 1:
+            # Partitions sort their own entries, so files need not arrive in time order
+            decoded_files = _decoded_files(executor, metric, file_struct_list, timezone_str,
+                                           in_flight or 2 * FITBIT_INGEST_WORKERS)
+            for file_struct, decoded, file_report in decoded_files:
+                report.merge(file_report)
+                with stage(key, 'bucket'):
+                    for date_obj, entry in _tracked(decoded, file_stats, file_struct['filename'], metric):
+                        bucketer.add(date_obj, metric, entry)
+                decoded = None
+        else:
+            # Out-of-order records only need to reach the right partition, which sorts its entries
+            def divert(pair):
+                bucketer.add(pair[0], metric, pair[1])
+
+            runs = [_in_order(_tracked(iter_fitbit_file(metric, file_struct, timezone_str), file_stats,
+                                       file_struct['filename'], metric), divert)
+                    for file_struct in file_struct_list]
+            merged = heapq.merge(*runs, key=lambda item: item[0])
+            while True:
+                batch = list(islice(merged, INSTRUMENT_BATCH_SIZE))
+                if not batch:
+                    break
+                with stage(key, 'bucket'):
+                    for date_obj, entry in batch:
+                        bucketer.add(date_obj, metric, entry)
+            runs = merged = None
+
+        with stage(key, 'bucket'):
+            bucketer.flush()
+
+    return {
+        'metric': metric,
+        'files': len(file_struct_list),
+        'bytes': sum(os.path.getsize(file_struct['filename']) for file_struct in file_struct_list),
+        'records': bucketer.entries_added,
+        'written': bucketer.entries_written,
+        'seconds': time.time() - tic,
+        'file_stats': file_stats,
+        'report': report.to_dict(),
+    }
+
+def _init_worker(log_level: int, root: str):
+    # Spawned workers (the default on macOS) do not inherit the parent's logging setup or data root
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    use_data_root(root)
+
+def _fitbit_schedule(metrics: dict) -> list:
+    """
+    Orders metrics for the pool: FITBIT_LARGE_METRICS first, then by total file size.
+    """
+    def size(metric):
+        return sum(os.path.getsize(file_struct['filename']) for file_struct in metrics[metric])
+
+    return sorted(metrics, key=lambda metric: (metric not in FITBIT_LARGE_METRICS, -size(metric)))
+
+def parse_fitbit_data(filepaths: list, workers: int = None):
+    """
+    Function that takes a list of filepaths to Fitbit export files and generates a separate json file for each metric.
+    With workers > 1 a process pool is used two ways: metrics split into at least FITBIT_FILE_PARALLEL_MIN_FILES
+    files (the daily heart_rate, SpO2... files) are ingested first, here, with their files decoded in parallel by
+    the pool, then the other metrics are ingested whole by the pool's workers, largest first. Returns the
+    partitions and record count of each file.
+    """
+    with stage("fitbit", 'discover'):
+        metrics = discover_fitbit_files(filepaths)
+        metrics = {metric: files for metric, files in metrics.items() if metric not in FITBIT_SKIPPED_METRICS}
+        schedule = _fitbit_schedule(metrics)
+    workers = FITBIT_INGEST_WORKERS if workers is None else workers
+
+    stats = []
+    if workers <= 1:
+        for metric in schedule:
+            stats.append(ingest_fitbit_metric(metric, metrics[metric]))
+    else:
+        many_file_metrics = [metric for metric in schedule if len(metrics[metric]) >= FITBIT_FILE_PARALLEL_MIN_FILES]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(logging.getLogger().level, data_root)) as executor:
+            # The largest metrics' file tasks go first, so whole-metric tasks never queue ahead of them
+            for metric in many_file_metrics:
+                stats.append(ingest_fitbit_metric(metric, metrics[metric], executor, 2 * workers))
+            futures = [executor.submit(ingest_fitbit_metric, metric, metrics[metric])
+                       for metric in schedule if metric not in many_file_metrics]
+            for future in as_completed(futures):
+                stats.append(future.result())
+
+    for metric_stats in sorted(stats, key=lambda metric_stats: -metric_stats['seconds']):
+        logger.info("%s: %d records (%d new) from %d files in %.2fs", metric_stats['metric'], metric_stats['records'],
+                    metric_stats['written'], metric_stats['files'], metric_stats['seconds'])
+
+    file_stats = {}
+    for metric_stats in stats:
+        file_stats.update(metric_stats['file_stats'])
+        current().merge(metric_stats['report'])
+    return file_stats
+
+
+def clean_bitesnap_entry(entry: dict, timezone_str: str):
+    """
+    Replaces the time fields of a Bitesnap entry with its utc/local times and offset.
+    Returns (utc datetime, 'food', entry), or None if the entry has no eatenAtUTC.
+    """
+    if "eatenAtUTC" not in entry:
+        return None
+
+    converted_time = convert_timestamp(entry["eatenAtUTC"], timezone_str)
+    del entry["eatenAtUTC"]
+
+    if "eatenAtLocalTime" in entry:
+        del entry["eatenAtLocalTime"]
+    if "lastModifiedUTC" in entry:
+        del entry["lastModifiedUTC"]
+
+    entry[utc_time_col] = converted_time['utc_time']
+    entry[local_time_col] = converted_time['local_time']
+    entry['timezoneOffset'] = converted_time['offset']
+    return converted_time['utc_datetime'], 'food', entry
 
 def parse_bitesnap_data(filepaths: list):
 
@@ -514,79 +666,91 @@ def parse_bitesnap_data(filepaths: list):
     "eatenAtUTC": "2023-11-12T18:10:23.000Z",
     "eatenAtLocalTime": 20231112131023,
     "lastModifiedUTC": 1699813049780,
+
+    The "entries" array is streamed entry by entry, like the Tidepool exports.
+    Returns the partitions and record count of each file.
+    """
+    timezone_str = timezone_for_source("bitesnap")
+
+    def clean_batches(json_file):
+        for batch in _timed_batches(iter_json_array(json_file, key='entries'), "bitesnap"):
+            cleaned = []
+            with stage("bitesnap", 'normalize'):
+                for entry in batch:
+                    triple = clean_bitesnap_entry(entry, timezone_str)
+                    if triple is None:
+                        logger.debug("Bitesnap entry without eatenAtUTC: %s", entry)
+                        continue
+                    cleaned.append(triple)
+
+            _count_cleaned("bitesnap", batch, cleaned)
+            yield cleaned
+
+    # filepath -> {partitions, records}, for the ingestion manifest
+    file_stats = {}
+
+    bucketer = MonthBucketer("bitesnap", parse_batch)
+    with memory_peak("bitesnap"):
+        for filepath in filepaths:
+            if filepath.endswith(".json"):
+                logger.info("Bitesnap file: %s", filepath)
+                count("bitesnap", 'files')
+                count("bitesnap", 'bytes_read', os.path.getsize(filepath))
+                with open(filepath, 'r') as json_file:
+                    for cleaned in clean_batches(json_file):
+                        with stage("bitesnap", 'bucket'):
+                            for date_obj, metric_type, entry in cleaned:
+                                _track_file(file_stats, filepath, "bitesnap", metric_type, date_obj)
+                                bucketer.add(date_obj, metric_type, entry)
+        with stage("bitesnap", 'bucket'):
+            bucketer.flush()
+    return file_stats
+
+def process_data(data_folder, parser_function, reprocess: bool = False, pipelined: bool = None):
     """
+    Ingests the new exports of a source and moves them to the used folder. With
+    reprocess, the files already in the used folder are gone through instead.
+    Files the ingestion manifest has already seen unchanged are skipped.
+
+    With pipelined (PIPELINE_MODE by default) the files go through the asyncio
+    pipeline of pipeline.py instead of parser_function.
+    """
+    if pipelined is None:
+        pipelined = PIPELINE_MODE
+    if pipelined:
+        # Imported here because pipeline.py builds on this module
+        from pipeline import run_pipeline
+        parser_function = partial(run_pipeline, data_folder)
 
-    for filepath in filepaths:
-        if filepath.endswith(".json"):
-            print("current file:", filepath)
-            with open(filepath, 'r') as json_file:
-                # TODO: Address this bottleneck.. will load all of the data at once. 
-                data = json.load(json_file)['entries'] 
-                sorted_data = sorted(data, key=lambda entry: convert_timestamp(entry['eatenAtUTC'])['utc_datetime'])
-                # TODO: again bottleneck if you run into issues
-
-                data_batch = defaultdict(list)
-                current_month = None
-                current_dateobj = None
-                for entry in sorted_data:
-                    # Clean the entry's time data
-                    if "eatenAtUTC" in entry:
-                        converted_time = convert_timestamp(entry["eatenAtUTC"])
-                        del entry["eatenAtUTC"]
-
-                        if "eatenAtLocalTime" in entry:
-                            del entry["eatenAtLocalTime"]
-                        if "lastModifiedUTC" in entry:
-                            del entry["lastModifiedUTC"]
-                        
-                        entry[utc_time_col] = converted_time['utc_time']
-                        entry[local_time_col] = converted_time['local_time']
-                        entry['timezoneOffset'] = converted_time['offset']
-                        entry['datetime'] = converted_time['utc_datetime']
-
-                    metric_type = 'food'
-                    date_obj = entry['datetime']
-                    del entry['datetime']
-
-                    if current_month is None:
-                        current_month = date_obj.month
-                        current_dateobj = date_obj
-
-                    if date_obj.month == current_month:
-                        data_batch[metric_type].append(entry)
-                    else:
-                        # Process the data batch for the previous month
-                        parse_batch(data_batch, current_dateobj, source="bitesnap")
-
-                        # Start a new data batch for the current month
-                        data_batch = defaultdict(list)
-                        data_batch[metric_type].append(entry)
-                        current_month = date_obj.month
-                        current_dateobj = date_obj
-
-                # Process the last data batch after exiting the loop
-                if data_batch:
-                    parse_batch(data_batch, date_obj, source="bitesnap")
-
-def process_data(data_folder, parser_function):
     data_export_path = os.path.join(export_folder, data_folder)
     data_used_path = os.path.join(used_folder, data_folder)
-    data_files = get_filepaths(data_export_path)
-    parser_function(data_files)
-    move_folder_contents(data_export_path, data_used_path)
+    root = data_used_path if reprocess else data_export_path
+
+    with stage(data_folder, 'discover'):
+        data_files = get_filepaths(root)
+        manifest = IngestionManifest.load(cleaned_folder)
+        to_ingest, stale_partitions = manifest.plan(data_files, root, data_folder)
+    logger.info("%s: %d of %d files to ingest, %d partitions to rebuild",
+                data_folder, len(to_ingest), len(data_files), len(stale_partitions))
+
+    # Partitions written by a changed file are rebuilt from all the files that wrote to them
+    with stage(data_folder, 'write'):
+        for partition in stale_partitions:
+            remove_partition(os.path.join(cleaned_folder, partition))
+            remove_rollups(os.path.join(cleaned_folder, partition))
+
+    if to_ingest:
+        file_stats = parser_function(list(to_ingest.values()))
+        for key, filepath in to_ingest.items():
+            stats = file_stats.get(filepath, {'partitions': [], 'records': 0})
+            manifest.record(key, filepath, stats['partitions'], stats['records'])
+
+    if not reprocess:
+        manifest.relocate(move_folder_contents(data_export_path, data_used_path))
+    manifest.save()
 
 if __name__ == "__main__":
-    tic = time.time()
-    create_folders()
-
-    # For Fitbit data
-    process_data(fitbit_folder, parse_fitbit_data)
-
-    # For Tidepool data
-    process_data(tidepool_folder, parse_tidepool_data)
-
-    # For Bitesnap data
-    process_data(bitesnap_folder, parse_bitesnap_data)
-
-    toc = time.time()
-    print("time elapsed:", toc - tic)
+    # Ingests through the resumable task queue, so a run that crashes resumes where
+    # it stopped; takes the arguments of `python task_queue.py` (run by default)
+    import task_queue
+    task_queue.main()
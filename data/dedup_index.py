@@ -0,0 +1,134 @@
+"""
+Duplicate index for the cleaned month partitions.
+
+Every partition `<metric>-YYYY-M.json` (see storage.py) gets a sidecar `<metric>-YYYY-M.index`
+with one key per stored record. A key is a short hash of the record's id
+(Tidepool `id`, Bitesnap `entryID`, see DEDUP_ID_KEYS) or, for records without
+one, of the record's canonical JSON. Checking a batch is a set lookup per record,
+and new keys are appended to the sidecar, so the month file never has to be
+scanned to find duplicates.
+
+A write stores the records, then folds them into the rollups, then saves their
+keys, and a crash in between would leave records the sidecar does not know of
+(written again by the next run) or rollups that already count them. So
+`begin_write` first leaves a `<metric>-YYYY-M.pending` marker, removed by
+`save`: a partition loaded with the marker still there has its index rebuilt
+from its records, and `recovered` tells the writer to rebuild its rollups too.
+"""
+
+import hashlib
+import json
+import os
+
+from config import DEDUP_ID_KEYS
+
+
+def record_key(entry: dict) -> str:
+    """
+    Returns the dedup key of a record: its id if it has one, else a hash of its content.
+    """
+    for id_key in DEDUP_ID_KEYS:
+        if entry.get(id_key):
+            content = f"{id_key}:{entry[id_key]}"
+            break
+    else:
+        content = json.dumps(entry, sort_keys=True, separators=(',', ':'), default=str)
+
+    return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
+
+def index_path(partition_path: str) -> str:
+    return os.path.splitext(partition_path)[0] + ".index"
+
+
+def pending_path(partition_path: str) -> str:
+    return os.path.splitext(partition_path)[0] + ".pending"
+
+
+def mark_pending(partition_path: str):
+    with open(pending_path(partition_path), 'w') as marker_file:
+        marker_file.flush()
+        os.fsync(marker_file.fileno())
+
+
+def clear_pending(partition_path: str):
+    if os.path.exists(pending_path(partition_path)):
+        os.remove(pending_path(partition_path))
+
+
+class DedupIndex:
+    """
+    Set of record keys stored in one partition, persisted next to it.
+    """
+
+    def __init__(self, partition_path: str):
+        self.partition_path = partition_path
+        self.path = index_path(partition_path)
+        self.keys = set()
+        self._new_keys = []
+        self._rewrite = True
+        # The last write to the partition was interrupted; its index was rebuilt
+        self.recovered = False
+
+    @classmethod
+    def load(cls, partition_path: str):
+        """
+        Loads the index of a partition. If the sidecar is missing (partitions written
+        before the index existed) or a write was interrupted, it is rebuilt from the
+        partition's records.
+        """
+        # Imported here because storage.py builds on record_key (through sqlite_store.py)
+        from storage import partition_exists, read_records
+
+        index = cls(partition_path)
+        if not partition_exists(partition_path):
+            return index
+
+        index.recovered = os.path.exists(pending_path(partition_path))
+        if os.path.exists(index.path) and not index.recovered:
+            with open(index.path, 'r') as index_file:
+                index.keys = set(index_file.read().split())
+            index._rewrite = False
+        else:
+            index.keys = {record_key(entry) for entry in read_records(partition_path)}
+
+        return index
+
+    def filter_new(self, entries: list) -> list:
+        """
+        Returns the entries that are not in the partition yet (or earlier in the
+        same list) and adds their keys to the index.
+        """
+        new_entries = []
+        for entry in entries:
+            key = record_key(entry)
+            if key not in self.keys:
+                self.keys.add(key)
+                self._new_keys.append(key)
+                new_entries.append(entry)
+        return new_entries
+
+    def begin_write(self):
+        """
+        Marks the partition as being written; call it before storing new entries.
+        """
+        mark_pending(self.partition_path)
+
+    def save(self):
+        """
+        Appends the keys added since loading, or writes the whole index if it was
+        rebuilt, then ends the write.
+        """
+        if self._rewrite:
+            # Written aside first: a crash must not leave a truncated index without the marker
+            tmp_path = f"{self.path}.tmp-{os.getpid()}"
+            with open(tmp_path, 'w') as index_file:
+                index_file.writelines(key + "\n" for key in self.keys)
+            os.replace(tmp_path, self.path)
+        elif self._new_keys:
+            with open(self.path, 'a') as index_file:
+                index_file.writelines(key + "\n" for key in self._new_keys)
+
+        self._new_keys = []
+        self._rewrite = False
+        clear_pending(self.partition_path)
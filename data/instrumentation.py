@@ -0,0 +1,172 @@
+"""
+Per-stage timers and counters for the ingestion pipeline.
+
+A RunReport keeps, per key (a source like "tidepool" or a metric like
+"fitbit/heart_rate"):
+    - the wall time of each stage: discover, decode, normalize, bucket, dedup,
+      write, rollup... Stages nest, and entering one pauses the enclosing one,
+      so every second is charged to exactly one stage
+    - counters: files, bytes_read, records_read, records_rejected, records_in,
+      records_written, duplicates
+    - with INSTRUMENT_TRACEMALLOC, the peak of traced Python allocations while
+      the key was ingested
+
+The report being filled is module state, per thread. Work done in a worker
+process or thread is collected into a report of its own (`collecting`), returned
+as a dict with the results and merged into the parent's with `merge`.
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+from config import INSTRUMENT_TRACEMALLOC
+
+
+def _new_entry() -> dict:
+    return {'stages': defaultdict(float), 'counters': defaultdict(int), 'tracemalloc_peak_bytes': 0}
+
+
+class RunReport:
+    """
+    Stage times and counters of one run (or of one worker task).
+    """
+
+    def __init__(self):
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.entries = defaultdict(_new_entry)
+        # Open stages, innermost last: (key, stage)
+        self._stack = []
+        self._mark = None
+
+    def _charge(self, now: float):
+        if self._stack:
+            key, stage = self._stack[-1]
+            self.entries[key]['stages'][stage] += now - self._mark
+        self._mark = now
+
+    def enter(self, key: str, stage: str):
+        self._charge(time.perf_counter())
+        self._stack.append((key, stage))
+
+    def exit(self):
+        self._charge(time.perf_counter())
+        self._stack.pop()
+
+    def count(self, key: str, counter: str, n: int = 1):
+        self.entries[key]['counters'][counter] += n
+
+    def record_peak(self, key: str, peak: int):
+        entry = self.entries[key]
+        entry['tracemalloc_peak_bytes'] = max(entry['tracemalloc_peak_bytes'], peak)
+
+    def merge(self, other: dict):
+        """
+        Adds the entries of another report's to_dict() to this one.
+        """
+        for key, other_entry in other['entries'].items():
+            entry = self.entries[key]
+            for stage, seconds in other_entry['stages'].items():
+                entry['stages'][stage] += seconds
+            for counter, n in other_entry['counters'].items():
+                entry['counters'][counter] += n
+            entry['tracemalloc_peak_bytes'] = max(entry['tracemalloc_peak_bytes'], other_entry['tracemalloc_peak_bytes'])
+
+    def to_dict(self) -> dict:
+        return {
+            'started': self.started,
+            'entries': {key: {'stages': dict(entry['stages']), 'counters': dict(entry['counters']),
+                              'tracemalloc_peak_bytes': entry['tracemalloc_peak_bytes']}
+                        for key, entry in sorted(self.entries.items())},
+        }
+
+    def stage_totals(self) -> dict:
+        totals = defaultdict(float)
+        for entry in self.entries.values():
+            for stage, seconds in entry['stages'].items():
+                totals[stage] += seconds
+        return {stage: round(seconds, 4) for stage, seconds in sorted(totals.items(), key=lambda item: -item[1])}
+
+    def save(self, path: str, seconds: float = None):
+        report = self.to_dict()
+        report['seconds'] = seconds
+        report['stages'] = self.stage_totals()
+
+        # Write to a temporary file first so a crash never leaves a half-written report
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as report_file:
+            json.dump(report, report_file, indent=1)
+        os.replace(tmp_path, path)
+
+
+_report = RunReport()
+# The report of a thread inside `collecting`; other threads share _report
+_local = threading.local()
+
+
+def current() -> RunReport:
+    return getattr(_local, 'report', _report)
+
+
+class stage:
+    """
+    Times a block as `name` of `key`: `with stage("fitbit/steps", "decode"): ...`
+    """
+    __slots__ = ('key', 'name')
+
+    def __init__(self, key: str, name: str):
+        self.key = key
+        self.name = name
+
+    def __enter__(self):
+        current().enter(self.key, self.name)
+
+    def __exit__(self, *exc_info):
+        current().exit()
+
+
+def count(key: str, counter: str, n: int = 1):
+    current().entries[key]['counters'][counter] += n
+
+
+class memory_peak:
+    """
+    With INSTRUMENT_TRACEMALLOC, records the peak traced allocation of a block under `key`.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+
+    def __enter__(self):
+        if INSTRUMENT_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def __exit__(self, *exc_info):
+        if tracemalloc.is_tracing():
+            current().record_peak(self.key, tracemalloc.get_traced_memory()[1])
+
+
+class collecting:
+    """
+    Makes a fresh report current in this thread for the block (e.g. one worker
+    task), then restores the previous one: `with collecting() as report: ...; report.to_dict()`.
+    """
+
+    def __enter__(self) -> RunReport:
+        self.previous = getattr(_local, 'report', None)
+        _local.report = RunReport()
+        return _local.report
+
+    def __exit__(self, *exc_info):
+        if self.previous is None:
+            del _local.report
+        else:
+            _local.report = self.previous
+        # The block's time is in the block's report, not in the enclosing stage
+        current()._mark = time.perf_counter()
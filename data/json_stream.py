@@ -0,0 +1,113 @@
+"""
+Incremental reader for large JSON exports.
+
+iter_json_array yields the elements of a top-level JSON array (Tidepool exports)
+or of an array stored under a key of a top-level object (Bitesnap's "entries")
+one at a time. The file is read in chunks and each element is decoded with
+json.JSONDecoder.raw_decode, so memory use is bounded by the largest single
+element rather than by the size of the export.
+"""
+
+import json
+import re
+
+from config import JSON_STREAM_CHUNK_SIZE
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Reader:
+    """
+    Chunked text buffer with a read position.
+    """
+
+    def __init__(self, file_obj, chunk_size: int):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+        Reads another chunk, dropping what was already consumed. Returns False at EOF.
+        """
+        if self.eof:
+            return False
+        # Read at least as much as is buffered, so a large element is not re-decoded
+        # once per chunk
+        chunk = self.file_obj.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character ("" at EOF) without consuming it.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expected one of {chars!r}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def decode_value(self, decoder: json.JSONDecoder):
+        """
+        Decodes the next JSON value, reading more data until it is complete.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A number cut off at the end of the chunk ("1.5" of "1.5e3") decodes
+                # fine, so only accept a value once the next delimiter is buffered
+                following = _WHITESPACE.match(self.buffer, end).end()
+                if self.eof or (following < len(self.buffer) and self.buffer[following] in ",]}:"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_array(file_obj, key: str = None, chunk_size: int = JSON_STREAM_CHUNK_SIZE):
+    """
+    Yields the elements of the top-level array of a JSON file, or, if `key` is
+    given, of the array under that key of the top-level object.
+    """
+    decoder = json.JSONDecoder()
+    reader = _Reader(file_obj, chunk_size)
+
+    if key is not None:
+        # Walk the top-level object, decoding (and discarding) values until `key`
+        reader.expect("{")
+        while True:
+            if reader.peek() == "}":
+                return
+            current_key = reader.decode_value(decoder)
+            reader.expect(":")
+            if current_key == key:
+                break
+            reader.decode_value(decoder)
+            if reader.expect(",}") == "}":
+                return
+
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+
+    while True:
+        yield reader.decode_value(decoder)
+        if reader.expect(",]") == "]":
+            return
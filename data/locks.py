@@ -0,0 +1,81 @@
+"""
+Cross-process locks for cleaned partitions.
+
+Each partition `<metric>-YYYY-M.json` is guarded by a `<metric>-YYYY-M.lock` file
+next to it. Writers (parse_batch) and compaction hold the lock while they touch
+the partition and its dedup index, so parallel workers or two pipeline runs on
+the same folder never interleave writes to one month. Readers hold it shared, so
+they never list a partition's files while compaction swaps them.
+
+Locks are reentrant within a thread: a block that already holds a partition's
+lock (in either mode) can call code that takes it again.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import LOCK_POLL_INTERVAL
+
+# Lock paths this thread holds, keyed with the pid so a forked worker does not
+# inherit its parent's
+_held = threading.local()
+
+
+def lock_path(partition_path: str) -> str:
+    return os.path.splitext(partition_path)[0] + ".lock"
+
+
+@contextmanager
+def partition_lock(partition_path: str, shared: bool = False):
+    """
+    Holds a lock on a partition for the duration of the block: exclusive, or
+    shared with other readers.
+    """
+    path = lock_path(partition_path)
+    held = getattr(_held, 'paths', None)
+    if held is None:
+        held = _held.paths = set()
+    key = (os.getpid(), path)
+    if key in held:
+        yield
+        return
+
+    held.add(key)
+    try:
+        with _acquire(path, shared):
+            yield
+    finally:
+        held.discard(key)
+
+
+@contextmanager
+def _acquire(path: str, shared: bool):
+    if fcntl is not None:
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+
+    # No flock (Windows): the lock is the existence of the file itself, and
+    # readers take it exclusively too
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
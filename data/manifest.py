@@ -0,0 +1,136 @@
+"""
+Ingestion manifest: which export files were ingested, and what they produced.
+
+`cleaned_data/ingest_manifest.json` has one entry per ingested file, keyed by its
+path relative to the source's export folder (e.g. "fitbit/Takeout/Fitbit/...").
+An entry records where the file is now, its size, mtime and content hash, the
+cleaned partitions it wrote to and its record count.
+
+Before a run, files whose size and mtime (or failing that, content hash) match
+their entry are skipped. A changed file invalidates the partitions it wrote to:
+they are dropped and rebuilt from the changed file plus every other file that
+wrote to them. Changing CLEANING_VERSION invalidates every entry. Losing
+cleaned_data loses the manifest too, so everything is ingested again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from config import CLEANING_VERSION, INGEST_MANIFEST_FILENAME
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(filepath: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IngestionManifest:
+    """
+    Persistent record of the ingested export files of one cleaned data folder.
+    """
+
+    def __init__(self, path: str, files: dict = None, cleaning_version: int = CLEANING_VERSION):
+        self.path = path
+        # key -> {path, size, mtime, hash, partitions, records}
+        self.files = files if files is not None else {}
+        self.cleaning_version = cleaning_version
+
+    @classmethod
+    def load(cls, cleaned_folder_path: str):
+        path = os.path.join(cleaned_folder_path, INGEST_MANIFEST_FILENAME)
+        if not os.path.exists(path):
+            return cls(path)
+
+        with open(path, 'r') as manifest_file:
+            data = json.load(manifest_file)
+        return cls(path, data.get('files', {}), data.get('cleaning_version'))
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written manifest
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump({'cleaning_version': CLEANING_VERSION, 'files': self.files}, manifest_file, indent=1)
+        os.replace(tmp_path, self.path)
+        self.cleaning_version = CLEANING_VERSION
+
+    def is_unchanged(self, key: str, filepath: str) -> bool:
+        """
+        Checks a file against its entry. The content is only hashed when the size
+        or mtime differ; if the hash still matches, the entry is refreshed.
+        """
+        entry = self.files.get(key)
+        if entry is None or self.cleaning_version != CLEANING_VERSION:
+            return False
+
+        stat = os.stat(filepath)
+        if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            return True
+        if stat.st_size == entry['size'] and file_hash(filepath) == entry['hash']:
+            entry.update(path=filepath, mtime=stat.st_mtime)
+            return True
+        return False
+
+    def record(self, key: str, filepath: str, partitions, records: int):
+        stat = os.stat(filepath)
+        self.files[key] = {
+            'path': filepath,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': file_hash(filepath),
+            'partitions': sorted(partitions),
+            'records': records,
+        }
+
+    def plan(self, filepaths: list, root: str, source: str):
+        """
+        Decides what a run over `filepaths`, found under `root` (the source's export
+        or used folder), has to do. Returns the files to ingest (key -> path) and
+        the partitions to drop before ingesting them.
+        """
+        to_ingest = {}
+        stale_partitions = set()
+        if self.cleaning_version != CLEANING_VERSION:
+            for entry in self.files.values():
+                stale_partitions.update(entry['partitions'])
+
+        # A file already in the manifest is found by its current path, so files
+        # renamed by move_folder_contents keep their key
+        keys_by_path = {entry['path']: key for key, entry in self.files.items()}
+
+        for filepath in filepaths:
+            key = keys_by_path.get(filepath) or os.path.join(source, os.path.relpath(filepath, root))
+            if self.is_unchanged(key, filepath):
+                continue
+            to_ingest[key] = filepath
+            if key in self.files:
+                stale_partitions.update(self.files[key]['partitions'])
+
+        # Files that wrote to a dropped partition have to be ingested again
+        for key, entry in list(self.files.items()):
+            if key in to_ingest or not stale_partitions.intersection(entry['partitions']):
+                continue
+            if os.path.exists(entry['path']):
+                to_ingest[key] = entry['path']
+            else:
+                logger.warning("Missing %s; its records are dropped from %s", entry['path'], entry['partitions'])
+                del self.files[key]
+
+        return to_ingest, stale_partitions
+
+    def relocate(self, moves: list):
+        """
+        Updates file paths after move_folder_contents; `moves` are the (source,
+        destination) pairs it moved, files or whole folders.
+        """
+        for entry in self.files.values():
+            for source_path, destination_path in moves:
+                if entry['path'] == source_path or entry['path'].startswith(source_path + os.sep):
+                    entry['path'] = destination_path + entry['path'][len(source_path):]
+                    break
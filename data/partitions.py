@@ -0,0 +1,247 @@
+"""
+Append-only storage for the cleaned month partitions.
+
+A partition `<metric>-YYYY-M.json` is made of:
+    - the compacted base file `<metric>-YYYY-M.json`, a JSON array written one
+      record per line, and
+    - any number of segments `<metric>-YYYY-M.seg-<id>.ndjson`, each a sorted run
+      of records added by one write.
+
+Writers only ever add segments. Readers merge the base file and the segments on
+the fly, so they see every record without waiting for compaction. Compaction
+(python storage.py, or the background thread in storage.py) folds the segments
+back into the base file under the partition lock, which readers hold shared
+(see storage.read_records), so a reader never sees the new base file together
+with the segments it replaces.
+
+Every file written here also gets a sparse time index `<file>.tidx`: the UTC
+epoch and byte offset of every SPARSE_INDEX_INTERVAL-th record. Range reads seek
+straight to the first block that can hold the range instead of decoding the
+whole file.
+"""
+
+import calendar
+import glob
+import heapq
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from config import SPARSE_INDEX_INTERVAL
+from timestamps import get_utc_epoch
+
+SEGMENT_SUFFIX = ".ndjson"
+TIME_INDEX_SUFFIX = ".tidx"
+
+# Matches base files and segments of every storage format (see storage.py)
+_PARTITION_PATTERN = re.compile(r'^(.*)-(\d{4})-(\d{1,2})(?:\.seg-[^.]+)?\.(?:json|ndjson|npz|parquet|npy)$')
+
+
+def segment_paths(partition_path: str, suffix: str = SEGMENT_SUFFIX) -> list:
+    """
+    Returns the segment files of a partition.
+    """
+    base_name = os.path.splitext(partition_path)[0]
+    return sorted(glob.glob(glob.escape(base_name) + ".seg-*" + suffix))
+
+
+def partition_exists(partition_path: str) -> bool:
+    return os.path.exists(partition_path) or bool(segment_paths(partition_path))
+
+
+def list_partitions(metric_folder: str) -> list:
+    """
+    Returns the partition paths (`<metric>-YYYY-M.json`) in a metric folder, in
+    calendar order, including partitions that so far only have segments.
+    """
+    partitions = {}
+    for filename in os.listdir(metric_folder):
+        match = _PARTITION_PATTERN.match(filename)
+        if match:
+            metric, year, month = match.groups()
+            partition_name = f"{metric}-{year}-{month}.json"
+            partitions[(int(year), int(month))] = os.path.join(metric_folder, partition_name)
+
+    return [partitions[key] for key in sorted(partitions)]
+
+
+def partition_bounds(partition_path: str) -> tuple:
+    """
+    Returns the UTC epochs [start, end) of a partition's month.
+    """
+    year, month = (int(group) for group in _PARTITION_PATTERN.match(os.path.basename(partition_path)).groups()[1:])
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return calendar.timegm((year, month, 1, 0, 0, 0)), calendar.timegm((next_year, next_month, 1, 0, 0, 0))
+
+
+def time_index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + TIME_INDEX_SUFFIX
+
+
+def time_index_files(partition_path: str) -> list:
+    """
+    Returns the sparse time indexes of a partition's base file and segments.
+    """
+    base_index = time_index_path(partition_path)
+    return ([base_index] if os.path.exists(base_index) else []) + segment_paths(partition_path, TIME_INDEX_SUFFIX)
+
+
+def _write_atomic(path: str, lines, epochs: list = None, header_lines: int = 0):
+    """
+    Writes lines to path. With `epochs` (the UTC epoch of each record line, after
+    `header_lines` non-record lines) the file's sparse time index is written too.
+    """
+    # Write to a temporary file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    index = []
+    with open(tmp_path, 'wb') as out_file:
+        for i, line in enumerate(lines):
+            record = i - header_lines
+            if epochs is not None and 0 <= record < len(epochs) and record % SPARSE_INDEX_INTERVAL == 0:
+                index.append((epochs[record], out_file.tell()))
+            out_file.write(line.encode())
+        size = out_file.tell()
+
+    if epochs is not None:
+        # The first row holds the data file's size, so an index left over from an
+        # older version of the file is recognized and ignored
+        index_tmp_path = f"{time_index_path(path)}.tmp-{os.getpid()}"
+        with open(index_tmp_path, 'wb') as index_file:
+            np.save(index_file, np.array([(size, SPARSE_INDEX_INTERVAL)] + index, dtype=np.int64).reshape(-1, 2))
+        os.replace(index_tmp_path, time_index_path(path))
+    os.replace(tmp_path, path)
+
+
+def _load_time_index(path: str):
+    """
+    Returns the (epochs, offsets) of a file's sparse time index, or None if it has
+    none or the index does not match the file.
+    """
+    index_path = time_index_path(path)
+    if not os.path.exists(index_path):
+        return None
+    index = np.load(index_path)
+    if index[0, 0] != os.path.getsize(path):
+        return None
+    return index[1:, 0], index[1:, 1]
+
+
+def _one_record_per_line(path: str) -> bool:
+    # Segments always are; base files are when written by compaction, which opens them with a lone "["
+    if path.endswith(SEGMENT_SUFFIX):
+        return True
+    with open(path, 'rb') as in_file:
+        return in_file.readline().strip() == b"["
+
+
+def _read_range(path: str, start: int = None, end: int = None):
+    """
+    Yields the records of one sorted base or segment file with start <= utc epoch < end.
+    Base files written before segments existed (a single json.dump line, no time
+    index) are loaded whole and filtered.
+    """
+    index = _load_time_index(path)
+    if index is None and not _one_record_per_line(path):
+        with open(path, 'r') as json_file:
+            entries = json.load(json_file)
+        epochs = [get_utc_epoch(entry) for entry in entries]
+        for i in sorted(range(len(entries)), key=epochs.__getitem__):
+            if (start is None or epochs[i] >= start) and (end is None or epochs[i] < end):
+                yield entries[i]
+        return
+
+    offset = 0
+    if index is not None and start is not None:
+        epochs, offsets = index
+        # The last block starting before `start` may still hold records at `start`
+        block = np.searchsorted(epochs, start, side='left') - 1
+        offset = int(offsets[block]) if block >= 0 else 0
+
+    with open(path, 'rb') as in_file:
+        in_file.seek(offset)
+        for line in in_file:
+            line = line.strip().rstrip(b',')
+            if line in (b"", b"[", b"]"):
+                continue
+            entry = json.loads(line)
+            epoch = get_utc_epoch(entry)
+            if start is not None and epoch < start:
+                continue
+            if end is not None and epoch >= end:
+                break
+            yield entry
+
+
+def append_segment(partition_path: str, entries: list) -> str:
+    """
+    Writes entries (in any order) as a new sorted segment of the partition.
+    """
+    epochs = [get_utc_epoch(entry) for entry in entries]
+    order = sorted(range(len(entries)), key=epochs.__getitem__)
+    segment_id = f"{time.time_ns()}-{os.getpid()}"
+    segment_path = os.path.splitext(partition_path)[0] + f".seg-{segment_id}{SEGMENT_SUFFIX}"
+
+    _write_atomic(segment_path, (json.dumps(entries[i]) + "\n" for i in order), [epochs[i] for i in order])
+    return segment_path
+
+
+def _read_segment(segment_path: str) -> list:
+    with open(segment_path, 'r') as segment_file:
+        return [json.loads(line) for line in segment_file if line.strip()]
+
+
+def read_partition(partition_path: str, segments: list = None) -> list:
+    """
+    Returns every record of a partition, sorted by UTC time: the base file merged
+    with its segments.
+    """
+    if segments is None:
+        segments = segment_paths(partition_path)
+
+    runs = []
+    if os.path.exists(partition_path):
+        with open(partition_path, 'r') as json_file:
+            runs.append(json.load(json_file))
+    for segment_path in segments:
+        runs.append(_read_segment(segment_path))
+
+    if len(runs) == 1:
+        return runs[0]
+    return list(heapq.merge(*runs, key=get_utc_epoch))
+
+
+def read_partition_range(partition_path: str, start: int = None, end: int = None) -> list:
+    """
+    Returns the records of a partition with start <= utc epoch < end, sorted by
+    UTC time, using the files' sparse time indexes to skip to the range.
+    """
+    files = ([partition_path] if os.path.exists(partition_path) else []) + segment_paths(partition_path)
+    runs = [_read_range(path, start, end) for path in files]
+    if len(runs) == 1:
+        return list(runs[0])
+    return list(heapq.merge(*runs, key=get_utc_epoch))
+
+
+def compact_partition(partition_path: str) -> bool:
+    """
+    Merges a partition's segments into its base file and removes them. Segments
+    added while compacting are left for the next run.
+    """
+    segments = segment_paths(partition_path)
+    if not segments:
+        return False
+
+    entries = read_partition(partition_path, segments)
+    lines = ["[\n"]
+    lines.extend(json.dumps(entry) + (",\n" if i < len(entries) - 1 else "\n") for i, entry in enumerate(entries))
+    lines.append("]\n")
+    _write_atomic(partition_path, lines, [get_utc_epoch(entry) for entry in entries], header_lines=1)
+
+    for segment_path in segments:
+        os.remove(segment_path)
+        if os.path.exists(time_index_path(segment_path)):
+            os.remove(time_index_path(segment_path))
+    return True
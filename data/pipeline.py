@@ -0,0 +1,264 @@
+"""
+Pipelined ingestion, an alternative driver behind data_parser.process_data.
+
+The parsers read, decode, normalize and write one after another, so the disk
+sits idle while timestamps are parsed and the other way around. Here the stages
+run at the same time on an asyncio event loop, connected by bounded queues:
+
+    read -> normalize (xN) -> bucket -> write (xPIPELINE_WRITERS)
+
+    - read: a thread streams the export files and cuts their raw records into
+      batches of PIPELINE_BATCH_SIZE
+    - normalize: PIPELINE_NORMALIZE_WORKERS processes clean the batches, with
+      the same functions as the parsers
+    - bucket: routes the cleaned records to their month partition. A partition
+      buffer goes to the writers as soon as it holds PIPELINE_BATCH_SIZE
+      entries, and the largest ones do whenever more than a queue's worth
+      (PIPELINE_QUEUE_SIZE batches) is buffered; the rest once every file is read
+    - write: threads running parse_batch; the partition locks keep two writers
+      off the same month
+
+A stage whose output queue is full waits (counted as backpressure_waits), so at
+most PIPELINE_QUEUE_SIZE batches are queued between two stages and memory stays
+bounded whatever the size of the export, while throughput tends to that of the
+slowest stage. The records written are the same as with the parsers, in more
+segments per partition.
+
+    process_data(tidepool_folder, parse_tidepool_data, pipelined=True)
+"""
+
+import asyncio
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import data_parser
+from bucketing import MonthBucketer
+from config import (FITBIT_SKIPPED_METRICS, PIPELINE_BATCH_SIZE, PIPELINE_NORMALIZE_WORKERS, PIPELINE_QUEUE_SIZE,
+                    PIPELINE_WRITERS)
+from constants import FITBIT_FOLDER, TIDEPOOL_FOLDER
+from instrumentation import collecting, count, current, memory_peak, stage
+from json_stream import iter_json_array
+from timestamp_schemas import sample_records, timestamp_columns
+from timestamps import TimestampParser
+from tz_offsets import timezone_for_source
+
+logger = logging.getLogger(__name__)
+
+# End of a queue's input
+_DONE = None
+
+
+def _export_files(source: str, filepaths: list) -> list:
+    """
+    Returns (filepath, metric, extension) for every export file the source's parser
+    would read. The metric of Tidepool and Bitesnap files is None: it comes from the records.
+    """
+    if source == FITBIT_FOLDER:
+        metrics = data_parser.discover_fitbit_files(filepaths)
+        return [(file_struct['filename'], metric, file_struct['extension'])
+                for metric, file_structs in metrics.items() if metric not in FITBIT_SKIPPED_METRICS
+                for file_struct in file_structs]
+    return [(filepath, None, ".json") for filepath in filepaths if filepath.endswith(".json")]
+
+
+def _open_records(source: str, metric: str, extension: str, export_file) -> tuple:
+    """
+    Returns an iterator over the raw records of an export file and, for Fitbit,
+    its timestamp column -> format (see timestamp_schemas.py).
+    """
+    if source != FITBIT_FOLDER:
+        return iter_json_array(export_file, key=None if source == TIDEPOOL_FOLDER else 'entries'), None
+
+    records = csv.DictReader(export_file) if extension == ".csv" else iter_json_array(export_file)
+    sample, records = sample_records(records)
+    return records, timestamp_columns(metric, sample)
+
+
+def read_batch(records, key: str) -> tuple:
+    """
+    Takes the next PIPELINE_BATCH_SIZE raw records. Returns them and the run report.
+    """
+    with collecting() as report, stage(key, 'decode'):
+        batch = list(islice(records, PIPELINE_BATCH_SIZE))
+    return batch, report.to_dict()
+
+
+def normalize_batch(source: str, metric: str, formats: dict, records: list, timezone_str: str) -> tuple:
+    """
+    Cleans a batch of raw records like the parsers do. Returns the (utc datetime,
+    metric, entry) of the valid ones and the run report; runs in a worker process.
+    """
+    cleaned = []
+    with collecting() as report:
+        if source == FITBIT_FOLDER:
+            key = f"{source}/{metric}"
+            with stage(key, 'normalize'):
+                parsers = {column: TimestampParser(format_str) for column, format_str in formats.items()}
+                for record in records:
+                    entry = data_parser._normalize_fitbit_record(record, parsers, timezone_str)
+                    if 'datetime' in entry:
+                        cleaned.append((entry.pop('datetime'), metric, entry))
+            count(key, 'records_read', len(records))
+            count(key, 'records_rejected', len(records) - len(cleaned))
+        else:
+            clean_entry = data_parser.clean_tidepool_entry if source == TIDEPOOL_FOLDER else data_parser.clean_bitesnap_entry
+            with stage(source, 'normalize'):
+                for entry in records:
+                    triple = clean_entry(entry, timezone_str)
+                    if triple is not None:
+                        cleaned.append(triple)
+            data_parser._count_cleaned(source, records, cleaned)
+    return cleaned, report.to_dict()
+
+
+def write_chunk(source: str, metric: str, dateobj, entries: list) -> tuple:
+    """
+    Writes entries of one month partition with parse_batch. Returns the number
+    written and the run report; runs in a writer thread.
+    """
+    with collecting() as report:
+        written = data_parser.parse_batch({metric: entries}, dateobj, source)
+    return written, report.to_dict()
+
+
+class _Pipeline:
+    """
+    The stages of one run and the queues between them. Coroutines never await
+    inside a `stage` block, so the run report's stage stack stays consistent.
+    """
+
+    def __init__(self, source: str, files: list, cpu_executor, normalizers: int, writers: int):
+        self.source = source
+        self.files = files
+        self.cpu_executor = cpu_executor
+        self.normalizers = normalizers
+        self.writers = writers
+        self.timezone_str = timezone_for_source(source)
+
+        self.bucketer = MonthBucketer(source, data_parser.parse_batch)
+        # filepath -> {partitions, records}, for the ingestion manifest
+        self.file_stats = {}
+        self.entries_written = 0
+
+    async def _put(self, queue: asyncio.Queue, item):
+        if queue.full():
+            count(self.source, 'backpressure_waits')
+        await queue.put(item)
+
+    async def _read(self):
+        for filepath, metric, extension in self.files:
+            key = self.source if metric is None else f"{self.source}/{metric}"
+            logger.debug("%s file: %s", self.source, filepath)
+            count(key, 'files')
+            count(key, 'bytes_read', os.path.getsize(filepath))
+
+            with open(filepath, 'r') as export_file:
+                records, formats = await self.loop.run_in_executor(self.read_executor, _open_records, self.source,
+                                                                   metric, extension, export_file)
+                while True:
+                    batch, report = await self.loop.run_in_executor(self.read_executor, read_batch, records, key)
+                    current().merge(report)
+                    if not batch:
+                        break
+                    await self._put(self.raw, (filepath, metric, formats, batch))
+
+        for _ in range(self.normalizers):
+            await self.raw.put(_DONE)
+
+    async def _normalize(self):
+        while True:
+            item = await self.raw.get()
+            if item is _DONE:
+                break
+            filepath, metric, formats, records = item
+            cleaned, report = await self.loop.run_in_executor(self.cpu_executor, normalize_batch, self.source, metric,
+                                                              formats, records, self.timezone_str)
+            current().merge(report)
+            await self._put(self.cleaned, (filepath, cleaned))
+        await self.cleaned.put(_DONE)
+
+    async def _bucket(self):
+        remaining = self.normalizers
+        while remaining:
+            item = await self.cleaned.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            filepath, cleaned = item
+            with stage(self.source, 'bucket'):
+                for date_obj, metric, entry in cleaned:
+                    data_parser._track_file(self.file_stats, filepath, self.source, metric, date_obj)
+                    self.bucketer.add(date_obj, metric, entry)
+                chunks = self.bucketer.take_full(PIPELINE_BATCH_SIZE, PIPELINE_QUEUE_SIZE * PIPELINE_BATCH_SIZE)
+            for chunk in chunks:
+                await self._put(self.writes, chunk)
+
+        # Every record is in: whatever is still buffered or spilled goes out in calendar order
+        drain = self.bucketer.drain()
+        while True:
+            with stage(self.source, 'bucket'):
+                chunk = next(drain, None)
+            if chunk is None:
+                break
+            await self._put(self.writes, chunk)
+
+        for _ in range(self.writers):
+            await self.writes.put(_DONE)
+
+    async def _write(self):
+        while True:
+            item = await self.writes.get()
+            if item is _DONE:
+                break
+            metric, dateobj, entries = item
+            written, report = await self.loop.run_in_executor(self.write_executor, write_chunk, self.source, metric,
+                                                              dateobj, entries)
+            current().merge(report)
+            self.entries_written += written
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.raw = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.cleaned = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.writes = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+
+        with ThreadPoolExecutor(max_workers=1) as self.read_executor, \
+                ThreadPoolExecutor(max_workers=self.writers) as self.write_executor:
+            await asyncio.gather(
+                self._read(),
+                *(self._normalize() for _ in range(self.normalizers)),
+                self._bucket(),
+                *(self._write() for _ in range(self.writers)),
+            )
+
+
+def run_pipeline(source: str, filepaths: list, normalize_workers: int = PIPELINE_NORMALIZE_WORKERS,
+                 writers: int = PIPELINE_WRITERS) -> dict:
+    """
+    Ingests the export files of a source (tidepool, fitbit or bitesnap) through
+    the pipeline. Returns the partitions and record count of each file, like the parsers.
+    """
+    tic = time.perf_counter()
+    with stage(source, 'discover'):
+        files = _export_files(source, filepaths)
+
+    if normalize_workers > 0:
+        cpu_executor = ProcessPoolExecutor(max_workers=normalize_workers, initializer=data_parser._init_worker,
+                                           initargs=(logging.getLogger().level, data_parser.data_root))
+    else:
+        cpu_executor = ThreadPoolExecutor(max_workers=1)
+    pipeline = _Pipeline(source, files, cpu_executor, max(normalize_workers, 1), writers)
+
+    try:
+        with memory_peak(source):
+            asyncio.run(pipeline.run())
+    finally:
+        cpu_executor.shutdown(cancel_futures=True)
+
+    logger.info("%s: %d records (%d new) from %d files in %.2fs (pipelined)", source, pipeline.bucketer.entries_added,
+                pipeline.entries_written, len(files), time.perf_counter() - tic)
+    return pipeline.file_stats
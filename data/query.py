@@ -0,0 +1,70 @@
+"""
+Time-range queries over the cleaned data.
+
+load_metric only opens the month partitions that overlap the range asked for,
+and within them only reads the rows in the range: packed and columnar partitions
+are sliced with a binary search on their sorted times, JSON partitions seek to
+the range through their sparse time index (see partitions.py) and SQLite ones
+scan their utc_Time index.
+"""
+
+import calendar
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from constants import CLEANED_FOLDER
+from partitions import partition_bounds
+from storage import list_partitions, read_columns
+
+
+def as_epoch(value) -> int:
+    # Naive datetimes are taken as UTC, like the utc_Time of cleaned records
+    if value is None or isinstance(value, (int, np.integer)):
+        return value
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return int(pd.Timestamp(value).timestamp())
+
+
+def overlapping_partitions(metric_folder: str, start: int = None, end: int = None) -> list:
+    """
+    Returns the partitions of a metric folder whose month overlaps [start, end).
+    """
+    partitions = []
+    for partition_path in list_partitions(metric_folder):
+        month_start, month_end = partition_bounds(partition_path)
+        if (start is None or month_end > start) and (end is None or month_start < end):
+            partitions.append(partition_path)
+    return partitions
+
+
+def load_metric(source: str, metric: str, start=None, end=None, columns: list = None,
+                cleaned_folder_path: str = CLEANED_FOLDER, as_frame: bool = True):
+    """
+    Returns the records of a metric with start <= utc time < end, sorted by time.
+    `start` and `end` are epoch seconds or datetimes (naive ones are UTC).
+
+    The result has utc_Time (int64 epoch seconds), timezoneOffset (minutes) and
+    `columns` (all of the metric's columns if None), as a DataFrame or, with
+    as_frame=False, as a dict of numpy arrays.
+    """
+    start, end = as_epoch(start), as_epoch(end)
+    wanted = None if columns is None else list(dict.fromkeys(['utc_Time', 'timezoneOffset', *columns]))
+
+    metric_folder = os.path.join(cleaned_folder_path, source, metric)
+    parts = [read_columns(partition_path, metric, wanted, start, end)
+             for partition_path in overlapping_partitions(metric_folder, start, end)]
+    parts = [part for part in parts if len(part.get('utc_Time', ()))]
+
+    if not parts:
+        names = wanted or ['utc_Time', 'timezoneOffset']
+        bundle = {name: np.array([], dtype=np.int64 if name == 'utc_Time' else object) for name in names}
+    else:
+        # Partitions are months, so their rows are already in time order
+        names = [name for name in parts[0] if all(name in part for part in parts)]
+        bundle = {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+    return pd.DataFrame(bundle) if as_frame else bundle
@@ -0,0 +1,213 @@
+"""
+Pre-aggregated rollup tiers for dense metrics (ROLLUP_METRICS).
+
+For every partition of such a metric, `<metric>-YYYY-M.rollup.npz` holds one
+tier per resolution in ROLLUP_RESOLUTIONS (1 min, 5 min, 1 hour, 1 day). A tier
+is a set of columns: bucket start, count, sum, min, max and sum of squares of the
+metric's value. Intraday buckets are aligned in UTC; daily buckets are local
+days, like the analyses in data_analysis.py.
+
+These aggregates merge by simple addition/min/max, so parse_batch folds each
+batch of new (already deduplicated) entries into the partition's tiers without
+touching the records already stored. Queries use the coarsest tier that answers
+them, and further aggregate it if the resolution asked for is coarser still.
+"""
+
+import os
+
+import numpy as np
+
+from config import ROLLUP_METRICS, ROLLUP_RESOLUTIONS
+from columnar import records_to_columns
+from storage import list_partitions, read_columns
+
+ROLLUP_SUFFIX = ".rollup.npz"
+DAY_SECONDS = 86400
+FIELDS = ('count', 'sum', 'min', 'max', 'sumsq')
+
+
+def has_rollups(metric: str) -> bool:
+    return metric in ROLLUP_METRICS
+
+
+def rollup_path(partition_path: str) -> str:
+    return os.path.splitext(partition_path)[0] + ROLLUP_SUFFIX
+
+
+def _as_float(values) -> np.ndarray:
+    values = np.asarray(values)
+    if values.dtype != object and values.dtype.kind != 'U':
+        return values.astype(np.float64)
+
+    floats = np.full(len(values), np.nan)
+    for i, value in enumerate(values.tolist()):
+        try:
+            floats[i] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return floats
+
+
+def _aggregate(start, count, total, minimum, maximum, sumsq) -> dict:
+    """
+    Merges rows with the same bucket start.
+    """
+    order = np.argsort(start, kind='stable')
+    start = start[order]
+    first = np.flatnonzero(np.r_[True, start[1:] != start[:-1]]) if len(start) else np.array([], dtype=np.intp)
+    if len(first) == len(start):
+        return {'start': start, 'count': count[order], 'sum': total[order],
+                'min': minimum[order], 'max': maximum[order], 'sumsq': sumsq[order]}
+
+    return {
+        'start': start[first],
+        'count': np.add.reduceat(count[order], first),
+        'sum': np.add.reduceat(total[order], first),
+        'min': np.minimum.reduceat(minimum[order], first),
+        'max': np.maximum.reduceat(maximum[order], first),
+        'sumsq': np.add.reduceat(sumsq[order], first),
+    }
+
+
+def _bucket_starts(utc_epochs, offsets, resolution: int) -> np.ndarray:
+    if resolution % DAY_SECONDS == 0:
+        # Daily (and coarser) buckets follow the local calendar
+        local_epochs = utc_epochs + offsets.astype(np.int64) * 60
+        return local_epochs // resolution * resolution
+    return utc_epochs // resolution * resolution
+
+
+def compute_tiers(columns: dict, field: str, resolutions: list = ROLLUP_RESOLUTIONS) -> dict:
+    """
+    Returns resolution -> tier for a columns dict with utc_Time, timezoneOffset and `field`.
+    """
+    values = _as_float(columns[field])
+    valid = ~np.isnan(values)
+    utc_epochs = np.asarray(columns['utc_Time'], dtype=np.int64)[valid]
+    offsets = np.asarray(columns['timezoneOffset'])[valid]
+    values = values[valid]
+
+    tiers = {}
+    for resolution in resolutions:
+        tiers[resolution] = _aggregate(_bucket_starts(utc_epochs, offsets, resolution),
+                                       np.ones(len(values), dtype=np.int64), values, values, values, values * values)
+    return tiers
+
+
+def merge_tiers(old: dict, new: dict) -> dict:
+    merged = {}
+    for resolution in set(old) | set(new):
+        if resolution not in old or resolution not in new:
+            merged[resolution] = old.get(resolution) or new[resolution]
+            continue
+        merged[resolution] = _aggregate(*(np.concatenate([old[resolution][name], new[resolution][name]])
+                                          for name in ('start',) + FIELDS))
+    return merged
+
+
+def read_tiers(partition_path: str) -> dict:
+    path = rollup_path(partition_path)
+    if not os.path.exists(path):
+        return {}
+
+    tiers = {}
+    with np.load(path) as rollup_file:
+        for name in rollup_file.files:
+            resolution, column = name.split("_", 1)
+            tiers.setdefault(int(resolution), {})[column] = rollup_file[name]
+    return tiers
+
+
+def _write_tiers(partition_path: str, tiers: dict):
+    path = rollup_path(partition_path)
+    # Write to a temporary file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as out_file:
+        np.savez(out_file, **{f"{resolution}_{name}": array
+                              for resolution, tier in tiers.items() for name, array in tier.items()})
+    os.replace(tmp_path, path)
+
+
+def rebuild_rollups(partition_path: str, metric: str):
+    """
+    Recomputes a partition's tiers from all of its records.
+    """
+    field = ROLLUP_METRICS[metric]
+    columns = read_columns(partition_path, metric, ['utc_Time', 'timezoneOffset', field])
+    if not len(columns.get('utc_Time', ())):
+        return
+    _write_tiers(partition_path, compute_tiers(columns, field))
+
+
+def update_rollups(partition_path: str, metric: str, new_entries: list):
+    """
+    Folds entries just appended to a partition into its tiers. Call it while
+    holding the partition's lock, after the entries are stored.
+    """
+    if not has_rollups(metric) or not new_entries:
+        return
+    if not os.path.exists(rollup_path(partition_path)):
+        # First rollup of the partition: build it from everything stored, new entries included
+        rebuild_rollups(partition_path, metric)
+        return
+
+    field = ROLLUP_METRICS[metric]
+    columns = records_to_columns(new_entries, {field: 'object'})
+    _write_tiers(partition_path, merge_tiers(read_tiers(partition_path), compute_tiers(columns, field)))
+
+
+def remove_rollups(partition_path: str):
+    if os.path.exists(rollup_path(partition_path)):
+        os.remove(rollup_path(partition_path))
+
+
+def pick_resolution(resolution: int, available=ROLLUP_RESOLUTIONS) -> int:
+    """
+    Returns the coarsest stored resolution that a `resolution` query can be built from.
+    """
+    candidates = [stored for stored in available if resolution % stored == 0
+                  and (stored % DAY_SECONDS == 0) == (resolution % DAY_SECONDS == 0)]
+    if not candidates:
+        raise ValueError(f"No rollup tier divides {resolution}s")
+    return max(candidates)
+
+
+def load_rollups(metric_folder: str, resolution: int, start: int = None, end: int = None) -> dict:
+    """
+    Returns the tier of a metric at `resolution` seconds over all its partitions,
+    restricted to buckets starting in [start, end) (epoch seconds; local for daily
+    resolutions). Adds 'mean' and 'std' columns.
+    """
+    stored = pick_resolution(resolution)
+    parts = [read_tiers(partition_path).get(stored) for partition_path in list_partitions(metric_folder)]
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        empty = {name: np.array([], dtype=np.int64) for name in ('start', 'count')}
+        return {**empty, **{name: np.array([]) for name in FIELDS[1:] + ('mean', 'std')}}
+
+    columns = [np.concatenate([part[name] for part in parts]) for name in ('start',) + FIELDS]
+    columns[0] = columns[0] // resolution * resolution
+    tier = _aggregate(*columns)
+
+    keep = np.ones(len(tier['start']), dtype=bool)
+    if start is not None:
+        keep &= tier['start'] >= start
+    if end is not None:
+        keep &= tier['start'] < end
+    tier = {name: array[keep] for name, array in tier.items()}
+
+    tier['mean'] = tier['sum'] / tier['count']
+    tier['std'] = np.sqrt(np.maximum(tier['sumsq'] / tier['count'] - tier['mean'] ** 2, 0))
+    return tier
+
+
+if __name__ == "__main__":
+    from constants import CLEANED_FOLDER
+
+    # Builds the tiers of partitions ingested before rollups existed
+    for root, dirs, files in os.walk(CLEANED_FOLDER):
+        metric = os.path.basename(root)
+        if has_rollups(metric):
+            for partition_path in list_partitions(root):
+                rebuild_rollups(partition_path, metric)
+                print("Rolled up", partition_path)
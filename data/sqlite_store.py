@@ -0,0 +1,294 @@
+"""
+SQLite storage for the cleaned partitions (CLEANED_STORAGE = "sqlite").
+
+Records are kept in `cleaned_data/cleaned.sqlite`, one table per source/metric
+("tidepool/cbg") with columns:
+    - id: the record's dedup key (see dedup_index.py), with a unique index, so
+      writes are INSERT OR IGNORE and "is this record stored" is an index lookup
+    - utc_Time: epoch seconds, indexed, so a month or any time range is an index
+      range scan instead of the decoding of a month file
+    - timezoneOffset, and the cleaned record as JSON
+
+A partition path `<cleaned>/<source>/<metric>/<metric>-YYYY-M.json` stands for
+the rows of its table in that UTC month, so storage.py, the rollups and the
+analysis address SQLite partitions like the file ones. The database is in WAL
+mode: analysis can read while an ingestion writes.
+
+WAL keeps its index in shared memory, so it only works for processes on one
+machine: this backend is meant for a local cleaned folder. On a network
+filesystem (SQLITE_NETWORK_FILESYSTEMS, e.g. the folder task_queue.py workers
+share) the database falls back to a rollback journal, with a warning: writers
+then block readers, and it is only as safe as the filesystem's POSIX locks.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import CLEANED_DATABASE_FILENAME, SQLITE_NETWORK_FILESYSTEMS
+from dedup_index import clear_pending, mark_pending, pending_path, record_key
+from partitions import partition_bounds
+from timestamps import get_utc_epoch
+
+_VERSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS partition_versions (
+    tbl TEXT NOT NULL,
+    month_start INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (tbl, month_start)
+)
+"""
+
+logger = logging.getLogger(__name__)
+
+# (pid, database path) -> connection, per thread: connections are not shared
+# between threads or inherited by forked workers
+_local = threading.local()
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _location(metric_folder: str) -> tuple:
+    """
+    Returns the database path and table name of a metric folder.
+    """
+    source_folder = os.path.dirname(os.path.normpath(metric_folder))
+    cleaned_folder_path = os.path.dirname(source_folder)
+    table = f"{os.path.basename(source_folder)}/{os.path.basename(os.path.normpath(metric_folder))}"
+    return os.path.join(cleaned_folder_path, CLEANED_DATABASE_FILENAME), table
+
+
+def filesystem_type(path: str, mounts_path: str = "/proc/mounts") -> str:
+    """
+    Returns the type of the filesystem `path` is on ("ext4", "nfs4"...), or None
+    where the mount table cannot be read (not Linux).
+    """
+    try:
+        with open(mounts_path, 'r') as mounts_file:
+            mounts = [line.split()[1:3] for line in mounts_file if len(line.split()) >= 3]
+    except OSError:
+        return None
+
+    path = os.path.realpath(path)
+    best, best_type = "", None
+    for mount_point, fs_type in mounts:
+        # Spaces in mount points are escaped as \040
+        mount_point = mount_point.replace("\\040", " ")
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) >= len(best):
+            best, best_type = mount_point, fs_type
+    return best_type
+
+
+def journal_mode(database_path: str) -> str:
+    """
+    Returns "WAL", or "DELETE" for a database on a network filesystem.
+    """
+    fs_type = filesystem_type(os.path.dirname(os.path.abspath(database_path)))
+    if fs_type in SQLITE_NETWORK_FILESYSTEMS:
+        logger.warning("%s is on a network filesystem (%s): SQLite's WAL needs a local disk, using a rollback "
+                       "journal; keep the cleaned folder local for concurrent reads", database_path, fs_type)
+        return "DELETE"
+    return "WAL"
+
+
+def _connection(database_path: str, create: bool = False):
+    """
+    Returns this thread's connection to a database, or None if it does not exist
+    and `create` is False.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (os.getpid(), database_path)
+    if key not in connections:
+        if not create and not os.path.exists(database_path):
+            return None
+        # Autocommit; writes open their transactions explicitly
+        connection = connections[key] = sqlite3.connect(database_path, timeout=60, isolation_level=None)
+        mode = journal_mode(database_path)
+        connection.execute(f"PRAGMA journal_mode={mode}")
+        # NORMAL is only durable with WAL
+        connection.execute(f"PRAGMA synchronous={'NORMAL' if mode == 'WAL' else 'FULL'}")
+        connection.execute(_VERSIONS_SCHEMA)
+    return connections[key]
+
+
+def _table_exists(connection, table: str) -> bool:
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table,)).fetchone() is not None
+
+
+def _create_table(connection, table: str):
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {_quote(table)} "
+                       "(id TEXT NOT NULL, utc_Time INTEGER NOT NULL, timezoneOffset INTEGER, record TEXT NOT NULL)")
+    connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {_quote(table + ':id')} ON {_quote(table)} (id)")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {_quote(table + ':utc_Time')} ON {_quote(table)} (utc_Time)")
+
+
+def _partition(partition_path: str, create: bool = False) -> tuple:
+    """
+    Returns the connection (None if there is no such table), table name and month
+    bounds of a partition.
+    """
+    database_path, table = _location(os.path.dirname(partition_path))
+    connection = _connection(database_path, create)
+    if connection is not None:
+        if create:
+            _create_table(connection, table)
+        elif not _table_exists(connection, table):
+            connection = None
+    return connection, table, partition_bounds(partition_path)
+
+
+def _bump_version(connection, table: str, month_start: int):
+    connection.execute("INSERT INTO partition_versions VALUES (?, ?, 1) "
+                       "ON CONFLICT (tbl, month_start) DO UPDATE SET version = version + 1", (table, month_start))
+
+
+def partition_exists(partition_path: str) -> bool:
+    connection, table, (month_start, month_end) = _partition(partition_path)
+    if connection is None:
+        return False
+    return connection.execute(f"SELECT 1 FROM {_quote(table)} WHERE utc_Time >= ? AND utc_Time < ? LIMIT 1",
+                              (month_start, month_end)).fetchone() is not None
+
+
+def partition_version(partition_path: str) -> int:
+    """
+    Returns a counter of the writes to a partition, which changes whenever its rows do.
+    """
+    database_path, table = _location(os.path.dirname(partition_path))
+    connection = _connection(database_path)
+    if connection is None:
+        return 0
+    row = connection.execute("SELECT version FROM partition_versions WHERE tbl = ? AND month_start = ?",
+                             (table, partition_bounds(partition_path)[0])).fetchone()
+    return row[0] if row else 0
+
+
+def append_records(partition_path: str, entries: list) -> int:
+    """
+    Inserts cleaned entries of one month, ignoring those already stored. Returns
+    the number inserted.
+    """
+    connection, table, (month_start, month_end) = _partition(partition_path, create=True)
+    rows = [(record_key(entry), get_utc_epoch(entry), entry.get('timezoneOffset'), json.dumps(entry))
+            for entry in entries]
+
+    changes = connection.total_changes
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.executemany(f"INSERT OR IGNORE INTO {_quote(table)} VALUES (?, ?, ?, ?)", rows)
+        inserted = connection.total_changes - changes
+        _bump_version(connection, table, month_start)
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return inserted
+
+
+def read_records(partition_path: str, start: int = None, end: int = None) -> list:
+    """
+    Returns the records of a partition sorted by UTC time: all of them, or those
+    with start <= utc epoch < end.
+    """
+    connection, table, (month_start, month_end) = _partition(partition_path)
+    if connection is None:
+        return []
+    low = month_start if start is None else max(start, month_start)
+    high = month_end if end is None else min(end, month_end)
+    rows = connection.execute(f"SELECT record FROM {_quote(table)} WHERE utc_Time >= ? AND utc_Time < ? "
+                              "ORDER BY utc_Time, rowid", (low, high))
+    return [json.loads(record) for record, in rows]
+
+
+def remove_partition(partition_path: str) -> bool:
+    connection, table, (month_start, month_end) = _partition(partition_path)
+    if connection is None:
+        return False
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        removed = connection.execute(f"DELETE FROM {_quote(table)} WHERE utc_Time >= ? AND utc_Time < ?",
+                                     (month_start, month_end)).rowcount
+        _bump_version(connection, table, month_start)
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return removed > 0
+
+
+def list_partitions(metric_folder: str) -> list:
+    """
+    Returns the paths of the months of a metric that have rows, in calendar order.
+    Each month is found with one index seek.
+    """
+    database_path, table = _location(metric_folder)
+    connection = _connection(database_path)
+    if connection is None or not _table_exists(connection, table):
+        return []
+
+    metric = os.path.basename(os.path.normpath(metric_folder))
+    query = f"SELECT MIN(utc_Time) FROM {_quote(table)} WHERE utc_Time >= ?"
+    partitions = []
+    epoch = connection.execute(query, (-(1 << 62),)).fetchone()[0]
+    while epoch is not None:
+        year, month = time.gmtime(epoch)[:2]
+        partition_path = os.path.join(metric_folder, f"{metric}-{year}-{month}.json")
+        partitions.append(partition_path)
+        epoch = connection.execute(query, (partition_bounds(partition_path)[1],)).fetchone()[0]
+    return partitions
+
+
+class SqliteDedupIndex:
+    """
+    DedupIndex counterpart for SQLite partitions: keys are looked up in the
+    table's id index instead of being loaded from a sidecar.
+    """
+
+    # Host parameters per lookup, below SQLite's limit
+    CHUNK_SIZE = 500
+
+    def __init__(self, partition_path: str):
+        self.partition_path = partition_path
+        self.connection, self.table, _ = _partition(partition_path)
+        # Records are inserted in one transaction, so only the rollups can be off
+        self.recovered = self.connection is not None and os.path.exists(pending_path(partition_path))
+
+    def _stored(self, keys: list) -> set:
+        if self.connection is None:
+            return set()
+        stored = set()
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT id FROM {_quote(self.table)} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            stored.update(key for key, in rows)
+        return stored
+
+    def filter_new(self, entries: list) -> list:
+        """
+        Returns the entries that are not stored yet (or earlier in the same list).
+        """
+        keys = [record_key(entry) for entry in entries]
+        seen = self._stored(list(set(keys)))
+        new_entries = []
+        for key, entry in zip(keys, entries):
+            if key not in seen:
+                seen.add(key)
+                new_entries.append(entry)
+        return new_entries
+
+    def begin_write(self):
+        mark_pending(self.partition_path)
+
+    def save(self):
+        # INSERT OR IGNORE keeps the index; there is nothing to persist
+        clear_pending(self.partition_path)
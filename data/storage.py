@@ -0,0 +1,358 @@
+"""
+Entry point for reading and writing cleaned partitions, whatever their format.
+
+Four formats exist:
+    - "json": row-oriented JSON base file + NDJSON segments (partitions.py)
+    - "columnar": typed column arrays per METRIC_SCHEMAS (columnar.py)
+    - "packed": memory-mapped fixed-size rows (packed.py)
+    - "sqlite": rows of an indexed table in one database (sqlite_store.py)
+
+With CLEANED_STORAGE "sqlite" every new partition goes to the database.
+Otherwise new partitions of PACKED_METRICS are packed, and others are written in
+CLEANED_STORAGE, falling back to "json" for metrics without a schema. An existing partition keeps the format it was
+written in, so switching CLEANED_STORAGE never mixes formats in one partition;
+convert_partition (python storage.py --convert <format>) rewrites existing ones.
+"""
+
+import os
+import threading
+from contextlib import nullcontext
+
+import numpy as np
+
+import sqlite_store
+from config import CLEANED_STORAGE, COMPACTION_INTERVAL_SECONDS, COMPACTION_MIN_SEGMENTS
+from columnar import (EXTRA_COLUMN, append_columnar_segment, columnar_files, columnar_partition_exists,
+                      columns_to_records, compact_columnar_partition, has_schema,
+                      read_columnar_partition, schema_for, records_to_columns)
+from dedup_index import DedupIndex, clear_pending, index_path
+from locks import partition_lock
+from packed import (append_packed_segment, compact_packed_partition, is_packed_metric, packed_files,
+                    packed_partition_exists, read_packed_partition)
+from partitions import (append_segment, compact_partition, partition_bounds, read_partition, read_partition_range,
+                        segment_paths, time_index_files)
+from partitions import list_partitions as list_partition_files
+
+JSON_STORAGE = "json"
+COLUMNAR_STORAGE = "columnar"
+PACKED_STORAGE = "packed"
+SQLITE_STORAGE = "sqlite"
+
+
+def partition_format(partition_path: str, metric: str = None, storage: str = None) -> str:
+    """
+    Returns the format of an existing partition, or the one a new partition of
+    `metric` would be written in.
+    """
+    if packed_partition_exists(partition_path):
+        return PACKED_STORAGE
+    if columnar_partition_exists(partition_path):
+        return COLUMNAR_STORAGE
+    if os.path.exists(partition_path) or segment_paths(partition_path):
+        return JSON_STORAGE
+    if sqlite_store.partition_exists(partition_path):
+        return SQLITE_STORAGE
+
+    storage = storage or CLEANED_STORAGE
+    if storage == SQLITE_STORAGE:
+        return SQLITE_STORAGE
+    if metric is not None and is_packed_metric(metric):
+        return PACKED_STORAGE
+    if storage in (COLUMNAR_STORAGE, PACKED_STORAGE) and metric is not None and has_schema(metric):
+        return storage
+    return JSON_STORAGE
+
+
+def partition_exists(partition_path: str) -> bool:
+    return (os.path.exists(partition_path) or bool(segment_paths(partition_path))
+            or columnar_partition_exists(partition_path) or packed_partition_exists(partition_path)
+            or sqlite_store.partition_exists(partition_path))
+
+
+def list_partitions(metric_folder: str) -> list:
+    """
+    Returns the partition paths of a metric folder, in calendar order, whatever their format.
+    """
+    partitions = list_partition_files(metric_folder) if os.path.isdir(metric_folder) else []
+    stored = set(partitions)
+    partitions += [path for path in sqlite_store.list_partitions(metric_folder) if path not in stored]
+    return sorted(partitions, key=partition_bounds)
+
+
+def load_dedup_index(partition_path: str, metric: str = None, storage: str = None):
+    """
+    Returns the duplicate index of a partition: its sidecar DedupIndex, or for
+    SQLite partitions a view of the table's id index.
+    """
+    if partition_format(partition_path, metric, storage) == SQLITE_STORAGE:
+        return sqlite_store.SqliteDedupIndex(partition_path)
+    return DedupIndex.load(partition_path)
+
+
+def append_entries(partition_path: str, metric: str, entries: list, storage: str = None) -> str:
+    """
+    Appends already-deduplicated entries to a partition as a new segment.
+    """
+    storage = partition_format(partition_path, metric, storage)
+    if storage == SQLITE_STORAGE:
+        sqlite_store.append_records(partition_path, entries)
+        return partition_path
+    if storage == PACKED_STORAGE:
+        return append_packed_segment(partition_path, metric, entries)
+    if storage == COLUMNAR_STORAGE:
+        return append_columnar_segment(partition_path, metric, entries)
+    return append_segment(partition_path, entries)
+
+
+def _slice_columns(columns: dict, start: int = None, end: int = None) -> dict:
+    # Columns are sorted by utc_Time, so a time range is a contiguous slice
+    if (start is None and end is None) or not columns:
+        return columns
+    utc_epochs = columns['utc_Time']
+    low = 0 if start is None else np.searchsorted(utc_epochs, start)
+    high = len(utc_epochs) if end is None else np.searchsorted(utc_epochs, end)
+    return {name: array[low:high] for name, array in columns.items()}
+
+
+def _read_columnar_range(partition_path: str, columns: list = None, start: int = None, end: int = None) -> dict:
+    if start is None and end is None:
+        return read_columnar_partition(partition_path, columns)
+    wanted = None if columns is None else list(dict.fromkeys(['utc_Time', *columns]))
+    converted = _slice_columns(read_columnar_partition(partition_path, wanted), start, end)
+    if columns is not None and 'utc_Time' not in columns:
+        converted.pop('utc_Time', None)
+    return converted
+
+
+def _read_lock(partition_path: str):
+    # Compaction replaces a partition's segments with a new base file under the
+    # partition lock; readers hold it shared so they see either the old files or
+    # the new ones, never both. SQLite partitions may have no folder, and need no lock
+    if not os.path.isdir(os.path.dirname(partition_path)):
+        return nullcontext()
+    return partition_lock(partition_path, shared=True)
+
+
+def read_records(partition_path: str, start: int = None, end: int = None) -> list:
+    """
+    Returns the records of a partition as cleaned dicts, sorted by UTC time: all
+    of them, or those with start <= utc epoch < end.
+    """
+    with _read_lock(partition_path):
+        return _read_records_locked(partition_path, start, end)
+
+
+def _read_records_locked(partition_path: str, start: int = None, end: int = None) -> list:
+    storage = partition_format(partition_path)
+    if storage == PACKED_STORAGE:
+        return columns_to_records(read_packed_partition(partition_path, start=start, end=end))
+    if storage == COLUMNAR_STORAGE:
+        return columns_to_records(_read_columnar_range(partition_path, start=start, end=end))
+    if storage == SQLITE_STORAGE:
+        return sqlite_store.read_records(partition_path, start, end)
+    if start is None and end is None:
+        return read_partition(partition_path)
+    return read_partition_range(partition_path, start, end)
+
+
+def read_columns(partition_path: str, metric: str, columns: list = None, start: int = None, end: int = None) -> dict:
+    """
+    Returns a partition as column -> numpy array, sorted by UTC time. Only
+    `columns` are loaded when given; for columnar partitions the others are never
+    decoded. utc_Time is int64 epoch seconds and timezoneOffset is in minutes.
+    With `start`/`end`, only rows with start <= utc_Time < end are returned.
+    """
+    with _read_lock(partition_path):
+        return _read_columns_locked(partition_path, metric, columns, start, end)
+
+
+def _read_columns_locked(partition_path: str, metric: str, columns: list = None, start: int = None,
+                         end: int = None) -> dict:
+    storage = partition_format(partition_path)
+    if storage in (PACKED_STORAGE, COLUMNAR_STORAGE):
+        if storage == PACKED_STORAGE:
+            converted = read_packed_partition(partition_path, columns, start, end)
+        else:
+            converted = _read_columnar_range(partition_path, columns, start, end)
+        # The leftover fields of the records are only for read_records, unless asked for
+        if columns is None:
+            converted.pop(EXTRA_COLUMN, None)
+        return converted
+
+    # JSON partitions are decoded (in full, or from the range's first indexed
+    # block), SQLite ones read with an index range scan, then converted with the metric's schema (or with just the requested
+    # fields for metrics that have none)
+    records = _read_records_locked(partition_path, start, end)
+    if has_schema(metric):
+        schema = schema_for(metric)
+    elif columns is None:
+        schema = {key: 'object' for record in records[:1] for key in record}
+    else:
+        schema = {column: 'object' for column in columns}
+    if columns is not None:
+        schema = {column: dtype for column, dtype in schema.items() if column in columns}
+
+    converted = records_to_columns(records, schema)
+    if columns is not None:
+        converted = {column: array for column, array in converted.items() if column in columns}
+    return converted
+
+
+def load_metric_columns(metric_folder: str, metric: str, columns: list = None) -> list:
+    """
+    Returns (partition path, columns) for every partition of a metric folder.
+    """
+    return [(partition_path, read_columns(partition_path, metric, columns))
+            for partition_path in list_partitions(metric_folder)]
+
+
+def _compact_locked(partition_path: str) -> bool:
+    storage = partition_format(partition_path)
+    if storage == SQLITE_STORAGE:
+        return False
+    if storage == PACKED_STORAGE:
+        return compact_packed_partition(partition_path)
+    if storage == COLUMNAR_STORAGE:
+        return compact_columnar_partition(partition_path)
+    return compact_partition(partition_path)
+
+
+def compact(partition_path: str) -> bool:
+    with partition_lock(partition_path):
+        return _compact_locked(partition_path)
+
+
+def partition_files(partition_path: str) -> list:
+    """
+    Returns every base file, segment and time index of a partition, whatever their format.
+    """
+    base_file = [partition_path] if os.path.exists(partition_path) else []
+    return (base_file + segment_paths(partition_path) + time_index_files(partition_path)
+            + columnar_files(partition_path) + packed_files(partition_path))
+
+
+def remove_partition(partition_path: str) -> bool:
+    """
+    Deletes a partition's base file, segments and time indexes, whatever their format.
+    """
+    removed = False
+    with partition_lock(partition_path):
+        for path in partition_files(partition_path):
+            os.remove(path)
+            removed = True
+        removed = sqlite_store.remove_partition(partition_path) or removed
+        # Nothing is left to recover from an interrupted write
+        clear_pending(partition_path)
+    return removed
+
+
+def convert_partition(partition_path: str, metric: str, storage: str) -> bool:
+    """
+    Rewrites a partition as one compacted file in `storage` ("columnar" or
+    "packed"; the metric needs a schema, and fields outside it are kept as JSON
+    in the extra column, see columnar.py).
+    Formats are read in preference packed > columnar > json, so the new file is
+    used as soon as it is written and the old ones are only removed afterwards.
+
+    To "sqlite", any file partition is moved into the database (file partitions
+    are read in preference to it, so here too the files go last).
+    """
+    if storage == SQLITE_STORAGE:
+        return _move_to_sqlite(partition_path)
+
+    order = [JSON_STORAGE, COLUMNAR_STORAGE, PACKED_STORAGE]
+    if not has_schema(metric):
+        return False
+
+    with partition_lock(partition_path):
+        current_format = partition_format(partition_path)
+        if (not partition_exists(partition_path) or current_format not in order
+                or order.index(current_format) >= order.index(storage)):
+            return False
+        old_files = partition_files(partition_path)
+        records = read_records(partition_path)
+        if storage == PACKED_STORAGE:
+            append_packed_segment(partition_path, metric, records)
+        else:
+            append_columnar_segment(partition_path, metric, records)
+        _compact_locked(partition_path)
+
+        for path in old_files:
+            os.remove(path)
+    return True
+
+
+def _move_to_sqlite(partition_path: str) -> bool:
+    with partition_lock(partition_path):
+        old_files = partition_files(partition_path)
+        if not old_files:
+            return False
+        sqlite_store.append_records(partition_path, read_records(partition_path))
+
+        # The sidecar dedup index is not used by SQLite partitions
+        if os.path.exists(index_path(partition_path)):
+            old_files.append(index_path(partition_path))
+        for path in old_files:
+            os.remove(path)
+    return True
+
+
+def convert_all(cleaned_folder_path: str, storage: str) -> int:
+    """
+    Converts every partition with a schema under a cleaned data folder to
+    `storage`. Returns the number of partitions converted.
+    """
+    converted = 0
+    for root, dirs, files in os.walk(cleaned_folder_path):
+        metric = os.path.basename(root)
+        for partition_path in list_partition_files(root):
+            if convert_partition(partition_path, metric, storage):
+                converted += 1
+    return converted
+
+
+def _segment_count(partition_path: str) -> int:
+    return (len(segment_paths(partition_path))
+            + sum(".seg-" in os.path.basename(path)
+                  for path in columnar_files(partition_path) + packed_files(partition_path)))
+
+
+def compact_all(cleaned_folder_path: str, min_segments: int = COMPACTION_MIN_SEGMENTS) -> int:
+    """
+    Compacts every partition under a cleaned data folder that has at least
+    min_segments segments. Returns the number of partitions compacted.
+    """
+    compacted = 0
+    for root, dirs, files in os.walk(cleaned_folder_path):
+        if not any(".seg-" in filename for filename in files):
+            continue
+        for partition_path in list_partition_files(root):
+            if _segment_count(partition_path) >= min_segments and compact(partition_path):
+                compacted += 1
+    return compacted
+
+
+def start_background_compaction(cleaned_folder_path: str, interval: float = COMPACTION_INTERVAL_SECONDS):
+    """
+    Runs compact_all every `interval` seconds on a daemon thread. Set the returned
+    event to stop it.
+    """
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            compact_all(cleaned_folder_path)
+
+    threading.Thread(target=run, name="partition-compaction", daemon=True).start()
+    return stop_event
+
+
+if __name__ == "__main__":
+    import sys
+
+    from constants import CLEANED_FOLDER
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--convert":
+        print("Partitions converted:", convert_all(CLEANED_FOLDER, sys.argv[2]))
+    else:
+        print("Partitions compacted:", compact_all(CLEANED_FOLDER))
@@ -0,0 +1,190 @@
+"""
+Deterministic synthetic exports, shaped like the real Tidepool, Fitbit Takeout
+and Bitesnap exports, for benchmarks (see benchmark.py).
+
+The same seed, start date and number of days always give byte-identical files.
+
+    python synthetic_exports.py <folder> [days] [seed]
+
+writes `<folder>/tidepool`, `<folder>/fitbit` and `<folder>/bitesnap`, laid out
+like export_data.
+"""
+
+import calendar
+import csv
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+DEFAULT_START = datetime(2023, 1, 1)
+# Fixed offset of the synthetic user's local time, in minutes
+TIMEZONE_OFFSET = -300
+
+
+def _iso_utc(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _write_json(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out_file:
+        # Same layout as the Fitbit exports: one indented object per item
+        json.dump(data, out_file, indent=2, separators=(',', ' : '))
+
+
+def _write_csv(path: str, header: list, rows: list):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _glucose(rng: random.Random, moment: datetime) -> float:
+    # Daily wave plus noise, in mmol/L like Tidepool's cbg values
+    phase = (moment.hour * 60 + moment.minute) / 1440 * 2 * math.pi
+    return round(7.5 + 2.5 * math.sin(phase) + rng.gauss(0, 0.6), 5)
+
+
+def generate_tidepool(folder: str, start: datetime = DEFAULT_START, days: int = 30, seed: int = 0) -> int:
+    """
+    Writes one Tidepool export: cbg every 5 minutes, smbg, basal and bolus.
+    Returns the number of entries.
+    """
+    rng = random.Random(seed)
+    entries = []
+
+    def entry(moment, entry_type, **fields):
+        local = moment + timedelta(minutes=TIMEZONE_OFFSET)
+        entries.append({
+            'id': f"{rng.getrandbits(128):032x}",
+            'type': entry_type,
+            'time': _iso_utc(moment),
+            'deviceTime': local.strftime("%Y-%m-%dT%H:%M:%S"),
+            'timezoneOffset': TIMEZONE_OFFSET,
+            'uploadId': f"upload{seed}",
+            'deviceId': f"pump-{seed}",
+            **fields,
+        })
+
+    for day in range(days):
+        midnight = start + timedelta(days=day)
+        for minute in range(0, 1440, 5):
+            moment = midnight + timedelta(minutes=minute, seconds=rng.randrange(60))
+            entry(moment, 'cbg', units='mmol/L', value=_glucose(rng, moment))
+        for minute in range(0, 1440, 30):
+            entry(midnight + timedelta(minutes=minute), 'basal', deliveryType='scheduled',
+                  rate=round(rng.uniform(0.5, 1.2), 3), duration=1800000)
+        for hour in (7, 12, 19):
+            moment = midnight + timedelta(hours=hour, minutes=rng.randrange(60))
+            entry(moment, 'bolus', subType='normal', normal=round(rng.uniform(1, 8), 2))
+            entry(moment - timedelta(minutes=5), 'smbg', units='mmol/L', value=_glucose(rng, moment))
+
+    path = os.path.join(folder, f"TidepoolExport_{seed}_{start:%Y-%m-%d}_{days}d.json")
+    _write_json(path, entries)
+    return len(entries)
+
+
+def generate_fitbit(folder: str, start: datetime = DEFAULT_START, days: int = 30, seed: int = 0) -> int:
+    """
+    Writes a Fitbit Takeout: daily heart_rate JSON files (a sample every ~10s),
+    monthly per-minute steps/calories/distance JSON files, and daily Minute SpO2
+    and estimated_oxygen_variation CSV files. Returns the number of records.
+    """
+    rng = random.Random(seed)
+    root = os.path.join(folder, "Takeout", "Fitbit")
+    global_export = os.path.join(root, "Global Export Data")
+    records = 0
+
+    for day in range(days):
+        midnight = start + timedelta(days=day)
+        date = f"{midnight:%Y-%m-%d}"
+
+        heart_rate = []
+        second = rng.randrange(10)
+        while second < 86400:
+            heart_rate.append({
+                'dateTime': f"{midnight + timedelta(seconds=second):%m/%d/%y %H:%M:%S}",
+                'value': {'bpm': rng.randrange(55, 130), 'confidence': rng.randrange(4)},
+            })
+            second += rng.choice((5, 10, 10, 15))
+        _write_json(os.path.join(global_export, f"heart_rate-{date}.json"), heart_rate)
+
+        # SpO2 is only measured during the night
+        night = [midnight + timedelta(hours=3, minutes=minute, seconds=rng.randrange(60)) for minute in range(420)]
+        _write_csv(os.path.join(root, "Oxygen Saturation (SpO2)", f"Minute SpO2 - {date}.csv"), ['timestamp', 'value'],
+                   [[f"{moment:%Y-%m-%dT%H:%M:%SZ}", round(rng.uniform(90, 100), 1)] for moment in night])
+        _write_csv(os.path.join(global_export, f"estimated_oxygen_variation-{date}.csv"),
+                   ['timestamp', 'Infrared to Red Signal Ratio'],
+                   [[f"{moment:%m/%d/%y %H:%M:%S}", rng.randrange(100)] for moment in night])
+        records += len(heart_rate) + 2 * len(night)
+
+    # Per-minute metrics come in files of up to a month
+    for first_day in range(0, days, 30):
+        file_start = start + timedelta(days=first_day)
+        minutes = range(min(30, days - first_day) * 1440)
+        for metric, value in (('steps', lambda: str(rng.choice((0, 0, 0, rng.randrange(120))))),
+                              ('calories', lambda: f"{rng.uniform(1, 10):.2f}"),
+                              ('distance', lambda: f"{rng.uniform(0, 80):.1f}")):
+            items = [{'dateTime': f"{file_start + timedelta(minutes=minute):%m/%d/%y %H:%M:%S}", 'value': value()}
+                     for minute in minutes]
+            _write_json(os.path.join(global_export, f"{metric}-{file_start:%Y-%m-%d}.json"), items)
+            records += len(items)
+
+    return records
+
+
+def generate_bitesnap(folder: str, start: datetime = DEFAULT_START, days: int = 30, seed: int = 0) -> int:
+    """
+    Writes one Bitesnap food log with ~4 entries a day. Returns the number of entries.
+    """
+    rng = random.Random(seed)
+    foods = [("Oatmeal", 150, 27.0), ("Apple", 95, 25.0), ("Chicken salad", 320, 12.0),
+             ("Rice bowl", 540, 80.0), ("Nestle Crunch", 189, 22.1), ("Yogurt", 120, 15.5)]
+
+    entries = []
+    for day in range(days):
+        midnight = start + timedelta(days=day)
+        for hour in sorted(rng.sample(range(7, 22), 4)):
+            eaten = midnight + timedelta(hours=hour, minutes=rng.randrange(60))
+            name, calories, carbs = rng.choice(foods)
+            quantity = rng.choice((0.5, 1, 1, 2))
+            entries.append({
+                'mealID': f"{rng.getrandbits(100):025x}",
+                'entryID': f"{rng.getrandbits(100):025x}",
+                'title': "",
+                'eatenAtUTC': _iso_utc(eaten),
+                'eatenAtLocalTime': int(f"{eaten + timedelta(minutes=TIMEZONE_OFFSET):%Y%m%d%H%M%S}"),
+                'lastModifiedUTC': calendar.timegm(eaten.timetuple()) * 1000,
+                'foodItemName': name,
+                'servingUnits': "serving",
+                'servingQuantity': quantity,
+                'nutrients': [{'name': 'calories', 'unit': 'cal', 'amount': calories * quantity},
+                              {'name': 'totalCarb', 'unit': 'g', 'amount': carbs * quantity}],
+            })
+
+    path = os.path.join(folder, f"bitesnap_food_log_{seed}_{start:%d-%m-%Y}_{days}d.json")
+    _write_json(path, {'entries': entries})
+    return len(entries)
+
+
+def generate_exports(folder: str, days: int = 30, seed: int = 0, start: datetime = DEFAULT_START) -> dict:
+    """
+    Writes all three sources under `folder`, laid out like export_data. Returns
+    source -> number of records.
+    """
+    return {
+        'tidepool': generate_tidepool(os.path.join(folder, "tidepool"), start, days, seed),
+        'fitbit': generate_fitbit(os.path.join(folder, "fitbit"), start, days, seed),
+        'bitesnap': generate_bitesnap(os.path.join(folder, "bitesnap"), start, days, seed),
+    }
+
+
+if __name__ == "__main__":
+    output_folder = sys.argv[1]
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    print(generate_exports(output_folder, days, seed))
@@ -0,0 +1,447 @@
+"""
+Resumable ingestion: persisted tasks in a SQLite queue, claimed with leases.
+
+A run of data_parser.process_data is all-or-nothing. Here ingestion is planned
+as tasks in `cleaned_data/ingest_tasks.sqlite`:
+    - one 'ingest' task per export file to ingest (as planned by the ingestion
+      manifest, whose stale partitions are dropped while planning)
+    - one 'finalize' task per source, claimable once all the source's ingest
+      tasks are done: it records the files in the manifest and moves the exports
+      found while planning to the used folder (files exported since are left
+      for the next run)
+
+Workers (processes here or on other machines sharing the data folder) claim the
+oldest claimable task with a lease of TASK_LEASE_SECONDS, renewed while the task
+runs. The lease of a worker that died expires and another worker takes the task
+over; its partial writes are harmless, since partition segments are written
+atomically and parse_batch drops the records already stored. A restart thus
+resumes after the last completed task. A task failing TASK_MAX_ATTEMPTS times is
+marked failed, with its source's finalize task, until `retry`.
+
+    python task_queue.py [run|plan|work|status|retry] [--workers N] [--sources ...]
+
+`python data_parser.py` (the default ingest) runs the same way.
+
+The queue uses SQLite's locking, so a shared filesystem must support POSIX
+locks, and the clocks of the machines must roughly agree for leases to expire.
+With CLEANED_STORAGE "sqlite" the cleaned database is on that filesystem too, so
+it uses a rollback journal instead of WAL (see sqlite_store.py).
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import data_parser
+from config import (LOG_FORMAT, LOG_LEVEL, RUN_REPORT_FILENAME, TASK_LEASE_SECONDS, TASK_MAX_ATTEMPTS,
+                    TASK_POLL_SECONDS, TASK_QUEUE_FILENAME)
+from constants import BITESNAP_FOLDER, FITBIT_FOLDER, TIDEPOOL_FOLDER
+from instrumentation import current
+from manifest import IngestionManifest
+from rollups import remove_rollups
+from storage import remove_partition
+
+logger = logging.getLogger(__name__)
+
+SOURCES = [FITBIT_FOLDER, TIDEPOOL_FOLDER, BITESNAP_FOLDER]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, id);
+CREATE INDEX IF NOT EXISTS tasks_by_run ON tasks (run, kind, state);
+"""
+
+# Oldest pending task, or running task whose lease expired; a finalize task only
+# once every ingest task of its run is done
+_CLAIMABLE = """
+SELECT * FROM tasks
+WHERE (state = 'pending' OR (state = 'running' AND lease_expires < :now))
+  AND (kind != 'finalize' OR NOT EXISTS (
+      SELECT 1 FROM tasks AS ingest WHERE ingest.run = tasks.run AND ingest.kind = 'ingest' AND ingest.state != 'done'))
+ORDER BY id LIMIT 1
+"""
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class TaskQueue:
+    """
+    A task table in one SQLite file. Tasks are dicts of their row, with payload
+    and result decoded. Use one TaskQueue per thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Autocommit; transactions are opened explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Holds the database's write lock for the block, so claims never race.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    @staticmethod
+    def _task(row) -> dict:
+        task = dict(row)
+        task['payload'] = json.loads(task['payload'])
+        task['result'] = json.loads(task['result']) if task['result'] else None
+        return task
+
+    def enqueue_run(self, source: str, ingest_payloads: dict, finalize_payload: dict = None) -> int:
+        """
+        Adds an ingest task per key -> payload and the finalize task of a new run
+        of `source`. Call it in a transaction. Returns the run id.
+        """
+        run = self.connection.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM tasks").fetchone()[0]
+        now = time.time()
+        rows = [(run, 'ingest', source, key, json.dumps(payload), now) for key, payload in ingest_payloads.items()]
+        rows.append((run, 'finalize', source, source, json.dumps(finalize_payload or {}), now))
+        self.connection.executemany(
+            "INSERT INTO tasks (run, kind, source, key, payload, updated) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return run
+
+    def claim(self, owner: str, lease_seconds: float = TASK_LEASE_SECONDS) -> dict:
+        """
+        Leases the next claimable task to `owner`. Returns it, or None if there is none.
+        """
+        with self.transaction() as connection:
+            while True:
+                now = time.time()
+                row = connection.execute(_CLAIMABLE, {'now': now}).fetchone()
+                if row is None:
+                    return None
+                if row['attempts'] >= TASK_MAX_ATTEMPTS:
+                    # Its workers kept dying before they could report a failure
+                    self._mark_failed(row['id'], row['run'], f"lease of {row['owner']} expired")
+                    continue
+                connection.execute(
+                    "UPDATE tasks SET state = 'running', owner = ?, lease_expires = ?, attempts = attempts + 1,"
+                    " updated = ? WHERE id = ?", (owner, now + lease_seconds, now, row['id']))
+                task = self._task(row)
+                task.update(state='running', owner=owner, attempts=row['attempts'] + 1)
+                return task
+
+    def renew(self, task_id: int, owner: str, lease_seconds: float = TASK_LEASE_SECONDS) -> bool:
+        """
+        Extends a lease. Returns False if the task is no longer `owner`'s.
+        """
+        cursor = self.connection.execute(
+            "UPDATE tasks SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'running'",
+            (time.time() + lease_seconds, task_id, owner))
+        return cursor.rowcount == 1
+
+    def checkpoint(self, task_id: int, owner: str, progress: dict) -> bool:
+        """
+        Stores a running task's progress as its result, for whoever resumes it.
+        """
+        cursor = self.connection.execute(
+            "UPDATE tasks SET result = ?, updated = ? WHERE id = ? AND owner = ? AND state = 'running'",
+            (json.dumps(progress), time.time(), task_id, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id: int, owner: str, result: dict) -> bool:
+        """
+        Marks a task done. Returns False if its lease was lost to another worker.
+        """
+        cursor = self.connection.execute(
+            "UPDATE tasks SET state = 'done', result = ?, error = NULL, lease_expires = NULL, updated = ?"
+            " WHERE id = ? AND owner = ? AND state = 'running'", (json.dumps(result), time.time(), task_id, owner))
+        return cursor.rowcount == 1
+
+    def fail(self, task_id: int, owner: str, error: str):
+        """
+        Puts a task back in the queue, or marks it failed after TASK_MAX_ATTEMPTS.
+        """
+        with self.transaction() as connection:
+            row = connection.execute("SELECT * FROM tasks WHERE id = ? AND owner = ? AND state = 'running'",
+                                     (task_id, owner)).fetchone()
+            if row is None:
+                return
+            if row['attempts'] >= TASK_MAX_ATTEMPTS:
+                self._mark_failed(task_id, row['run'], error)
+            else:
+                connection.execute("UPDATE tasks SET state = 'pending', owner = NULL, lease_expires = NULL,"
+                                   " error = ?, updated = ? WHERE id = ?", (error, time.time(), task_id))
+
+    def _mark_failed(self, task_id: int, run: int, error: str):
+        now = time.time()
+        self.connection.execute("UPDATE tasks SET state = 'failed', owner = NULL, lease_expires = NULL, error = ?,"
+                                " updated = ? WHERE id = ?", (error, now, task_id))
+        # The exports of a run with a failed file are neither recorded nor moved
+        self.connection.execute("UPDATE tasks SET state = 'failed', error = ?, updated = ?"
+                                " WHERE run = ? AND kind = 'finalize' AND state = 'pending'",
+                                (f"task {task_id} failed", now, run))
+
+    def retry_failed(self) -> int:
+        cursor = self.connection.execute("UPDATE tasks SET state = 'pending', attempts = 0, error = NULL,"
+                                         " updated = ? WHERE state = 'failed'", (time.time(),))
+        return cursor.rowcount
+
+    def unfinished(self, source: str = None) -> int:
+        """
+        Counts the tasks (of a source) that are not done, failed ones included.
+        """
+        query = "SELECT COUNT(*) FROM tasks WHERE state != 'done'"
+        if source is None:
+            return self.connection.execute(query).fetchone()[0]
+        return self.connection.execute(query + " AND source = ?", (source,)).fetchone()[0]
+
+    def active(self) -> int:
+        """
+        Counts the pending and running tasks: while there are any, a worker may get work.
+        """
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'running')").fetchone()[0]
+
+    def ingest_results(self, run: int) -> list:
+        rows = self.connection.execute(
+            "SELECT * FROM tasks WHERE run = ? AND kind = 'ingest' AND state = 'done' ORDER BY id", (run,))
+        return [self._task(row) for row in rows]
+
+    def counts(self) -> dict:
+        rows = self.connection.execute("SELECT source, state, COUNT(*) FROM tasks GROUP BY source, state")
+        counts = {}
+        for source, state, n in rows:
+            counts.setdefault(source, {})[state] = n
+        return counts
+
+
+def queue_path() -> str:
+    return os.path.join(data_parser.cleaned_folder, TASK_QUEUE_FILENAME)
+
+
+def plan_source(queue: TaskQueue, source: str) -> int:
+    """
+    Plans a run of `source` over its export folder: drops the partitions the
+    manifest marks stale and enqueues the tasks. A source with unfinished tasks
+    is resumed rather than planned again. Returns the run id, or None.
+    """
+    data_export_path = os.path.join(data_parser.export_folder, source)
+
+    # Under the write lock, so two workers starting at once do not both plan
+    with queue.transaction():
+        if queue.unfinished(source):
+            logger.info("%s: resuming the unfinished run", source)
+            return None
+        data_files = data_parser.get_filepaths(data_export_path)
+        if not data_files:
+            return None
+
+        manifest = IngestionManifest.load(data_parser.cleaned_folder)
+        to_ingest, stale_partitions = manifest.plan(data_files, data_export_path, source)
+        for partition in stale_partitions:
+            remove_partition(os.path.join(data_parser.cleaned_folder, partition))
+            remove_rollups(os.path.join(data_parser.cleaned_folder, partition))
+
+        run = queue.enqueue_run(source, {key: {'filepath': filepath} for key, filepath in to_ingest.items()},
+                                {'filepaths': data_files})
+    logger.info("%s: run %d, %d of %d files to ingest, %d partitions to rebuild",
+                source, run, len(to_ingest), len(data_files), len(stale_partitions))
+    return run
+
+
+def _ingest(source: str, filepath: str) -> dict:
+    parsers = {
+        # Workers are the parallelism: one file is ingested by one process
+        FITBIT_FOLDER: partial(data_parser.parse_fitbit_data, workers=1),
+        TIDEPOOL_FOLDER: data_parser.parse_tidepool_data,
+        BITESNAP_FOLDER: data_parser.parse_bitesnap_data,
+    }
+    stats = parsers[source]([filepath]).get(filepath, {'partitions': [], 'records': 0})
+    return {'partitions': sorted(stats['partitions']), 'records': stats['records']}
+
+
+def _finalize(queue: TaskQueue, task: dict) -> dict:
+    """
+    Records the run's files in the manifest and moves the exports planned in the
+    run (those ingested, and those the manifest found unchanged) to the used
+    folder; files exported after planning stay. The moves are checkpointed, so a
+    retry does not move again.
+    """
+    source = task['source']
+    data_export_path = os.path.join(data_parser.export_folder, source)
+    data_used_path = os.path.join(data_parser.used_folder, source)
+
+    manifest = IngestionManifest.load(data_parser.cleaned_folder)
+    ingested = queue.ingest_results(task['run'])
+    moves = (task['result'] or {}).get('moves')
+    if moves is None:
+        planned = task['payload'].get('filepaths') or [ingest['payload']['filepath'] for ingest in ingested]
+        # Re-ingested files may already be in the used folder
+        exported = [path for path in planned if path.startswith(data_export_path + os.sep)]
+        moves = data_parser.move_files(exported, data_export_path, data_used_path)
+        queue.checkpoint(task['id'], task['owner'], {'moves': moves})
+
+    for ingest in ingested:
+        filepath = ingest['payload']['filepath']
+        manifest.record(ingest['key'], _current_path(filepath, moves, data_export_path, data_used_path),
+                        ingest['result']['partitions'], ingest['result']['records'])
+    manifest.relocate(moves)
+    manifest.save()
+    return {'files': len(ingested), 'moved': len(moves)}
+
+
+def _current_path(filepath: str, moves: list, data_export_path: str, data_used_path: str) -> str:
+    if os.path.exists(filepath):
+        return filepath
+    for source_path, destination_path in moves:
+        if filepath == source_path or filepath.startswith(source_path + os.sep):
+            return destination_path + filepath[len(source_path):]
+    # Moved by an attempt that died before its checkpoint
+    return os.path.join(data_used_path, os.path.relpath(filepath, data_export_path))
+
+
+class _Heartbeat:
+    """
+    Renews a task's lease from a thread while the task runs.
+    """
+
+    def __init__(self, path: str, task: dict, lease_seconds: float):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(path, task, lease_seconds), daemon=True)
+
+    def _run(self, path: str, task: dict, lease_seconds: float):
+        queue = TaskQueue(path)
+        try:
+            while not self.stopped.wait(lease_seconds / 3):
+                if not queue.renew(task['id'], task['owner'], lease_seconds):
+                    logger.warning("Lost the lease of task %d (%s)", task['id'], task['key'])
+                    return
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def work(path: str = None, owner: str = None, lease_seconds: float = TASK_LEASE_SECONDS) -> int:
+    """
+    Claims and runs tasks until none are pending or running. Returns the number
+    of tasks this worker completed.
+    """
+    path = path or queue_path()
+    owner = owner or default_owner()
+    queue = TaskQueue(path)
+    completed = 0
+    try:
+        while True:
+            task = queue.claim(owner, lease_seconds)
+            if task is None:
+                if not queue.active():
+                    return completed
+                # Other workers hold the remaining tasks, or a finalize task waits for them
+                time.sleep(TASK_POLL_SECONDS)
+                continue
+
+            tic = time.perf_counter()
+            try:
+                with _Heartbeat(path, task, lease_seconds):
+                    if task['kind'] == 'ingest':
+                        result = _ingest(task['source'], task['payload']['filepath'])
+                    else:
+                        result = _finalize(queue, task)
+            except Exception as e:
+                logger.exception("Task %d (%s %s) failed", task['id'], task['kind'], task['key'])
+                queue.fail(task['id'], owner, f"{type(e).__name__}: {e}")
+                continue
+
+            if queue.complete(task['id'], owner, result):
+                completed += 1
+                logger.info("Task %d (%s %s) done in %.2fs", task['id'], task['kind'], task['key'],
+                            time.perf_counter() - tic)
+            else:
+                logger.warning("Task %d (%s) was taken over by another worker", task['id'], task['key'])
+    finally:
+        queue.close()
+
+
+def _init_worker(log_level: int, root: str):
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    data_parser.use_data_root(root)
+
+
+def work_in_processes(workers: int, path: str = None) -> int:
+    path = path or queue_path()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(logging.getLogger().level, data_parser.data_root)) as executor:
+        futures = [executor.submit(work, path) for _ in range(workers)]
+        return sum(future.result() for future in futures)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Resumable ingestion through a SQLite task queue.")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "plan", "work", "status", "retry"],
+                        help="run = plan, then work (default)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes on this machine")
+    parser.add_argument("--sources", nargs="+", choices=SOURCES, default=SOURCES)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    data_parser.create_folders()
+    task_queue = TaskQueue(queue_path())
+
+    if args.command == "retry":
+        logger.info("%d failed tasks queued again", task_queue.retry_failed())
+    if args.command in ("run", "plan"):
+        for source in args.sources:
+            plan_source(task_queue, source)
+    if args.command in ("run", "work", "retry"):
+        tic = time.time()
+        if args.workers > 1:
+            completed = work_in_processes(args.workers)
+        else:
+            completed = work()
+            # The stages of in-process workers are in this process's report
+            report_path = os.path.join(data_parser.cleaned_folder, RUN_REPORT_FILENAME)
+            current().save(report_path, time.time() - tic)
+            logger.info("run report: %s", report_path)
+        logger.info("%d tasks done in %.2fs", completed, time.time() - tic)
+
+    for source, states in task_queue.counts().items():
+        logger.info("%s: %s", source, states)
+    task_queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+import pytest
+
+# The modules of data/ import each other by their flat names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_parser  # noqa: E402
+from constants import CLEANED_FOLDER  # noqa: E402
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    """
+    Points data_parser at an empty data root in a temporary folder.
+    """
+    data_parser.use_data_root(str(tmp_path))
+    data_parser.create_folders()
+    yield tmp_path
+    data_parser.use_data_root("")
+
+
+@pytest.fixture
+def cleaned_folder(data_root):
+    return str(data_root / CLEANED_FOLDER)
+
+
+def make_cbg(i: int, month: int = 10, **fields) -> dict:
+    """
+    Returns a cleaned Tidepool cbg entry, 5 minutes after the previous i.
+    """
+    minutes = 5 * i
+    day, minute = 1 + minutes // 1440, minutes % 1440
+    entry = {
+        'id': f"cbg{i:08d}",
+        'type': 'cbg',
+        'units': 'mmol/L',
+        'value': 5.5 + (i % 7) / 2,
+        'deviceId': 'DexG6-1234',
+        'uploadId': 'upid_0001',
+        'utc_Time': f"2023-{month:02d}-{day:02d}T{minute // 60:02d}:{minute % 60:02d}:00Z",
+        'local_Time': f"2023-{month:02d}-{day:02d}T{minute // 60:02d}:{minute % 60:02d}:00",
+        'timezoneOffset': 0.0,
+    }
+    entry.update(fields)
+    return entry
+
+
+def make_calories(i: int) -> dict:
+    """
+    Returns a cleaned Fitbit calories entry, 5 minutes after the previous i. As
+    in the export, its value is a string.
+    """
+    entry = make_cbg(i)
+    return {
+        'utc_Time': entry['utc_Time'],
+        'local_Time': entry['local_Time'],
+        'timezoneOffset': 0.0,
+        'value': f"{1 + i / 100:.2f}",
+    }
+
+
+def partition_for(cleaned_folder: str, metric: str = "cbg", source: str = "tidepool") -> str:
+    """
+    Returns the path of a metric's October 2023 partition, creating its folder.
+    """
+    metric_folder = os.path.join(cleaned_folder, source, metric)
+    os.makedirs(metric_folder, exist_ok=True)
+    return os.path.join(metric_folder, f"{metric}-2023-10.json")
+
+
+def assert_same_records(read: list, written: list):
+    """
+    Asserts that records read back are the ones written, value types included
+    (a plain == takes 1 for 1.0).
+    """
+    assert [json.dumps(record, sort_keys=True) for record in read] == \
+        [json.dumps(entry, sort_keys=True) for entry in written]
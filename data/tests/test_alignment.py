@@ -0,0 +1,124 @@
+import calendar
+from datetime import datetime
+
+import matplotlib
+import numpy as np
+import pytest
+
+import data_analysis
+import data_parser
+from alignment import align_metrics, asof, asof_indices, resample
+from conftest import make_cbg
+
+matplotlib.use("Agg")
+
+OCTOBER = calendar.timegm(datetime(2023, 10, 1).utctimetuple())
+
+
+def test_asof_tolerance_is_inclusive():
+    times = np.array([100, 200])
+    assert asof_indices(times, [150, 160], tolerance=50).tolist() == [0, -1]
+    assert asof_indices(times, [150, 140], tolerance=50, direction='forward').tolist() == [1, -1]
+    # A tie is resolved backward
+    assert asof_indices(times, [150], direction='nearest').tolist() == [0]
+    assert asof_indices(times, [99, 201], direction='nearest', tolerance=1).tolist() == [0, 1]
+    assert asof_indices(times, [99]).tolist() == [-1]
+    assert asof_indices(times, [201], direction='forward').tolist() == [-1]
+
+
+def test_asof_of_empty_series():
+    assert asof_indices([], [1, 2]).tolist() == [-1, -1]
+    assert asof_indices([1, 2], []).tolist() == []
+    assert np.isnan(asof([], [], [1, 2])).all()
+    assert asof([1], [5.0], []).tolist() == []
+
+
+def test_asof_with_duplicate_times_takes_the_last_sample():
+    times = np.array([100, 100, 100, 200])
+    values = [1.0, 2.0, 3.0, 4.0]
+    assert asof(times, values, [100, 150]).tolist() == [3.0, 3.0]
+    assert asof(times, values, [50], direction='forward').tolist() == [1.0]
+
+
+def test_asof_sorts_unsorted_times():
+    times = np.array([300, 100, 200, 100])
+    values = ["3", "1a", 2, "1b"]
+    assert asof_indices(times, [100, 250, 300]).tolist() == [3, 2, 0]
+    assert asof(times, [3.0, 1.0, 2.0, 1.5], [100, 250], direction='forward').tolist() == [1.0, 3.0]
+    # Values that are not numbers are NaN
+    assert np.isnan(asof(times, values, [150])[0])
+
+
+def test_unknown_direction_or_aggregate():
+    with pytest.raises(ValueError):
+        asof_indices([1], [1], direction='sideways')
+    with pytest.raises(ValueError):
+        resample([1], [1.0], 0, 10, 5, how='median')
+
+
+def test_resample_steps_are_closed_on_the_left():
+    times = np.array([0, 9, 10, 19, 20, 25])
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    # Steps [0, 10), [10, 20), [20, 25): the sample at the end is out of range
+    assert resample(times, values, 0, 25, 10, 'sum').tolist() == [3.0, 7.0, 5.0]
+    assert resample(times, values, 0, 25, 10, 'count').tolist() == [2.0, 2.0, 1.0]
+    assert resample(times, values, 0, 30, 10, 'last').tolist() == [2.0, 4.0, 6.0]
+    assert resample(times, values, 5, 25, 10, 'min').tolist() == [2.0, 4.0]
+    assert resample(times, values, 0, 30, 10, 'asof', tolerance=0).tolist() == [1.0, 3.0, 5.0]
+
+
+def test_resample_of_empty_or_unsorted_series():
+    assert resample([], [], 0, 20, 10, 'sum').tolist() == [0.0, 0.0]
+    assert np.isnan(resample([], [], 0, 20, 10)).all()
+    assert resample([5], [1.0], 0, 0, 10).tolist() == []
+    # NaN samples are skipped, but still counted as events
+    assert resample([12, 3, 15], [2.0, 1.0, np.nan], 0, 20, 10, 'mean').tolist() == [1.0, 2.0]
+    assert resample([12, 3, 15], [2.0, 1.0, np.nan], 0, 20, 10, 'count').tolist() == [1.0, 2.0]
+    assert resample([12, 3, 15], [2.0, 1.0, 4.0], 0, 20, 10, 'last').tolist() == [1.0, 4.0]
+
+
+@pytest.fixture
+def glucose(data_root, cleaned_folder):
+    # cbg every 5 minutes, and an smbg reading (twice the cbg) every 30 minutes
+    cbg = [make_cbg(i) for i in range(24)]
+    smbg = [make_cbg(i, id=f"smbg{i}", type='smbg', value=2 * cbg[i]['value']) for i in range(0, 24, 6)]
+    data_parser.parse_batch({'cbg': cbg, 'smbg': smbg}, datetime(2023, 10, 1), "tidepool")
+    return cleaned_folder
+
+
+def test_align_on_a_metric(glucose):
+    aligned = align_metrics(["tidepool/cbg", "tidepool/smbg"], on="tidepool/cbg", tolerance=600,
+                            cleaned_folder_path=glucose)
+    assert aligned.index.tolist() == [OCTOBER + 300 * i for i in range(24)]
+    # smbg as of each cbg sample: 0 and 5 minutes after a reading, not 10
+    smbg = aligned["tidepool/smbg"].to_numpy()
+    assert not np.isnan(smbg[[0, 1, 2, 6, 7, 8]]).any()
+    assert np.isnan(smbg[[3, 4, 5, 9]]).all()
+    assert smbg[2] == 2 * aligned["tidepool/cbg"].iloc[0]
+
+    window = align_metrics(["tidepool/smbg"], OCTOBER + 600, OCTOBER + 1800, on="tidepool/cbg",
+                           cleaned_folder_path=glucose)
+    assert window.index.tolist() == [OCTOBER + 600 + 300 * i for i in range(4)]
+
+
+def test_align_on_a_grid(glucose):
+    aligned = align_metrics(["tidepool/cbg", "tidepool/smbg"], step=3600, cleaned_folder_path=glucose)
+    assert aligned.index.tolist() == [OCTOBER, OCTOBER + 3600]
+    values = [make_cbg(i)['value'] for i in range(24)]
+    assert aligned["tidepool/cbg"].tolist() == pytest.approx([np.mean(values[:12]), np.mean(values[12:])])
+
+    with pytest.raises(ValueError):
+        align_metrics(["tidepool/cbg"], step=3600, on="tidepool/cbg", cleaned_folder_path=glucose)
+
+
+def test_align_without_data(data_root, cleaned_folder):
+    aligned = align_metrics(["tidepool/cbg"], step=300, cleaned_folder_path=cleaned_folder)
+    assert aligned.empty and list(aligned.columns) == ["tidepool/cbg"]
+    aligned = align_metrics(["tidepool/cbg"], on="tidepool/smbg", cleaned_folder_path=cleaned_folder)
+    assert aligned.empty
+
+
+def test_compare_metrics_aligned(glucose, monkeypatch):
+    monkeypatch.setattr(data_analysis.plt, "show", lambda: None)
+    correlation = data_analysis.compare_metrics_aligned("tidepool/smbg", "tidepool/cbg", cleaned_folder_path=glucose)
+    assert correlation == pytest.approx(1.0)
@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark.py")
+
+
+def test_generate_statistics_stage_runs(tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run([sys.executable, BENCHMARK, "--days", "1", "--stages", "parse_tidepool_data",
+                    "generate_statistics", "--workdir", str(tmp_path / "work"), "--output", str(output)],
+                   check=True, capture_output=True, cwd=tmp_path)
+
+    stages = json.loads(output.read_text())['stages']
+    assert 'error' not in stages['generate_statistics']
+    assert stages['generate_statistics']['records'] == stages['parse_tidepool_data']['records']
+
+
+def test_failed_stage_fails_the_run(tmp_path, monkeypatch):
+    def failing_user(workdir, days, seed, stages, pipelined=False):
+        return {'seed': seed, 'generated': {}, 'stages': {stage: {'error': "ValueError: boom"} for stage in stages}}
+    monkeypatch.setattr(benchmark, "benchmark_user", failing_user)
+    monkeypatch.setattr(sys, "argv", ["benchmark.py", "--days", "1", "--stages", "generate_statistics",
+                                      "--workdir", str(tmp_path), "--output", str(tmp_path / "results.json")])
+
+    with pytest.raises(SystemExit) as exit_info:
+        benchmark.main()
+    assert exit_info.value.code == 1
+    assert json.loads((tmp_path / "results.json").read_text())['stages']['generate_statistics']['error']
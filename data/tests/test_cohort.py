@@ -0,0 +1,30 @@
+from datetime import datetime
+
+import cohort
+import data_analysis
+import data_parser
+from conftest import make_cbg
+
+
+def _ingest_user(users_folder: str, user_id: str, month: int, metric: str):
+    data_parser.use_data_root(cohort.user_root(user_id, users_folder))
+    data_parser.create_folders()
+    data_parser.parse_batch({metric: [make_cbg(i, month, type=metric) for i in range(10)]},
+                            datetime(2023, month, 1), "tidepool", storage="json")
+
+
+def test_statistics_do_not_leak_between_users_of_a_process(tmp_path):
+    users_folder = str(tmp_path / "users")
+    _ingest_user(users_folder, "alice", 9, 'cbg')
+    _ingest_user(users_folder, "bob", 10, 'bolus')
+
+    try:
+        # Pool processes run the tasks of several users one after another
+        assert 'error' not in cohort.run_user_task("alice", cohort.STATISTICS_TASK, users_folder)
+        assert 'error' not in cohort.run_user_task("bob", cohort.STATISTICS_TASK, users_folder)
+    finally:
+        data_parser.use_data_root("")
+
+    assert data_analysis.total_metrics == {'bolus'}
+    assert dict(data_analysis.metric_entry_count) == {'bolus': {'10-01-2023': 10}}
+    assert set(data_analysis.metric_days) == {'bolus'}
@@ -0,0 +1,94 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+import data_parser
+from columnar import (EXTRA_COLUMN, append_columnar_segment, columns_to_records, extra_column,
+                      read_columnar_partition, records_to_columns, schema_for)
+from conftest import assert_same_records, make_calories, make_cbg, partition_for
+from dedup_index import DedupIndex, index_path
+from storage import compact, convert_partition, read_columns, read_records
+
+
+def test_fields_outside_the_schema_survive_a_columnar_write(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    entries = [make_cbg(i, payload='{"trend": 3}') for i in range(3)]
+    append_columnar_segment(partition_path, 'cbg', entries)
+
+    assert_same_records(read_records(partition_path), entries)
+
+
+def test_nested_extra_fields_are_merged_back():
+    entries = [{'utc_Time': "2023-10-01T00:00:00Z", 'local_Time': "2023-10-01T00:00:00", 'timezoneOffset': 0.0,
+                'value': {'bpm': 70, 'confidence': 2, 'source': "wrist"}},
+               # Out of uint8's range, and without a confidence
+               {'utc_Time': "2023-10-01T00:00:05Z", 'local_Time': "2023-10-01T00:00:05", 'timezoneOffset': 0.0,
+                'value': {'bpm': 300}}]
+    columns = records_to_columns(entries, schema_for('heart_rate'))
+    columns[EXTRA_COLUMN] = extra_column(entries, schema_for('heart_rate'))
+    assert columns_to_records(columns) == entries
+
+
+def test_segments_without_the_extra_column_still_merge(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    # A segment written before the extra column existed
+    old = records_to_columns([make_cbg(0)], schema_for('cbg'))
+    np.savez(os.path.splitext(partition_path)[0] + ".seg-0-0.npz", **old)
+    append_columnar_segment(partition_path, 'cbg', [make_cbg(1)])
+
+    merged = read_columnar_partition(partition_path)
+    assert merged[EXTRA_COLUMN].tolist()[0] == ""
+    assert compact(partition_path)
+    assert [record['id'] for record in read_records(partition_path)] == [make_cbg(i)['id'] for i in range(2)]
+
+
+def test_read_columns_hides_the_extra_column(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    append_columnar_segment(partition_path, 'cbg', [make_cbg(0)])
+    assert EXTRA_COLUMN not in read_columns(partition_path, 'cbg')
+
+
+def test_convert_keeps_every_field(data_root, cleaned_folder):
+    entries = [make_cbg(i, type='smbg') for i in range(4)]
+    data_parser.parse_batch({'smbg': entries}, datetime(2023, 10, 1), "tidepool", storage="json")
+
+    partition_path = partition_for(cleaned_folder, 'smbg')
+    assert convert_partition(partition_path, 'smbg', "columnar")
+    assert_same_records(read_records(partition_path), entries)
+
+
+def test_object_column_of_equal_length_lists_is_one_dimensional():
+    entries = [make_cbg(i, nutrients=[{'name': 'calories', 'amount': i}, {'name': 'protein', 'amount': 1}])
+               for i in range(3)]
+    columns = records_to_columns(entries, {'nutrients': 'object'})
+    assert columns['nutrients'].shape == (3,)
+    assert columns['nutrients'][2] == entries[2]['nutrients']
+
+
+def test_columnar_partitions_give_back_the_records_written(cleaned_folder):
+    partition_path = partition_for(cleaned_folder, 'steps', 'fitbit')
+    entries = [
+        {**make_calories(0), 'value': "12"},
+        {**make_calories(1), 'value': 12},
+        {**make_calories(2), 'value': 70000},
+        {**make_calories(3), 'value': "n/a"},
+        {**make_calories(4), 'value': None},
+        {key: value for key, value in make_calories(5).items() if key != 'value'},
+    ]
+    append_columnar_segment(partition_path, 'steps', entries)
+    assert_same_records(read_records(partition_path), entries)
+    assert read_columns(partition_path, 'steps')['value'].tolist() == [12, 12, 0, 0, 0, 0]
+
+
+def test_reingesting_a_converted_partition_adds_nothing(data_root, cleaned_folder):
+    entries = [make_calories(i) for i in range(3)]
+    data_parser.parse_batch({'calories': entries}, datetime(2023, 10, 1), "fitbit")
+    partition_path = partition_for(cleaned_folder, 'calories', 'fitbit')
+    assert convert_partition(partition_path, 'calories', "columnar")
+    assert_same_records(read_records(partition_path), entries)
+
+    # Rebuilt from the columnar records, the index still knows them
+    os.remove(index_path(partition_path))
+    assert DedupIndex.load(partition_path).filter_new(entries) == []
+    assert data_parser.parse_batch({'calories': entries}, datetime(2023, 10, 1), "fitbit") == 0
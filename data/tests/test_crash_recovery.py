@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+
+import data_parser
+from conftest import make_cbg, partition_for
+from dedup_index import DedupIndex, pending_path
+from rollups import read_tiers
+from sqlite_store import SqliteDedupIndex
+from storage import read_records
+
+DAY = 86400
+
+
+def crash(*args):
+    os._exit(1)
+
+
+def crashing_parse(data_batch: dict, storage: str, crash_point: str):
+    # Runs in a forked child, which dies at `crash_point` like a killed worker
+    if crash_point == 'save':
+        DedupIndex.save = crash
+        SqliteDedupIndex.save = crash
+    else:
+        data_parser.update_rollups = crash
+    data_parser.parse_batch(data_batch, datetime(2023, 10, 1), "tidepool", storage)
+
+
+def run_killed(data_batch: dict, storage: str, crash_point: str):
+    child = multiprocessing.get_context("fork").Process(target=crashing_parse, args=(data_batch, storage, crash_point))
+    child.start()
+    child.join()
+    assert child.exitcode == 1
+
+
+@pytest.mark.parametrize("storage", ["json", "sqlite"])
+@pytest.mark.parametrize("crash_point", ["rollup", "save"])
+def test_rerun_after_crash_stores_and_counts_each_record_once(cleaned_folder, storage, crash_point):
+    partition_path = partition_for(cleaned_folder)
+    entries = [make_cbg(i) for i in range(8)]
+    assert data_parser.parse_batch({'cbg': entries[:5]}, datetime(2023, 10, 1), "tidepool", storage) == 5
+
+    run_killed({'cbg': entries}, storage, crash_point)
+    assert os.path.exists(pending_path(partition_path))
+
+    # Resumed: the three entries the killed run stored are not written again
+    assert data_parser.parse_batch({'cbg': entries}, datetime(2023, 10, 1), "tidepool", storage) == 0
+    assert sorted(entry['id'] for entry in read_records(partition_path)) == [entry['id'] for entry in entries]
+    assert read_tiers(partition_path)[DAY]['count'].sum() == 8
+    assert not os.path.exists(pending_path(partition_path))
+
+    # And the rebuilt index keeps later runs incremental
+    assert data_parser.parse_batch({'cbg': [make_cbg(8)]}, datetime(2023, 10, 1), "tidepool", storage) == 1
+    assert read_tiers(partition_path)[DAY]['count'].sum() == 9
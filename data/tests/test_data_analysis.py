@@ -0,0 +1,65 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import data_analysis
+import data_parser
+from conftest import make_cbg
+from daily_summary import DailySummary, partition_fingerprint
+from rollups import remove_rollups
+from storage import list_partitions
+
+
+def test_generate_statistics_of_a_cleaned_folder(data_root, cleaned_folder):
+    # One day of cbg: 288 samples 5 minutes apart
+    entries = [make_cbg(i) for i in range(288)]
+    data_parser.parse_batch({'cbg': entries}, datetime(2023, 10, 1), "tidepool", storage="json")
+
+    results = data_analysis.generate_statistics(cleaned_folder)
+
+    assert results['cbg_avg']['10-01'] == pytest.approx(sum(entry['value'] for entry in entries) / 288)
+    assert data_analysis.metric_entry_count['cbg']['10-01-2023'] == 288
+    assert data_analysis.get_foldernames(str(data_root / "missing")) == []
+
+
+def _evening_across_months(value_sep: float, value_oct: float) -> tuple:
+    """
+    Returns cbg entries of local day 09-30 at UTC-4: its first 20 hours are in
+    the September partition, its last 4 hours in the October one.
+    """
+    start = datetime(2023, 9, 30, 4)
+    september, october = [], []
+    for i in range(288):
+        utc = start + timedelta(minutes=5 * i)
+        local = utc - timedelta(hours=4)
+        entry = make_cbg(i, utc_Time=f"{utc:%Y-%m-%dT%H:%M:%SZ}", local_Time=f"{local:%Y-%m-%dT%H:%M:%S}",
+                         timezoneOffset=-240.0, value=value_sep if utc.month == 9 else value_oct)
+        (september if utc.month == 9 else october).append(entry)
+    return september, october
+
+
+@pytest.mark.parametrize("rollups", [True, False])
+def test_local_day_split_across_partitions(data_root, cleaned_folder, rollups):
+    september, october = _evening_across_months(5.0, 10.0)
+    data_parser.parse_batch({'cbg': september}, datetime(2023, 9, 1), "tidepool", storage="json")
+    data_parser.parse_batch({'cbg': october}, datetime(2023, 10, 1), "tidepool", storage="json")
+    if not rollups:
+        for partition_path in list_partitions(os.path.join(cleaned_folder, "tidepool", "cbg")):
+            remove_rollups(partition_path)
+
+    results = data_analysis.generate_statistics(cleaned_folder)
+
+    assert len(september) == 240 and len(october) == 48
+    assert results['cbg_avg']['09-30'] == pytest.approx((240 * 5.0 + 48 * 10.0) / 288)
+
+
+def test_summary_rows_from_before_sums_are_recomputed(tmp_path):
+    summary = DailySummary(str(tmp_path / "summary.json"), {
+        "cbg/cbg-2023-9.json": {'metric': 'cbg', 'fingerprint': partition_fingerprint("cbg/cbg-2023-9.json"),
+                                'results': {'cbg_avg': {'09-30': 5.0}}, 'entry_counts': {}},
+    })
+    rows = {'results': {'cbg_avg': {'09-30': [50.0, 10]}}, 'means': ['cbg_avg'], 'entry_counts': {}}
+
+    assert summary.refresh([("cbg/cbg-2023-9.json", 'cbg')], lambda *args: rows) == 1
+    assert summary.results()['cbg_avg']['09-30'] == 5.0
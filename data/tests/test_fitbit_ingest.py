@@ -0,0 +1,134 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import data_parser
+from bucketing import MonthBucketer
+from config import FITBIT_FILE_PARALLEL_MIN_FILES
+from storage import list_partitions, read_records
+
+
+class SpyExecutor(ThreadPoolExecutor):
+    """
+    Thread pool that records what is submitted, and the most futures submitted
+    but not yet taken at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = []
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append((fn.__name__, args[0]))
+        self.outstanding += 1
+        self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        future = super().submit(fn, *args, **kwargs)
+        result = future.result
+
+        def taken(*result_args):
+            self.outstanding -= 1
+            return result(*result_args)
+        future.result = taken
+        return future
+
+
+def write_daily_files(folder: str, metric: str, days: int, per_day: int = 24, start=datetime(2023, 10, 25)) -> list:
+    """
+    Writes one Fitbit JSON file per day of `metric`, with a record per hour.
+    Returns their file structs.
+    """
+    os.makedirs(folder, exist_ok=True)
+    file_structs = []
+    for day in range(days):
+        midnight = start + timedelta(days=day)
+        records = [{'dateTime': f"{midnight + timedelta(hours=hour):%m/%d/%y %H:%M:%S}", 'value': str(day * 100 + hour)}
+                   for hour in range(per_day)]
+        filename = os.path.join(folder, f"{metric}-{midnight:%Y-%m-%d}.json")
+        with open(filename, 'w') as export_file:
+            json.dump(records, export_file)
+        file_structs.append({'filename': filename, 'dates': f"{midnight:%Y-%m-%d}", 'extension': '.json'})
+    return file_structs
+
+
+def stored(cleaned_folder: str, metric: str) -> list:
+    records = []
+    for partition_path in list_partitions(os.path.join(cleaned_folder, "fitbit", metric)):
+        records.extend(read_records(partition_path))
+    return sorted(records, key=lambda record: record['utc_Time'])
+
+
+def test_parallel_ingest_matches_serial(data_root, cleaned_folder):
+    file_structs = write_daily_files(str(data_root / "export"), "steps", 12)
+    data_parser.ingest_fitbit_metric("steps", file_structs)
+    serial = stored(cleaned_folder, "steps")
+
+    data_parser.use_data_root(str(data_root / "parallel"))
+    data_parser.create_folders()
+    with SpyExecutor(max_workers=2) as executor:
+        stats = data_parser.ingest_fitbit_metric("steps", file_structs, executor, in_flight=3)
+
+    assert stats['records'] == 12 * 24
+    assert stored(data_parser.cleaned_folder, "steps") == serial
+    # Crosses from October into November
+    assert len(list_partitions(os.path.join(data_parser.cleaned_folder, "fitbit", "steps"))) == 2
+
+
+def test_parallel_ingest_bounds_decoded_files(data_root):
+    file_structs = write_daily_files(str(data_root / "export"), "steps", 12)
+    with SpyExecutor(max_workers=2) as executor:
+        data_parser.ingest_fitbit_metric("steps", file_structs, executor, in_flight=3)
+
+    assert len(executor.submitted) == 12
+    assert executor.max_outstanding <= 3
+
+
+def test_file_tasks_go_before_whole_metrics(data_root, monkeypatch):
+    export = str(data_root / "export")
+    many = write_daily_files(export, "heart_rate", FITBIT_FILE_PARALLEL_MIN_FILES)
+    few = write_daily_files(export, "calories", 1)
+    executors = []
+
+    def spy_pool(max_workers, initializer, initargs):
+        executors.append(SpyExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs))
+        return executors[-1]
+    monkeypatch.setattr(data_parser, "ProcessPoolExecutor", spy_pool)
+
+    data_parser.parse_fitbit_data([file_struct['filename'] for file_struct in many + few], workers=2)
+
+    names = [name for name, _ in executors[0].submitted]
+    assert names == ['decode_fitbit_file'] * len(many) + ['ingest_fitbit_metric']
+
+
+def test_newest_first_file_spills_instead_of_buffering(data_root, cleaned_folder, monkeypatch):
+    # Like sleep-*.json, the records of the file run backwards in time
+    file_structs = write_daily_files(str(data_root / "export"), "steps", 1, per_day=24)
+    with open(file_structs[0]['filename']) as export_file:
+        records = json.load(export_file)
+    with open(file_structs[0]['filename'], 'w') as export_file:
+        json.dump(records[::-1], export_file)
+
+    read, held = [], []
+    iter_fitbit_file = data_parser.iter_fitbit_file
+
+    def counting_iter(*args):
+        for pair in iter_fitbit_file(*args):
+            read.append(pair)
+            yield pair
+
+    class SmallBucketer(MonthBucketer):
+        def add(self, *args):
+            super().add(*args)
+            held.append(len(read) - self.entries_added)
+            assert self.buffered <= self.max_buffered
+    monkeypatch.setattr(data_parser, "iter_fitbit_file", counting_iter)
+    monkeypatch.setattr(data_parser, "MonthBucketer", lambda *args: SmallBucketer(*args, max_buffered=6))
+
+    stats = data_parser.ingest_fitbit_metric("steps", file_structs)
+
+    assert stats['records'] == 24
+    # Records read but not yet bucketed: only the merge's head of each run
+    assert max(held) <= 1
+    assert [record['value'] for record in stored(cleaned_folder, "steps")] == [str(hour) for hour in range(24)]
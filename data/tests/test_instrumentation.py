@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import data_parser
+from config import INSTRUMENT_BATCH_SIZE
+from instrumentation import RunReport, collecting
+from synthetic_exports import generate_fitbit, generate_tidepool
+
+
+@pytest.fixture
+def stage_entries(monkeypatch):
+    """
+    Records the (key, stage) of every stage entered.
+    """
+    entered = []
+    enter = RunReport.enter
+
+    def recording_enter(self, key, name):
+        entered.append((key, name))
+        enter(self, key, name)
+    monkeypatch.setattr(RunReport, "enter", recording_enter)
+    return entered
+
+
+def _listed(folder: str) -> list:
+    return [os.path.join(root, name) for root, _, names in os.walk(folder) for name in sorted(names)]
+
+
+def test_tidepool_stages_are_timed_per_batch(data_root, stage_entries):
+    export = str(data_root / "export")
+    entries = generate_tidepool(export, days=10)
+
+    with collecting() as report:
+        data_parser.parse_tidepool_data(_listed(export))
+
+    batches = -(-entries // INSTRUMENT_BATCH_SIZE)
+    for name in ('decode', 'normalize', 'bucket'):
+        assert stage_entries.count(("tidepool", name)) <= batches + 2
+    counters = report.to_dict()['entries']
+    assert sum(entry['counters'].get('records_read', 0) for entry in counters.values()) == entries
+    assert counters['tidepool']['counters']['records_rejected'] == 0
+
+
+def test_fitbit_stages_are_timed_per_batch(data_root, stage_entries):
+    export = str(data_root / "export")
+    generate_fitbit(export, days=1)
+    file_structs = data_parser.discover_fitbit_files(_listed(export))['steps']
+
+    stats = data_parser.ingest_fitbit_metric("steps", file_structs)
+
+    assert stats['records'] == 1440
+    for name in ('decode', 'normalize', 'bucket'):
+        assert stage_entries.count(("fitbit/steps", name)) <= 4
+    assert stats['report']['entries']['fitbit/steps']['counters']['records_read'] == 1440
@@ -0,0 +1,59 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+import data_parser
+from conftest import assert_same_records, make_calories, make_cbg, partition_for
+from dedup_index import DedupIndex, index_path
+from packed import append_packed_segment, packed_files
+from storage import PACKED_STORAGE, compact, convert_partition, partition_format, read_columns, read_records
+
+
+def test_cbg_is_not_packed_by_default(cleaned_folder):
+    entries = [make_cbg(i, payload='{"trend": 3}') for i in range(5)]
+    data_parser.parse_batch({'cbg': entries}, datetime(2023, 10, 1), "tidepool")
+
+    partition_path = partition_for(cleaned_folder)
+    assert partition_format(partition_path) != PACKED_STORAGE
+    assert_same_records(read_records(partition_path), entries)
+
+
+def test_packed_rows_keep_fields_outside_the_schema(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    entries = [make_cbg(i, payload='{"trend": 3}') for i in range(5)]
+    append_packed_segment(partition_path, 'cbg', entries)
+
+    assert_same_records(read_records(partition_path), entries)
+    assert set(read_columns(partition_path, 'cbg')) == {'utc_Time', 'timezoneOffset', 'id', 'value', 'units'}
+
+
+def test_long_strings_widen_the_packed_column(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    short = [make_cbg(i) for i in range(0, 6, 2)]
+    long = [make_cbg(i, id=f"upload-{i}-" + "x" * 80) for i in range(1, 6, 2)]
+    data_parser.parse_batch({'cbg': short}, datetime(2023, 10, 1), "tidepool", storage=PACKED_STORAGE)
+    data_parser.parse_batch({'cbg': long}, datetime(2023, 10, 1), "tidepool", storage=PACKED_STORAGE)
+
+    expected = sorted(short + long, key=lambda entry: entry['utc_Time'])
+    assert_same_records(read_records(partition_path), expected)
+
+    assert compact(partition_path)
+    assert len(packed_files(partition_path)) == 1
+    rows = np.load(packed_files(partition_path)[0])
+    assert rows.dtype['id'].itemsize >= len(long[0]['id'])
+    assert_same_records(read_records(partition_path), expected)
+
+
+def test_reingesting_a_packed_partition_adds_nothing(data_root, cleaned_folder):
+    entries = [make_calories(i) for i in range(3)] + [{**make_calories(3), 'value': 2.5}]
+    data_parser.parse_batch({'calories': entries}, datetime(2023, 10, 1), "fitbit")
+    partition_path = partition_for(cleaned_folder, 'calories', 'fitbit')
+    assert convert_partition(partition_path, 'calories', PACKED_STORAGE)
+    assert_same_records(read_records(partition_path), entries)
+    assert read_columns(partition_path, 'calories')['value'].tolist() == [1.0, 1.01, 1.02, 2.5]
+
+    # Rebuilt from the packed records, the index still knows them
+    os.remove(index_path(partition_path))
+    assert DedupIndex.load(partition_path).filter_new(entries) == []
+    assert data_parser.parse_batch({'calories': entries}, datetime(2023, 10, 1), "fitbit") == 0
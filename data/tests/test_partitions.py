@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+
+from conftest import make_cbg, partition_for
+from locks import partition_lock
+from partitions import append_segment, read_partition_range, segment_paths
+from query import load_metric
+from storage import compact, read_records
+from timestamps import get_utc_epoch
+
+
+def test_segments_and_base_are_merged_in_time_order(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    append_segment(partition_path, [make_cbg(i) for i in (4, 0, 2)])
+    append_segment(partition_path, [make_cbg(i) for i in (3, 1)])
+    assert [entry['id'] for entry in read_records(partition_path)] == [make_cbg(i)['id'] for i in range(5)]
+
+    assert compact(partition_path)
+    assert segment_paths(partition_path) == []
+    assert len(read_records(partition_path)) == 5
+
+
+def test_compaction_waits_for_readers(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    append_segment(partition_path, [make_cbg(0)])
+
+    compactor = threading.Thread(target=compact, args=(partition_path,))
+    with partition_lock(partition_path, shared=True):
+        compactor.start()
+        time.sleep(0.2)
+        # The segment a reader may have listed is still there
+        assert len(segment_paths(partition_path)) == 1
+    compactor.join(5)
+    assert segment_paths(partition_path) == []
+
+
+def test_reads_during_compaction_see_each_record_once(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    append_segment(partition_path, [make_cbg(i) for i in range(200)])
+    stop = threading.Event()
+
+    def write_and_compact():
+        i = 200
+        while not stop.is_set():
+            append_segment(partition_path, [make_cbg(i)])
+            compact(partition_path)
+            i += 1
+
+    writer = threading.Thread(target=write_and_compact)
+    writer.start()
+    try:
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            ids = [entry['id'] for entry in read_records(partition_path)]
+            assert len(ids) == len(set(ids))
+    finally:
+        stop.set()
+        writer.join(5)
+
+
+def test_a_read_inside_the_write_lock_does_not_deadlock(cleaned_folder):
+    partition_path = partition_for(cleaned_folder)
+    append_segment(partition_path, [make_cbg(0)])
+    with partition_lock(partition_path):
+        assert len(read_records(partition_path)) == 1
+
+
+def _baseline_partition(cleaned_folder: str, entries: list) -> str:
+    # What parse_batch wrote before segments: one json.dump line, no time index
+    partition_path = partition_for(cleaned_folder)
+    with open(partition_path, 'w') as json_file:
+        json.dump(entries, json_file)
+    return partition_path
+
+
+def test_range_read_of_a_baseline_partition(cleaned_folder):
+    entries = [make_cbg(i) for i in range(100)]
+    partition_path = _baseline_partition(cleaned_folder, entries)
+    start, end = get_utc_epoch(entries[10]), get_utc_epoch(entries[20])
+
+    assert read_partition_range(partition_path, start, end) == entries[10:20]
+    assert read_records(partition_path, start, end) == entries[10:20]
+    frame = load_metric("tidepool", "cbg", start, end, columns=['value'], cleaned_folder_path=cleaned_folder)
+    assert frame['value'].tolist() == [entry['value'] for entry in entries[10:20]]
+
+
+def test_range_read_of_a_baseline_partition_with_segments(cleaned_folder):
+    entries = [make_cbg(i) for i in range(100)]
+    partition_path = _baseline_partition(cleaned_folder, entries[::2])
+    append_segment(partition_path, entries[1::2])
+
+    assert read_partition_range(partition_path, get_utc_epoch(entries[5]), None) == entries[5:]
@@ -0,0 +1,52 @@
+import os
+from datetime import datetime
+
+import pipeline
+from bucketing import MonthBucketer
+from storage import list_partitions, read_records
+from synthetic_exports import generate_tidepool
+
+
+def _bucketer(counts: dict) -> MonthBucketer:
+    bucketer = MonthBucketer("tidepool", write_batch=None)
+    for month, n in counts.items():
+        for i in range(n):
+            bucketer.add(datetime(2023, month, 1 + i % 28), 'cbg', {'i': i})
+    return bucketer
+
+
+def test_take_full_takes_buffers_of_size():
+    bucketer = _bucketer({9: 10, 10: 3})
+    chunks = bucketer.take_full(5)
+    assert [(dateobj.month, len(entries)) for _, dateobj, entries in chunks] == [(9, 10)]
+    assert bucketer.buffered == 3
+
+
+def test_take_full_caps_the_volume_buffered():
+    bucketer = _bucketer({8: 4, 9: 3, 10: 2})
+    chunks = bucketer.take_full(5, max_buffered=4)
+    assert sorted(dateobj.month for _, dateobj, _ in chunks) == [8, 9]
+    assert bucketer.buffered == 2
+    assert [dateobj.month for _, dateobj, _ in bucketer.drain()] == [10]
+
+
+def test_pipeline_writes_a_month_before_the_export_is_read(data_root, cleaned_folder, monkeypatch):
+    export = str(data_root / "export")
+    # A month of 5-minute cbg, well under the old 50k threshold
+    entries = generate_tidepool(export, start=datetime(2023, 10, 1), days=31)
+    writes = []
+    write_chunk = pipeline.write_chunk
+
+    def recording_write_chunk(source, metric, dateobj, chunk):
+        writes.append((metric, len(chunk)))
+        return write_chunk(source, metric, dateobj, chunk)
+    monkeypatch.setattr(pipeline, "write_chunk", recording_write_chunk)
+
+    pipeline.run_pipeline("tidepool", [os.path.join(export, name) for name in os.listdir(export)],
+                          normalize_workers=0, writers=1)
+
+    assert len([metric for metric, _ in writes if metric == 'cbg']) > 1
+    assert sum(n for _, n in writes) == entries
+    stored = sum(len(read_records(partition_path)) for metric in ('cbg', 'smbg', 'basal', 'bolus')
+                 for partition_path in list_partitions(os.path.join(cleaned_folder, "tidepool", metric)))
+    assert stored == entries
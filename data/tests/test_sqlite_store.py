@@ -0,0 +1,37 @@
+import logging
+import os
+
+import sqlite_store
+
+
+def _mounts(tmp_path, lines: list) -> str:
+    mounts_path = tmp_path / "mounts"
+    mounts_path.write_text("".join(f"{line} 0 0\n" for line in lines))
+    return str(mounts_path)
+
+
+def test_filesystem_type_is_the_longest_mount_point(tmp_path):
+    mounts = _mounts(tmp_path, ["/dev/sda1 / ext4 rw", "server:/export /mnt/shared\\040data nfs4 rw",
+                                "server:/export /mnt/sharedother nfs rw"])
+
+    assert sqlite_store.filesystem_type("/mnt/shared data/users/cleaned", mounts) == "nfs4"
+    assert sqlite_store.filesystem_type("/mnt/shared", mounts) == "ext4"
+    assert sqlite_store.filesystem_type("/home", str(tmp_path / "missing")) is None
+
+
+def test_no_wal_on_a_network_filesystem(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(sqlite_store, "filesystem_type", lambda path: "nfs4")
+    database_path = str(tmp_path / "cleaned.sqlite")
+
+    with caplog.at_level(logging.WARNING, logger="sqlite_store"):
+        connection = sqlite_store._connection(database_path, create=True)
+
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert "network filesystem" in caplog.text
+    assert not os.path.exists(database_path + "-wal")
+
+
+def test_wal_on_a_local_filesystem(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_store, "filesystem_type", lambda path: "ext4")
+    connection = sqlite_store._connection(str(tmp_path / "cleaned.sqlite"), create=True)
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
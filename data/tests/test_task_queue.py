@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+
+import data_parser
+import task_queue
+from config import RUN_REPORT_FILENAME
+from manifest import IngestionManifest
+from synthetic_exports import generate_tidepool
+
+
+def test_finalize_only_moves_the_files_of_its_run(data_root):
+    export = os.path.join(data_parser.export_folder, "tidepool")
+    generate_tidepool(export, days=1, seed=0)
+    generate_tidepool(export, days=1, seed=1)
+    planned = sorted(os.listdir(export))
+
+    queue = task_queue.TaskQueue(task_queue.queue_path())
+    try:
+        run = task_queue.plan_source(queue, "tidepool")
+    finally:
+        queue.close()
+    assert run is not None
+
+    # Exported while the run is in progress
+    generate_tidepool(export, days=1, seed=2)
+    late = sorted(set(os.listdir(export)) - set(planned))
+
+    assert task_queue.work() == len(planned) + 1
+    assert os.listdir(export) == late
+    assert sorted(os.listdir(os.path.join(data_parser.used_folder, "tidepool"))) == planned
+
+    manifest = IngestionManifest.load(data_parser.cleaned_folder)
+    paths = sorted(entry['path'] for entry in manifest.files.values())
+    assert paths == [os.path.join(data_parser.used_folder, "tidepool", name) for name in planned]
+
+
+def test_data_parser_resumes_the_planned_run(data_root, monkeypatch):
+    # The single-user layout, relative to the working directory
+    monkeypatch.chdir(data_root)
+    data_parser.use_data_root("")
+    data_parser.create_folders()
+    export = os.path.join(data_parser.export_folder, "tidepool")
+    generate_tidepool(export, days=1, seed=0)
+    planned = sorted(os.listdir(export))
+    # A run planned by a process that then died
+    queue = task_queue.TaskQueue(task_queue.queue_path())
+    try:
+        task_queue.plan_source(queue, "tidepool")
+    finally:
+        queue.close()
+
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_parser.py")
+    subprocess.run([sys.executable, script], check=True, capture_output=True)
+
+    queue = task_queue.TaskQueue(task_queue.queue_path())
+    try:
+        assert queue.counts() == {"tidepool": {'done': len(planned) + 1}}
+    finally:
+        queue.close()
+    assert sorted(os.listdir(os.path.join(data_parser.used_folder, "tidepool"))) == planned
+    with open(os.path.join(data_parser.cleaned_folder, RUN_REPORT_FILENAME)) as report_file:
+        assert json.load(report_file)['stages']
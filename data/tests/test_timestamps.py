@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from timestamps import TimestampParser, get_utc_epoch, parse_epochs
+
+
+def test_utc_formats_are_parsed_without_offset():
+    parser = TimestampParser()
+    assert parser.epoch("2023-10-09T18:33:18.000Z") == 1696876398
+    assert parser.epoch("2023-10-09T18:33:18Z") == 1696876398
+
+
+def test_naive_timestamps_are_local_wall_time():
+    converted = TimestampParser().convert("10/19/23 00:00:00", "America/New_York")
+    assert converted['utc_time'] == "2023-10-19T04:00:00Z"
+    assert converted['local_time'] == "2023-10-19T00:00:00"
+    assert converted['offset'] == -240.0
+
+
+def test_format_change_is_sniffed_again():
+    parser = TimestampParser()
+    parser.epoch("2023-11-04T07:04:33Z")
+    assert parser.epoch("11/01/23 00:00:00", "UTC") == 1698796800
+
+
+def test_unsupported_format_raises():
+    with pytest.raises(ValueError):
+        TimestampParser().epoch("yesterday")
+
+
+def test_parse_many_matches_scalar_parsing_across_dst():
+    values = ["2023-11-05T00:30:00", "2023-11-05T01:30:00", "2023-11-05T03:00:00"]
+    parser = TimestampParser()
+    expected = [parser.epoch(value, "America/New_York") for value in values]
+    assert np.array_equal(parse_epochs(values, timezone_str="America/New_York"), expected)
+
+
+def test_get_utc_epoch_reads_the_utc_column():
+    assert get_utc_epoch({'value': 1, 'utc_Time': "1970-01-01T00:01:00Z"}) == 60
@@ -0,0 +1,73 @@
+"""
+Registry of the timestamp columns of each Fitbit metric.
+
+Instead of testing every string of every record against TIMESTAMP_FORMATS, the
+columns holding timestamps are looked up once per metric: declared in
+TIMESTAMP_COLUMNS, or inferred from the first records of the metric's first file
+and cached. Records are then normalized by converting only those columns, each
+with a TimestampParser that remembers its column's format.
+"""
+
+import logging
+from itertools import islice
+
+from config import FITBIT_SCHEMA_SAMPLE_RECORDS, TIMESTAMP_COLUMNS
+from timestamps import TimestampParser, detect_format
+
+logger = logging.getLogger(__name__)
+
+# metric -> {column: format}, for metrics whose columns were inferred
+_inferred = {}
+
+
+def infer_timestamp_columns(records) -> dict:
+    """
+    Returns column -> format for the top-level string fields that hold a timestamp
+    in any of the given records.
+    """
+    columns = {}
+    for record in records:
+        for key, value in record.items():
+            if key not in columns and isinstance(value, str):
+                format_str = detect_format(value)
+                if format_str is not None:
+                    columns[key] = format_str
+    return columns
+
+
+def timestamp_columns(metric: str, records: list = None) -> dict:
+    """
+    Returns column -> format for a metric. Undeclared metrics are inferred from
+    `records` (a sample of their first records) the first time they are seen.
+    """
+    if metric in TIMESTAMP_COLUMNS:
+        return TIMESTAMP_COLUMNS[metric]
+    if metric not in _inferred:
+        if records is None:
+            return {}
+        _inferred[metric] = infer_timestamp_columns(records)
+        logger.info("Inferred timestamp columns of %s: %s", metric, _inferred[metric])
+    return _inferred[metric]
+
+
+def timestamp_parsers(metric: str, records: list = None) -> dict:
+    """
+    Returns column -> TimestampParser for a metric's timestamp columns.
+    """
+    return {column: TimestampParser(format_str)
+            for column, format_str in timestamp_columns(metric, records).items()}
+
+
+def sample_records(records, size: int = FITBIT_SCHEMA_SAMPLE_RECORDS):
+    """
+    Takes the first `size` records of an iterator. Returns the sample and an
+    iterator over all the records, sample included.
+    """
+    records = iter(records)
+    sample = list(islice(records, size))
+
+    def all_records():
+        yield from sample
+        yield from records
+
+    return sample, all_records()
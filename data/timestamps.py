@@ -0,0 +1,247 @@
+"""
+Timestamp parsing for the formats found in the Tidepool, Fitbit and Bitesnap
+exports (see TIMESTAMP_FORMATS in constants.py).
+
+Each format is compiled once into a regex. A TimestampParser sniffs the format
+from the first value it sees and keeps using it for the rest of the file or
+column, so the trial-and-error over every format only happens when the format
+actually changes. Offsets come from the cached transition tables in tz_offsets.py.
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
+
+from config import DEFAULT_TIMEZONE
+from constants import TIMESTAMP_FORMATS
+from tz_offsets import get_offsets
+
+# strptime directive -> regex fragment. Every compiled pattern exposes the same
+# named groups so the fast path can unpack them without caring about the format.
+_DIRECTIVES = {
+    "Y": r"(?P<Y>\d{4})",
+    "y": r"(?P<Y>\d{2})",
+    "m": r"(?P<m>\d{1,2})",
+    "d": r"(?P<d>\d{1,2})",
+    "H": r"(?P<H>\d{1,2})",
+    "M": r"(?P<M>\d{1,2})",
+    "S": r"(?P<S>\d{1,2})",
+    "f": r"(?P<f>\d{1,6})",
+}
+_GROUPS = ("Y", "m", "d", "H", "M", "S", "f")
+
+
+def _compile_format(format_str: str):
+    """
+    Turns a strptime format string into an anchored regex with the groups in _GROUPS.
+    Groups the format does not use are added as empty groups at the end.
+    """
+    parts = []
+    used = set()
+    i = 0
+    while i < len(format_str):
+        char = format_str[i]
+        if char == "%" and i + 1 < len(format_str):
+            directive = format_str[i + 1]
+            parts.append(_DIRECTIVES[directive])
+            used.add("Y" if directive == "y" else directive)
+            i += 2
+        else:
+            parts.append(re.escape(char))
+            i += 1
+
+    for group in _GROUPS:
+        if group not in used:
+            parts.append(f"(?P<{group}>)")
+
+    return re.compile("".join(parts))
+
+
+# format string -> (compiled regex, whether the timestamp is in UTC)
+_COMPILED_FORMATS = {
+    format_str: (_compile_format(format_str), format_str.endswith("Z"))
+    for format_str in TIMESTAMP_FORMATS
+}
+
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_SECOND = timedelta(seconds=1)
+
+
+@lru_cache(maxsize=None)
+def _fixed_offset(offset_seconds: int) -> timezone:
+    return timezone(timedelta(seconds=offset_seconds))
+
+
+def detect_format(timestamp_str) -> str:
+    """
+    Returns the first format in TIMESTAMP_FORMATS that matches the timestamp, or None.
+    """
+    if not isinstance(timestamp_str, str):
+        return None
+
+    for format_str, (pattern, _) in _COMPILED_FORMATS.items():
+        if pattern.fullmatch(timestamp_str):
+            return format_str
+    return None
+
+
+def _fields_to_wall_time(match) -> datetime:
+    """
+    Builds the naive datetime exactly as written in the timestamp.
+    """
+    year, month, day, hour, minute, second, fraction = match.group(*_GROUPS)
+
+    year = int(year)
+    if year < 100:
+        # Same century rule as strptime's %y
+        year += 1900 if year >= 69 else 2000
+
+    return datetime(
+        year, int(month), int(day),
+        int(hour or 0), int(minute or 0), int(second or 0),
+        int(fraction.ljust(6, "0")) if fraction else 0,
+    )
+
+
+def _iso_utc(datetime_obj: datetime) -> str:
+    return (f"{datetime_obj.year:04d}-{datetime_obj.month:02d}-{datetime_obj.day:02d}"
+            f"T{datetime_obj.hour:02d}:{datetime_obj.minute:02d}:{datetime_obj.second:02d}Z")
+
+
+def _iso_local(datetime_obj: datetime) -> str:
+    return (f"{datetime_obj.year:04d}-{datetime_obj.month:02d}-{datetime_obj.day:02d}"
+            f"T{datetime_obj.hour:02d}:{datetime_obj.minute:02d}:{datetime_obj.second:02d}")
+
+
+class TimestampParser:
+    """
+    Parses the timestamps of one file or column.
+
+    The format is detected from the first value and remembered; later values are
+    parsed with that format's compiled regex. If a value does not match, the format
+    is sniffed again and the new one is remembered instead.
+    """
+
+    def __init__(self, format_str: str = None):
+        self.format_str = None
+        self._pattern = None
+        self._is_utc = False
+        if format_str is not None:
+            self._use_format(format_str)
+
+    def _use_format(self, format_str: str):
+        self.format_str = format_str
+        self._pattern, self._is_utc = _COMPILED_FORMATS[format_str]
+
+    def _match(self, timestamp_str: str):
+        if self._pattern is not None:
+            match = self._pattern.fullmatch(timestamp_str)
+            if match:
+                return match
+
+        format_str = detect_format(timestamp_str)
+        if format_str is None:
+            raise ValueError("Unsupported timestamp format")
+
+        self._use_format(format_str)
+        return self._pattern.fullmatch(timestamp_str)
+
+    def matches(self, timestamp_str) -> bool:
+        """
+        Checks if a value is a timestamp in one of the accepted formats.
+        """
+        if not isinstance(timestamp_str, str):
+            return False
+        if self._pattern is not None and self._pattern.fullmatch(timestamp_str):
+            return True
+        return detect_format(timestamp_str) is not None
+
+    def _to_utc(self, timestamp_str: str, timezone_str: str):
+        """
+        Returns the naive UTC datetime and its epoch seconds.
+        """
+        match = self._match(timestamp_str)
+        wall_time = _fields_to_wall_time(match)
+        epoch = (wall_time - _EPOCH) // _ONE_SECOND
+
+        if not self._is_utc:
+            utc_epoch = get_offsets(timezone_str).local_to_utc(epoch)
+            wall_time -= timedelta(seconds=epoch - utc_epoch)
+            epoch = utc_epoch
+
+        return wall_time, epoch
+
+    def parse(self, timestamp_str: str, timezone_str: str = DEFAULT_TIMEZONE) -> datetime:
+        """
+        Returns the timestamp as a timezone-aware UTC datetime. Timestamps without
+        a 'Z' are wall-clock times in timezone_str.
+        """
+        return self._to_utc(timestamp_str, timezone_str)[0].replace(tzinfo=timezone.utc)
+
+    def epoch(self, timestamp_str: str, timezone_str: str = DEFAULT_TIMEZONE) -> int:
+        """
+        Returns the timestamp as whole seconds since the Unix epoch.
+        """
+        return self._to_utc(timestamp_str, timezone_str)[1]
+
+    def convert(self, timestamp_str: str, timezone_str: str = DEFAULT_TIMEZONE) -> dict:
+        """
+        Converts a timestamp to UTC and to the given timezone. The result has the
+        same keys as data_parser.convert_timestamp.
+        """
+        utc_time, utc_epoch = self._to_utc(timestamp_str, timezone_str)
+        offset_seconds = get_offsets(timezone_str).offset(utc_epoch)
+        local_time = utc_time + timedelta(seconds=offset_seconds)
+
+        return {
+            'utc_time': _iso_utc(utc_time),
+            'utc_datetime': utc_time.replace(tzinfo=timezone.utc),
+            'local_time': _iso_local(local_time),
+            'local_datetime': local_time.replace(tzinfo=_fixed_offset(offset_seconds)),
+            'offset': float(offset_seconds // 60),
+        }
+
+    def parse_many(self, timestamps, timezone_str: str = DEFAULT_TIMEZONE) -> np.ndarray:
+        """
+        Parses a sequence of timestamps into an int64 array of epoch seconds.
+        Naive timestamps are shifted to UTC in one vectorized pass at the end.
+        """
+        epochs = np.empty(len(timestamps), dtype=np.int64)
+        is_naive = np.zeros(len(timestamps), dtype=bool)
+        for i, timestamp_str in enumerate(timestamps):
+            match = self._match(timestamp_str)
+            epochs[i] = (_fields_to_wall_time(match) - _EPOCH) // _ONE_SECOND
+            is_naive[i] = not self._is_utc
+
+        if is_naive.any():
+            epochs[is_naive] = get_offsets(timezone_str).local_to_utc_many(epochs[is_naive])
+        return epochs
+
+
+# Parser for the utc_* columns of cleaned entries, which always share one format
+_utc_column_parser = TimestampParser()
+
+
+def get_utc_epoch(entry: dict) -> int:
+    """
+    Returns the epoch seconds of a cleaned entry's (first) UTC timestamp column.
+    """
+    return _utc_column_parser.epoch(next((v for k, v in entry.items() if 'utc' in k)))
+
+
+def parse_epochs(timestamps, format_str: str = None, timezone_str: str = DEFAULT_TIMEZONE) -> np.ndarray:
+    """
+    Batch entry point: parses a file's or column's timestamps into epoch seconds.
+    The format is detected once from the first value unless given.
+    """
+    return TimestampParser(format_str).parse_many(timestamps, timezone_str)
+
+
+def parse_datetime64(timestamps, format_str: str = None, timezone_str: str = DEFAULT_TIMEZONE) -> np.ndarray:
+    """
+    Same as parse_epochs, but returns a datetime64[s] array in UTC.
+    """
+    return parse_epochs(timestamps, format_str, timezone_str).astype("datetime64[s]")
@@ -0,0 +1,95 @@
+"""
+UTC -> local offset lookups backed by a timezone's transition table.
+
+The table is read from pytz once per zone. After that an offset is a binary
+search over the transition times, and whole arrays of UTC epochs are resolved
+with a single np.searchsorted call instead of one astimezone() per record.
+"""
+
+import bisect
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pytz
+
+from config import DEFAULT_TIMEZONE, SOURCE_TIMEZONES
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_epoch(datetime_obj: datetime) -> int:
+    return int((datetime_obj - _EPOCH).total_seconds())
+
+
+class TimezoneOffsets:
+    """
+    Transition table for one timezone: sorted UTC epochs at which the offset
+    changes, and the offset (in seconds) that applies from each one onwards.
+    """
+
+    def __init__(self, timezone_str: str):
+        self.timezone_str = timezone_str
+        tz = pytz.timezone(timezone_str)
+
+        transition_times = getattr(tz, '_utc_transition_times', None)
+        if transition_times:
+            # The first transition is datetime.min, which stands for "since forever"
+            self.transitions = [_to_epoch(t) if t.year > 1 else -2**62 for t in transition_times]
+            self.offsets = [int(info[0].total_seconds()) for info in tz._transition_info]
+        else:
+            # Fixed-offset zones (UTC, Etc/GMT+5, ...) have no table
+            self.transitions = [-2**62]
+            self.offsets = [int(tz.utcoffset(_EPOCH).total_seconds())]
+
+        self._transitions_array = np.array(self.transitions, dtype=np.int64)
+        self._offsets_array = np.array(self.offsets, dtype=np.int32)
+
+    def offset(self, utc_epoch: int) -> int:
+        """
+        Returns the UTC offset in seconds at a UTC epoch.
+        """
+        return self.offsets[bisect.bisect_right(self.transitions, utc_epoch) - 1]
+
+    def offsets_for(self, utc_epochs) -> np.ndarray:
+        """
+        Returns the UTC offsets in seconds for an array of UTC epochs.
+        """
+        utc_epochs = np.asarray(utc_epochs, dtype=np.int64)
+        indices = np.searchsorted(self._transitions_array, utc_epochs, side='right') - 1
+        return self._offsets_array[indices]
+
+    def local_to_utc(self, local_epoch: int) -> int:
+        """
+        Converts a wall-clock time in this zone (given as epoch seconds as if it were
+        UTC) to a UTC epoch. Ambiguous and skipped times resolve the same way
+        datetime.astimezone() does for a naive datetime (fold=0).
+        """
+        guess = local_epoch - self.offset(local_epoch)
+        offset = self.offset(guess)
+        return local_epoch - offset if self.offset(local_epoch - offset) == offset else guess
+
+    def local_to_utc_many(self, local_epochs) -> np.ndarray:
+        """
+        Array version of local_to_utc.
+        """
+        local_epochs = np.asarray(local_epochs, dtype=np.int64)
+        guess = local_epochs - self.offsets_for(local_epochs)
+        offsets = self.offsets_for(guess)
+        candidate = local_epochs - offsets
+        return np.where(self.offsets_for(candidate) == offsets, candidate, guess)
+
+
+@lru_cache(maxsize=None)
+def get_offsets(timezone_str: str = DEFAULT_TIMEZONE) -> TimezoneOffsets:
+    """
+    Returns the (cached) transition table for a timezone name.
+    """
+    return TimezoneOffsets(timezone_str)
+
+
+def timezone_for_source(source: str) -> str:
+    """
+    Returns the timezone configured for a data source, falling back to DEFAULT_TIMEZONE.
+    """
+    return SOURCE_TIMEZONES.get(source, DEFAULT_TIMEZONE)